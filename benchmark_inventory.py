@@ -0,0 +1,109 @@
+"""
+مقایسه دو چیدمان موجودی موشک (rows و packed) روی دیتابیس مصنوعی
+
+اجرا:
+    python benchmark_inventory.py --users 1000000 --ops 20000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from models import Inventory
+from inventory_store import INVENTORY_STORES
+
+# همان شناسه‌های MISSILE_DATA در main.py؛ main به خاطر BOT_TOKEN اینجا import نمی‌شود
+MISSILE_IDS = tuple(range(1, 11))
+Inventory.configure((missile_id, f'missile-{missile_id}') for missile_id in MISSILE_IDS)
+
+
+def open_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-16384')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+def build(conn: sqlite3.Connection, store, users: int, batch: int = 50000):
+    """ساخت users و موجودی تصادفی: هر کاربر ۳ تا ۱۰ نوع موشک"""
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, level INTEGER DEFAULT 1)')
+    conn.execute('CREATE TABLE missiles (id INTEGER PRIMARY KEY, name TEXT, rank INTEGER)')
+    store.create_schema(conn.cursor())
+    rng = random.Random(42)
+    for start in range(1, users + 1, batch):
+        conn.execute('BEGIN')
+        cursor = conn.cursor()
+        ids = range(start, min(start + batch, users + 1))
+        cursor.executemany('INSERT INTO users (user_id) VALUES (?)', ((user_id,) for user_id in ids))
+        for user_id in ids:
+            owned = rng.sample(MISSILE_IDS, rng.randint(3, len(MISSILE_IDS)))
+            store.seed(cursor, user_id, [(missile_id, rng.randint(1, 20)) for missile_id in owned])
+        conn.execute('COMMIT')
+
+
+def timed(label: str, ops: int, func) -> float:
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<22} {elapsed * 1000:10.1f} ms  {ops / elapsed:12,.0f} ops/s")
+    return elapsed
+
+
+def run_layout(name: str, users: int, ops: int, workdir: str):
+    store = INVENTORY_STORES[name]()
+    path = os.path.join(workdir, f'{name}.db')
+    conn = open_db(path)
+    print(f"\n== {name} ==")
+    timed('build', users, lambda: build(conn, store, users))
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print(f"  {'file size':<22} {os.path.getsize(path) / 1024 / 1024:10.1f} MB")
+
+    rng = random.Random(7)
+    sample = [rng.randint(1, users) for _ in range(ops)]
+
+    def loads():
+        for user_id in sample:
+            store.load(conn, user_id)
+
+    def single_row_tx(action):
+        def run():
+            for user_id in sample:
+                conn.execute('BEGIN IMMEDIATE')
+                action(conn.cursor(), user_id, rng.choice(MISSILE_IDS))
+                conn.execute('COMMIT')
+        return run
+
+    timed('load', ops, loads)
+    timed('take (1 tx each)', ops, single_row_tx(lambda c, u, m: store.take(c, u, m)))
+    timed('add (1 tx each)', ops, single_row_tx(lambda c, u, m: store.add(c, u, m, 1)))
+
+    def grant():
+        conn.execute('BEGIN IMMEDIATE')
+        store.grant(conn.cursor(), MISSILE_IDS[0], 3, '1', ())
+        conn.execute('COMMIT')
+
+    timed('grant to all users', users, grant)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--ops', type=int, default=20_000)
+    parser.add_argument('--layouts', default='rows,packed')
+    parser.add_argument('--dir', default=None, help='پوشه فایل‌های موقت (پیش‌فرض: tempdir)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        print(f"users={args.users:,} ops={args.ops:,} sqlite={sqlite3.sqlite_version}")
+        for name in args.layouts.split(','):
+            run_layout(name.strip(), args.users, args.ops, workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+موتور پیام همگانی - کارهای ماندگار در SQLite، ارسال هم‌زمان با محدودیت نرخ و ادامه پس از ری‌استارت
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """محدودکننده نرخ سراسری ارسال
+
+    توقف ناشی از RetryAfter روی همه ارسال‌کننده‌ها اعمال می‌شود، چون محدودیت
+    تلگرام برای کل ربات است نه برای هر چت.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BroadcastEngine:
+    """اجرای کارهای پیام همگانی
+
+    گیرنده‌ها با db.iter_users صفحه به صفحه به ترتیب user_id خوانده می‌شوند و هر صفحه
+    توسط چند ارسال‌کننده هم‌زمان فرستاده می‌شود. cursor پس از پایان هر صفحه ذخیره می‌شود،
+    پس پس از ری‌استارت حداکثر یک صفحه دوباره ارسال می‌شود. پیام پیشرفت ادمین هر
+    progress_interval ثانیه ویرایش می‌شود.
+    """
+
+    def __init__(self, bot: Bot, db, rate: float = 25, concurrency: int = 8,
+                 page_size: int = 200, progress_interval: float = 5, max_attempts: int = 3):
+        self.bot = bot
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self, admin_chat_id: int, text: str) -> int:
+        """ساخت کار جدید و شروع ارسال در پس‌زمینه"""
+        total = await self.db.count_users()
+        job_id = await self.db.create_broadcast_job(admin_chat_id, text, total)
+        job = {
+            'id': job_id, 'admin_chat_id': admin_chat_id, 'progress_message_id': None,
+            'text': text, 'cursor': 0, 'sent': 0, 'failed': 0, 'total': total
+        }
+        progress = await self.bot.send_message(admin_chat_id, self.render(job, started=time.monotonic()))
+        job['progress_message_id'] = progress.message_id
+        await self.db.set_broadcast_message(job_id, progress.message_id)
+        self._spawn(job)
+        return job_id
+
+    async def resume(self):
+        """ادامه کارهای نیمه‌تمام پس از ری‌استارت"""
+        for job in await self.db.get_running_broadcasts():
+            logger.info(f"📢 Resuming broadcast {job['id']} after user {job['cursor']}")
+            self._spawn(job)
+
+    async def stop(self):
+        """توقف کارهای در حال اجرا؛ cursor ذخیره‌شده برای ادامه باقی می‌ماند"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, job: Dict):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job['id'], None))
+
+    async def _run(self, job: Dict):
+        started = time.monotonic()
+        base = job['sent'] + job['failed']
+        queue: asyncio.Queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(job, queue)) for _ in range(self.concurrency)]
+        progress = asyncio.create_task(self._report_every(job, started, base))
+        try:
+            last_user_id = job['cursor']
+            queued = 0
+            users = self.db.iter_users(self.page_size, after_user_id=job['cursor'])
+            async with contextlib.aclosing(users):
+                async for user in users:
+                    queue.put_nowait(user.user_id)
+                    last_user_id = user.user_id
+                    queued += 1
+                    if queued % self.page_size == 0:
+                        await self._checkpoint(job, queue, last_user_id)
+            await queue.join()
+            job['cursor'] = last_user_id
+            await self.db.update_broadcast_job(job['id'], job['cursor'], job['sent'], job['failed'], 'done')
+            elapsed = time.monotonic() - started
+            logger.info(f"📢 Broadcast {job['id']} done: {job['sent']} sent, {job['failed']} failed ({elapsed:.0f}s)")
+            # ویرایش دوره‌ای نباید بعد از پیام پایان برسد
+            progress.cancel()
+            await asyncio.gather(progress, return_exceptions=True)
+            await self._report(job, started, base, done=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {job['id']} error: {e}")
+        finally:
+            progress.cancel()
+            for worker in workers:
+                worker.cancel()
+
+    async def _checkpoint(self, job: Dict, queue: asyncio.Queue, last_user_id: int):
+        """صبر تا ارسال صف و ذخیره cursor؛ صفحه بعد در این فاصله از پیش خوانده می‌شود"""
+        await queue.join()
+        job['cursor'] = last_user_id
+        await self.db.update_broadcast_job(job['id'], job['cursor'], job['sent'], job['failed'])
+
+    async def _report_every(self, job: Dict, started: float, base: int):
+        """ویرایش پیام پیشرفت هر progress_interval ثانیه، مستقل از طول صفحه‌ها"""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._report(job, started, base)
+
+    async def _worker(self, job: Dict, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                if await self._deliver(chat_id, job['text']):
+                    job['sent'] += 1
+                else:
+                    job['failed'] += 1
+            except Exception as e:
+                logger.error(f"Broadcast to {chat_id} error: {e}")
+                job['failed'] += 1
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, chat_id: int, text: str) -> bool:
+        """ارسال به یک گیرنده؛ RetryAfter همیشه رعایت می‌شود و خطای شبکه با backoff تکرار می‌شود"""
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Broadcast flood control: retry after {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    logger.warning(f"Broadcast to {chat_id} failed: {e}")
+                    return False
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramAPIError:
+                # ربات بلاک شده، چت حذف شده و ...
+                return False
+
+    async def _report(self, job: Dict, started: float, base: int, done: bool = False):
+        """ویرایش پیام پیشرفت ادمین"""
+        if not job['progress_message_id']:
+            return
+        await self.bucket.acquire()
+        try:
+            await self.bot.edit_message_text(
+                self.render(job, started, base, done),
+                chat_id=job['admin_chat_id'],
+                message_id=job['progress_message_id']
+            )
+        except TelegramAPIError as e:
+            logger.warning(f"Broadcast progress update failed: {e}")
+
+    @staticmethod
+    def render(job: Dict, started: float, base: int = 0, done: bool = False) -> str:
+        processed = job['sent'] + job['failed']
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = (processed - base) / elapsed
+        remaining = max(job['total'] - processed, 0)
+        eta = f"{remaining / rate / 60:.1f} دقیقه" if rate > 0 else "-"
+        title = "✅ <b>ارسال پیام همگانی تمام شد</b>" if done else "📤 <b>در حال ارسال پیام همگانی...</b>"
+        return f"""
+{title}
+━━━━━━━━━━━━━━
+🆔 کار: #{job['id']}
+📤 ارسال شده: {job['sent']} کاربر
+❌ ناموفق: {job['failed']} کاربر
+📊 پیشرفت: {processed}/{job['total']}
+⚡ سرعت: {rate:.1f} پیام در ثانیه
+⏳ زمان باقی‌مانده: {eta if not done else '-'}
+        """
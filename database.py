@@ -9,6 +9,8 @@ import shutil
 from datetime import datetime
 from typing import Optional, List, Tuple
 
+from models import Player, player_factory
+
 logger = logging.getLogger(__name__)
 
 class Database:
@@ -70,10 +72,11 @@ class Database:
         """دریافت اتصال به دیتابیس"""
         return sqlite3.connect(self.db_path)
     
-    def get_user(self, user_id: int) -> Optional[Tuple]:
+    def get_user(self, user_id: int) -> Optional[Player]:
         """دریافت اطلاعات کاربر"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        cursor.row_factory = player_factory
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         user = cursor.fetchone()
         conn.close()
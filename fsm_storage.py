@@ -0,0 +1,167 @@
+"""
+ذخیره‌ساز FSM روی SQLite - جایگزین ماندگار MemoryStorage که بین چند پروسه ربات مشترک است
+
+state و data هر کلید در یک سطر جدول fsm_states نگه داشته می‌شوند. خواندن‌ها از یک
+کش LRU درون پروسه انجام می‌شوند و نوشتن‌ها هم‌زمان در کش و دیتابیس اعمال می‌شوند.
+اعتبار کش با PRAGMA data_version سنجیده می‌شود: این مقدار فقط وقتی تغییر می‌کند که
+اتصال دیگری (پروسه دیگر) چیزی commit کرده باشد و در آن صورت کل کش دور ریخته می‌شود.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# (state, data, expires_at)
+Record = Tuple[Optional[str], Dict[str, Any], int]
+
+
+class SQLiteStorage(BaseStorage):
+    """ذخیره‌ساز FSM با کش write-through و انقضای TTL
+
+    هر بار نوشتن، انقضای کلید را ttl ثانیه جلو می‌برد؛ کلیدهای منقضی در خواندن خالی
+    دیده می‌شوند و حداکثر هر purge_interval ثانیه یک بار از جدول حذف می‌شوند.
+    """
+
+    def __init__(self, db_path: str = 'app/data/fsm.db', ttl: int = 86400,
+                 cache_size: int = 10000, purge_interval: int = 600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: 'OrderedDict[str, Record]' = OrderedDict()
+        self._lock = threading.Lock()
+        # همه کارهای کند دیتابیس روی یک thread جدا تا event loop بلاک نشود
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm')
+        self._purged_at = 0.0
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        logger.info(f"💾 FSM storage ready: {db_path} (ttl={ttl}s)")
+
+    # === خواندن ===
+    def _validate_cache(self):
+        """دور ریختن کش اگر پروسه دیگری از آخرین بررسی چیزی نوشته باشد"""
+        version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._cache.clear()
+
+    def _cached(self, key: str) -> Optional[Record]:
+        with self._lock:
+            self._validate_cache()
+            record = self._cache.get(key)
+            if record is not None:
+                self._cache.move_to_end(key)
+            return record
+
+    def _load(self, key: str) -> Record:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT state, data, expires_at FROM fsm_states WHERE key = ?', (key,)
+            ).fetchone()
+            record = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0)
+            self._remember(key, record)
+            return record
+
+    def _remember(self, key: str, record: Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _get(self, key: StorageKey) -> Record:
+        storage_key = self.key_builder.build(key)
+        record = self._cached(storage_key)
+        if record is None:
+            loop = asyncio.get_running_loop()
+            record = await loop.run_in_executor(self._executor, self._load, storage_key)
+        if record[2] and record[2] < time.time():
+            return None, {}, 0
+        return record
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[0]
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._get(key))[1])
+
+    # === نوشتن ===
+    def _write(self, key: str, field: str, value):
+        """نوشتن state یا data؛ سطرِ خالی (بدون state و data) حذف می‌شود"""
+        now = time.time()
+        with self._lock:
+            self._validate_cache()
+            current = self._cache.get(key)
+            if current is None or (current[2] and current[2] < now):
+                row = self._conn.execute(
+                    'SELECT state, data, expires_at FROM fsm_states WHERE key = ? AND expires_at >= ?',
+                    (key, int(now))
+                ).fetchone()
+                current = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0)
+
+            state, data = current[0], current[1]
+            if field == 'state':
+                state = value
+            else:
+                data = value
+
+            if state is None and not data:
+                self._conn.execute('DELETE FROM fsm_states WHERE key = ?', (key,))
+                record = (None, {}, 0)
+            else:
+                expires_at = int(now) + self.ttl
+                self._conn.execute('''
+                INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, expires_at = excluded.expires_at
+                ''', (key, state, json.dumps(data, ensure_ascii=False), expires_at))
+                record = (state, data, expires_at)
+            # نوشتن خود این اتصال data_version را تغییر نمی‌دهد، پس کش معتبر می‌ماند
+            self._remember(key, record)
+
+            if now - self._purged_at >= self.purge_interval:
+                self._purged_at = now
+                purged = self._conn.execute(
+                    'DELETE FROM fsm_states WHERE expires_at < ?', (int(now),)
+                ).rowcount
+                if purged:
+                    logger.info(f"🧹 Purged {purged} expired FSM states")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, self.key_builder.build(key), 'state', value)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, self.key_builder.build(key), 'data', dict(data))
+
+    async def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
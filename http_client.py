@@ -0,0 +1,150 @@
+"""
+لایه HTTP مشترک پروسه - یک ClientSession با connector تنظیم‌شده برای Bot API و کارهای جانبی
+
+همه درخواست‌ها (تلگرام، Keep-Alive و ...) از یک استخر اتصال استفاده می‌کنند تا در
+ارسال‌های انبوه اتصال‌های TLS باز دوباره استفاده شوند. TraceConfig آمار استفاده
+مجدد از اتصال، اتصال‌های جدید و زمان انتظار برای استخر را جمع می‌کند.
+"""
+
+import asyncio
+import ssl
+import time
+from typing import Dict, Optional
+
+import certifi
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+
+
+class HttpMetrics:
+    """شمارنده‌های TraceConfig"""
+
+    __slots__ = (
+        'requests', 'errors', 'new_connections', 'reused_connections', 'connect_time',
+        'queued', 'queue_wait', 'queue_wait_max', 'dns_hits', 'dns_misses'
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def snapshot(self) -> Dict[str, float]:
+        acquired = self.new_connections + self.reused_connections
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_rate': self.reused_connections / acquired if acquired else 0.0,
+            'connect_ms_avg': self.connect_time * 1000 / self.new_connections if self.new_connections else 0.0,
+            'queued': self.queued,
+            'queue_wait_ms_avg': self.queue_wait * 1000 / self.queued if self.queued else 0.0,
+            'queue_wait_ms_max': self.queue_wait_max * 1000,
+            'dns_hits': self.dns_hits,
+            'dns_misses': self.dns_misses
+        }
+
+
+class HttpClient:
+    """مالک ClientSession مشترک؛ سشن در اولین استفاده داخل event loop ساخته می‌شود"""
+
+    def __init__(self, pool_size: int = 100, pool_per_host: int = 0, keepalive_timeout: float = 60,
+                 dns_ttl: int = 600, connect_timeout: float = 10, timeout: float = 60):
+        self.pool_size = pool_size
+        self.pool_per_host = pool_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.metrics = HttpMetrics()
+        self._session: Optional[ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    async def session(self) -> ClientSession:
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                connector = TCPConnector(
+                    ssl=ssl.create_default_context(cafile=certifi.where()),
+                    limit=self.pool_size,
+                    limit_per_host=self.pool_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.dns_ttl
+                )
+                self._session = ClientSession(
+                    connector=connector,
+                    timeout=ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout),
+                    headers={'User-Agent': f'aiogram/{aiogram_version}'},
+                    trace_configs=[self._trace_config()]
+                )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # فرصت بستن اتصال‌های SSL
+            await asyncio.sleep(0.25)
+
+    def _trace_config(self) -> TraceConfig:
+        metrics = self.metrics
+        trace = TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            metrics.requests += 1
+
+        async def on_request_exception(session, ctx, params):
+            metrics.errors += 1
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+
+        async def on_queued_end(session, ctx, params):
+            waited = time.perf_counter() - ctx.queued_at
+            metrics.queued += 1
+            metrics.queue_wait += waited
+            metrics.queue_wait_max = max(metrics.queue_wait_max, waited)
+
+        async def on_create_start(session, ctx, params):
+            ctx.connect_at = time.perf_counter()
+
+        async def on_create_end(session, ctx, params):
+            metrics.new_connections += 1
+            metrics.connect_time += time.perf_counter() - ctx.connect_at
+
+        async def on_reuse(session, ctx, params):
+            metrics.reused_connections += 1
+
+        async def on_dns_hit(session, ctx, params):
+            metrics.dns_hits += 1
+
+        async def on_dns_miss(session, ctx, params):
+            metrics.dns_misses += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_start.append(on_create_start)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_dns_cache_hit.append(on_dns_hit)
+        trace.on_dns_cache_miss.append(on_dns_miss)
+        return trace
+
+
+class SharedSession(AiohttpSession):
+    """سشن aiogram روی ClientSession مشترک؛ بستن آن بر عهده HttpClient است"""
+
+    def __init__(self, client: HttpClient, **kwargs):
+        kwargs.setdefault('timeout', client.timeout)
+        super().__init__(**kwargs)
+        self.client = client
+
+    async def create_session(self) -> ClientSession:
+        return await self.client.session()
+
+    async def close(self):
+        # dp.start_polling در پایان سشن ربات را می‌بندد؛ سشن مشترک را HttpClient می‌بندد
+        pass
@@ -0,0 +1,184 @@
+"""
+چیدمان ذخیره‌سازی موجودی موشک‌ها - یک سطر برای هر موشک یا یک سطر فشرده برای هر کاربر
+
+هر دو کلاس رابط یکسانی دارند و با cursor تراکنش جاری کار می‌کنند؛ Database فقط یکی از
+آن‌ها را بر اساس DB_INVENTORY_LAYOUT استفاده می‌کند.
+"""
+
+from array import array
+from typing import Iterable, Tuple
+
+from models import Inventory
+
+
+class RowInventoryStore:
+    """جدول user_missiles: یک سطر (user_id, missile_id, quantity) برای هر موشک"""
+
+    name = 'rows'
+
+    @staticmethod
+    def create_schema(cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_missiles (
+            user_id INTEGER,
+            missile_id INTEGER,
+            quantity INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, missile_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (missile_id) REFERENCES missiles(id)
+        ) WITHOUT ROWID
+        ''')
+
+    def load(self, conn, user_id: int) -> Inventory:
+        rows = conn.execute('''
+        SELECT missile_id, quantity FROM user_missiles
+        WHERE user_id = ? AND quantity > 0
+        ''', (user_id,)).fetchall()
+        return Inventory.from_rows(user_id, rows)
+
+    def add(self, cursor, user_id: int, missile_id: int, quantity: int = 1):
+        cursor.execute('''
+        INSERT INTO user_missiles (user_id, missile_id, quantity)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, missile_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity
+        ''', (user_id, missile_id, quantity))
+
+    def seed(self, cursor, user_id: int, items: Iterable[Tuple[int, int]]):
+        """موجودی اولیه کاربر جدید؛ اگر از قبل وجود داشته باشد دست نمی‌خورد"""
+        cursor.executemany('''
+        INSERT OR IGNORE INTO user_missiles (user_id, missile_id, quantity)
+        VALUES (?, ?, ?)
+        ''', [(user_id, missile_id, quantity) for missile_id, quantity in items])
+
+    def take(self, cursor, user_id: int, missile_id: int, quantity: int = 1) -> bool:
+        """کسر شرطی؛ False یعنی موجودی کافی نبود"""
+        cursor.execute('''
+        UPDATE user_missiles
+        SET quantity = quantity - ?
+        WHERE user_id = ? AND missile_id = ? AND quantity >= ?
+        ''', (quantity, user_id, missile_id, quantity))
+        return cursor.rowcount > 0
+
+    def grant(self, cursor, missile_id: int, quantity: int, where: str, params: tuple) -> int:
+        """افزودن یک موشک به همه کاربران منطبق با شرط WHERE روی users"""
+        cursor.execute(f'''
+        INSERT INTO user_missiles (user_id, missile_id, quantity)
+        SELECT user_id, ?, ? FROM users WHERE {where}
+        ON CONFLICT(user_id, missile_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity
+        ''', (missile_id, quantity, *params))
+        return cursor.rowcount
+
+    def adopt(self, cursor) -> int:
+        """انتقال موجودی‌های جدول فشرده به این چیدمان"""
+        if not cursor.execute('SELECT 1 FROM user_inventory LIMIT 1').fetchone():
+            return 0
+        users = cursor.execute('SELECT COUNT(*) FROM user_inventory').fetchone()[0]
+        for missile_id in Inventory.ids:
+            column = PackedInventoryStore.column(missile_id)
+            cursor.execute(f'''
+            INSERT INTO user_missiles (user_id, missile_id, quantity)
+            SELECT user_id, ?, {column} FROM user_inventory WHERE {column} > 0
+            ON CONFLICT(user_id, missile_id)
+            DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', (missile_id,))
+        cursor.execute('DELETE FROM user_inventory')
+        return users
+
+
+class PackedInventoryStore:
+    """جدول user_inventory: یک سطر با طول ثابت برای هر کاربر و یک ستون برای هر موشک
+
+    خواندن یک lookup روی کلید اصلی است و ستون‌ها به ترتیب کاتالوگ مستقیماً به آرایه
+    Inventory تبدیل می‌شوند؛ کسر و افزایش هر کدام یک UPDATE روی همان یک سطر است.
+    """
+
+    name = 'packed'
+
+    @staticmethod
+    def column(missile_id: int) -> str:
+        return f'm_{int(missile_id)}'
+
+    @staticmethod
+    def create_schema(cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_inventory (
+            user_id INTEGER PRIMARY KEY,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+        ''')
+        # موشک‌های جدید کاتالوگ ستون خودشان را می‌گیرند
+        existing = {row[1] for row in cursor.execute('PRAGMA table_info(user_inventory)')}
+        for missile_id in Inventory.ids:
+            column = PackedInventoryStore.column(missile_id)
+            if column not in existing:
+                cursor.execute(f'ALTER TABLE user_inventory ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+
+    def load(self, conn, user_id: int) -> Inventory:
+        columns = ', '.join(self.column(missile_id) for missile_id in Inventory.ids)
+        row = conn.execute(
+            f'SELECT {columns} FROM user_inventory WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return Inventory(user_id)
+        return Inventory(user_id, array('i', row))
+
+    def add(self, cursor, user_id: int, missile_id: int, quantity: int = 1):
+        column = self.column(missile_id)
+        cursor.execute(f'''
+        INSERT INTO user_inventory (user_id, {column}) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET {column} = {column} + excluded.{column}
+        ''', (user_id, quantity))
+
+    def seed(self, cursor, user_id: int, items: Iterable[Tuple[int, int]]):
+        items = list(items)
+        columns = ''.join(f', {self.column(missile_id)}' for missile_id, _ in items)
+        placeholders = ', ?' * len(items)
+        cursor.execute(
+            f'INSERT OR IGNORE INTO user_inventory (user_id{columns}) VALUES (?{placeholders})',
+            (user_id, *(quantity for _, quantity in items))
+        )
+
+    def take(self, cursor, user_id: int, missile_id: int, quantity: int = 1) -> bool:
+        column = self.column(missile_id)
+        cursor.execute(f'''
+        UPDATE user_inventory SET {column} = {column} - ?
+        WHERE user_id = ? AND {column} >= ?
+        ''', (quantity, user_id, quantity))
+        return cursor.rowcount > 0
+
+    def grant(self, cursor, missile_id: int, quantity: int, where: str, params: tuple) -> int:
+        column = self.column(missile_id)
+        cursor.execute(f'''
+        INSERT INTO user_inventory (user_id, {column})
+        SELECT user_id, ? FROM users WHERE {where}
+        ON CONFLICT(user_id) DO UPDATE SET {column} = {column} + excluded.{column}
+        ''', (quantity, *params))
+        return cursor.rowcount
+
+    def adopt(self, cursor) -> int:
+        """انتقال سطرهای user_missiles به سطر فشرده هر کاربر"""
+        if not cursor.execute('SELECT 1 FROM user_missiles LIMIT 1').fetchone():
+            return 0
+        columns = [self.column(missile_id) for missile_id in Inventory.ids]
+        sums = ', '.join(
+            f'SUM(CASE WHEN missile_id = {int(missile_id)} THEN quantity ELSE 0 END)'
+            for missile_id in Inventory.ids
+        )
+        updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in columns)
+        cursor.execute(f'''
+        INSERT INTO user_inventory (user_id, {', '.join(columns)})
+        SELECT user_id, {sums} FROM user_missiles WHERE 1
+        GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET {updates}
+        ''')
+        users = cursor.rowcount
+        cursor.execute('DELETE FROM user_missiles')
+        return users
+
+
+INVENTORY_STORES = {
+    RowInventoryStore.name: RowInventoryStore,
+    PackedInventoryStore.name: PackedInventoryStore
+}
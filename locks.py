@@ -0,0 +1,63 @@
+"""
+قفل‌های هر کاربر - اجرای سریالی تغییرات اقتصادی یک کاربر و اجرای موازی کاربران مختلف
+
+هندلرهای خرید، باکس، ماینر و ارتقا موجودی را می‌خوانند، در پایتون بررسی می‌کنند و بعد
+می‌نویسند؛ دو کلیک سریع روی یک دکمه بدون قفل هر دو از همان موجودی قدیمی رد می‌شوند.
+برای هر کاربر فقط تا وقتی کسی قفل را نگه داشته یا منتظر آن است یک ورودی وجود دارد و
+آخرین نفری که بیرون می‌رود آن را حذف می‌کند، پس حافظه با تعداد کاربران هم‌زمان رشد
+می‌کند نه با کل کاربران.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable
+
+
+class _Entry:
+    __slots__ = ('lock', 'holders')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # صاحب فعلی قفل + منتظرها
+        self.holders = 0
+
+
+class UserLocks:
+    """مدیریت قفل asyncio به ازای هر کلید (معمولاً user_id)"""
+
+    def __init__(self):
+        self._entries: Dict[Hashable, _Entry] = {}
+        self.acquired = 0
+        self.contended = 0
+        self.peak = 0
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+            self.peak = max(self.peak, len(self._entries))
+        elif entry.holders:
+            self.contended += 1
+
+        entry.holders += 1
+        try:
+            async with entry.lock:
+                self.acquired += 1
+                yield
+        finally:
+            entry.holders -= 1
+            # لغو شدن در حال انتظار هم از همین مسیر رد می‌شود و ورودی یتیم نمی‌ماند
+            if not entry.holders and self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'active': len(self._entries),
+            'peak': self.peak,
+            'acquired': self.acquired,
+            'contended': self.contended
+        }
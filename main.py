@@ -5,15 +5,27 @@ Warzone Telegram Bot - Version 3.0.0
 """
 
 import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import queue
+import secrets
+import signal
 import sqlite3
 import random
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Set, Tuple, AsyncIterator, Generator
 import os
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, types, F
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup,
     InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
@@ -23,7 +35,20 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
-import aiohttp
+from aiogram.exceptions import TelegramBadRequest
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from models import Player, Inventory, player_factory
+from broadcast import BroadcastEngine
+from inventory_store import INVENTORY_STORES, PackedInventoryStore, RowInventoryStore
+from screens import RegistrySession, ScreenRegistry
+from http_client import HttpClient
+from fsm_storage import SQLiteStorage
+from locks import UserLocks
+from middlewares import ThrottlingMiddleware
+from routing import PrefilterDispatcher, RoutingTable, UpdatePrefilter
+from outbox import OutboxDispatcher
 
 # === تنظیمات لاگ ===
 logging.basicConfig(
@@ -40,14 +65,118 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
 PORT = int(os.getenv('PORT', 8080))
 KEEP_ALIVE_URL = os.getenv('KEEP_ALIVE_URL', '')
+# با تنظیم WEBHOOK_URL (آدرس عمومی https) ربات به جای polling با webhook روی PORT اجرا می‌شود
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# اگر تنظیم نشود در هر اجرا یک مقدار تصادفی ساخته و همراه setWebhook ثبت می‌شود
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE_MB = int(os.getenv('DB_MMAP_SIZE_MB', 128))
+DB_READ_WORKERS = int(os.getenv('DB_READ_WORKERS', 4))
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL').upper()
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0') == '1'
+# بیش از ۱: کاربران بر اساس user_id بین چند فایل SQLite (هر کدام با نویسنده خودش) تقسیم می‌شوند
+DB_SHARDS = max(1, int(os.getenv('DB_SHARDS', 1)))
+# rows: جدول user_missiles (یک سطر برای هر موشک) / packed: یک سطر فشرده برای هر کاربر
+DB_INVENTORY_LAYOUT = os.getenv('DB_INVENTORY_LAYOUT', 'rows')
+DB_FLUSH_INTERVAL_MS = int(os.getenv('DB_FLUSH_INTERVAL_MS', 20))
+DB_FLUSH_MAX_OPS = int(os.getenv('DB_FLUSH_MAX_OPS', 500))
+PLAYER_CACHE_SIZE = int(os.getenv('PLAYER_CACHE_SIZE', 10000))
+# استخر اتصال HTTP مشترک (Bot API و درخواست‌های جانبی)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 0))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv('HTTP_KEEPALIVE_SECONDS', 60))
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', 600))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 60))
+# تعداد کیبوردهای انتخاب موشک (هر شکل موجودی یکی) که در حافظه می‌مانند
+KEYBOARD_CACHE_SIZE = int(os.getenv('KEYBOARD_CACHE_SIZE', 2048))
+# سطل توکن هر کاربر: RATE آپدیت در ثانیه با ظرفیت BURST؛ اقتصاد و حمله سطل جداگانه هم دارند
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', 3))
+THROTTLE_USER_BURST = float(os.getenv('THROTTLE_USER_BURST', 12))
+THROTTLE_ECONOMY_RATE = float(os.getenv('THROTTLE_ECONOMY_RATE', 1))
+THROTTLE_ECONOMY_BURST = float(os.getenv('THROTTLE_ECONOMY_BURST', 5))
+THROTTLE_ATTACK_RATE = float(os.getenv('THROTTLE_ATTACK_RATE', 0.5))
+THROTTLE_ATTACK_BURST = float(os.getenv('THROTTLE_ATTACK_BURST', 3))
+USER_PAGE_SIZE = int(os.getenv('USER_PAGE_SIZE', 500))
+ADMIN_STATS_REFRESH_SECONDS = int(os.getenv('ADMIN_STATS_REFRESH_SECONDS', 60))
+# sqlite: state های FSM در فایل جدا و مشترک بین پروسه‌ها / memory: فقط در حافظه همین پروسه
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_DB_PATH = os.getenv('FSM_DB_PATH', 'app/data/fsm.db')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 86400))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 15))
+LEADERBOARD_BUFFER = int(os.getenv('LEADERBOARD_BUFFER', 30))
+# محدودیت سراسری تلگرام حدود ۳۰ پیام در ثانیه است
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 8))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 200))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv('BROADCAST_PROGRESS_SECONDS', 5))
+# اعلان‌های حمله و انتقام از جدول outbox و با همان محدودیت نرخ پیام همگانی ارسال می‌شوند
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 1))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+# انتقام فقط تا ۲۴ ساعت ممکن است، پس دوره نگهداری حملات کمتر از آن نمی‌شود
+ATTACK_RETENTION_HOURS = max(24, int(os.getenv('ATTACK_RETENTION_HOURS', 72)))
+ATTACK_ARCHIVE_PATH = os.getenv('ATTACK_ARCHIVE_PATH', 'app/data/warzone_archive.db')
+ATTACK_PRUNE_BATCH = int(os.getenv('ATTACK_PRUNE_BATCH', 1000))
+ATTACK_PRUNE_INTERVAL_MIN = int(os.getenv('ATTACK_PRUNE_INTERVAL_MIN', 60))
 
 if not BOT_TOKEN:
     raise ValueError("لطفا BOT_TOKEN را در .env تنظیم کنید")
 
 # === راه‌اندازی ربات ===
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+http = HttpClient(
+    pool_size=HTTP_POOL_SIZE,
+    pool_per_host=HTTP_POOL_PER_HOST,
+    keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+    dns_ttl=HTTP_DNS_TTL,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    timeout=HTTP_TIMEOUT
+)
+screens = ScreenRegistry(KEYBOARD_CACHE_SIZE)
+# خرید، باکس، ماینر و ارتقای یک کاربر پشت سر هم اجرا می‌شوند تا دو کلیک سریع دوبار خرج نکنند
+user_locks = UserLocks()
+bot = Bot(
+    token=BOT_TOKEN,
+    session=RegistrySession(screens, http),
+    default=DefaultBotProperties(parse_mode='HTML')
+)
+if FSM_STORAGE == 'memory':
+    storage = MemoryStorage()
+else:
+    storage = SQLiteStorage(FSM_DB_PATH, ttl=FSM_STATE_TTL, cache_size=FSM_CACHE_SIZE)
+dp = PrefilterDispatcher(storage=storage)
+# همه callback ها و دکمه‌های متنی منوها از این جدول رد می‌شوند؛ attach قبل از ثبت هندلرهای دیگر
+routes = RoutingTable()
+routes.attach(dp)
+# دکمه انتقام در پیام‌های حمله‌ای که قبل از قالب فشرده ارسال شده‌اند
+routes.legacy('revenge_', 'rv')
+ATTACK_TEXT_PREFIX = "حمله با"
+# پیام‌های گروه که دستور، دکمه منو یا «حمله با» نیستند قبل از middleware ها دور ریخته می‌شوند
+dp.prefilter = UpdatePrefilter(routes, prefixes=('/', ATTACK_TEXT_PREFIX))
+
+# === کنترل سیل درخواست ===
+def throttle_class(update: types.Update) -> Optional[str]:
+    """دسته سطل توکن یک آپدیت؛ None یعنی فقط سطل کلی کاربر"""
+    if update.callback_query is not None:
+        return routes.group(update.callback_query.data)
+    elif update.message is not None and update.message.text:
+        if update.message.text.startswith(ATTACK_TEXT_PREFIX):
+            return 'attack'
+    return None
+
+throttling = ThrottlingMiddleware(
+    user_limit=(THROTTLE_USER_RATE, THROTTLE_USER_BURST),
+    class_limits={
+        'economy': (THROTTLE_ECONOMY_RATE, THROTTLE_ECONOMY_BURST),
+        'attack': (THROTTLE_ATTACK_RATE, THROTTLE_ATTACK_BURST)
+    },
+    classify=throttle_class,
+    exempt=ADMIN_IDS
+)
+dp.update.outer_middleware(throttling)
 
 # === States برای FSM ===
 class UserStates(StatesGroup):
@@ -58,183 +187,892 @@ class UserStates(StatesGroup):
     admin_panel = State()
     waiting_for_revenge = State()
 
-# === کلاس دیتابیس ===
-class Database:
-    def __init__(self, db_path='app/data/warzone.db'):
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+# === لایه اتصال دیتابیس ===
+class ConnectionManager:
+    """اتصال‌های ماندگار و تنظیم‌شده SQLite - برای هر thread یک اتصال"""
+
+    def __init__(self, db_path: str, cache_size_kb: int = DB_CACHE_SIZE_KB,
+                 mmap_size_mb: int = DB_MMAP_SIZE_MB, cached_statements: int = 256,
+                 synchronous: str = DB_SYNCHRONOUS):
         self.db_path = db_path
-        self.init_db()
-    
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+        # WAL روی فایل دیتابیس ماندگار است و فقط یک بار تنظیم می‌شود
+        conn = self.get()
+        mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        logger.info(f"💾 SQLite ready: {db_path} (journal_mode={mode})")
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.cached_statements
+        )
         conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA cache_size=-{self.cache_size_kb}')
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size_mb * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        """اتصال thread جاری (در اولین استفاده ساخته می‌شود)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
         return conn
+
+    def close_all(self):
+        """بستن همه اتصال‌ها هنگام خاموش شدن"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+# === بافر نوشتن با تأخیر (write-behind) ===
+class ResourceDeltaBuffer:
+    """تجمیع تغییرات منابع هر کاربر در حافظه تا commit گروهی بعدی
     
-    def init_db(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # جدول کاربران
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            zone_coin INTEGER DEFAULT 1000,
-            zone_gem INTEGER DEFAULT 0,
-            zone_point INTEGER DEFAULT 500,
-            level INTEGER DEFAULT 1,
-            xp INTEGER DEFAULT 0,
-            is_admin BOOLEAN DEFAULT 0,
-            miner_level INTEGER DEFAULT 1,
-            last_miner_claim INTEGER DEFAULT (strftime('%s', 'now')),
-            cyber_tower_level INTEGER DEFAULT 0,
-            defense_missile_level INTEGER DEFAULT 0,
-            defense_electronic_level INTEGER DEFAULT 0,
-            defense_antifighter_level INTEGER DEFAULT 0,
-            total_defense_bonus REAL DEFAULT 0.0,
-            fighter_level INTEGER DEFAULT 0,
-            last_revenge_time INTEGER DEFAULT 0,
-            created_at INTEGER DEFAULT (strftime('%s', 'now'))
-        )
-        ''')
-        
-        # جدول موشک‌ها
+    سه تغییر سکه برای یک کاربر به یک «+N» تبدیل می‌شوند. تغییراتی که در حال commit
+    هستند (inflight) تا پایان COMMIT نگه داشته می‌شوند تا خواندن‌ها چیزی را گم نکنند.
+    """
+
+    COLUMNS = ('zone_coin', 'zone_gem', 'zone_point', 'fighter_level')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._pending: Dict[int, Dict[str, int]] = {}
+        self._inflight: Dict[int, Dict[str, int]] = {}
+        self.ops = 0
+        self.first_op_at = 0.0
+
+    def add(self, user_id: int, column: str, amount: int):
+        with self.lock:
+            deltas = self._pending.setdefault(user_id, {})
+            deltas[column] = deltas.get(column, 0) + amount
+            if not self.ops:
+                self.first_op_at = time.monotonic()
+            self.ops += 1
+
+    def deltas_for(self, user_id: int) -> Dict[str, int]:
+        """مجموع تغییرات commit نشده یک کاربر"""
+        with self.lock:
+            merged = dict(self._inflight.get(user_id, {}))
+            for column, amount in self._pending.get(user_id, {}).items():
+                merged[column] = merged.get(column, 0) + amount
+            return merged
+
+    def apply(self, cursor):
+        """اعمال همه تغییرات در تراکنش جاری با یک executemany"""
+        with self.lock:
+            if not self._pending:
+                return ()
+            self._inflight, self._pending = self._pending, {}
+            self.ops = 0
+            rows = [
+                tuple(deltas.get(column, 0) for column in self.COLUMNS) + (user_id,)
+                for user_id, deltas in self._inflight.items()
+            ]
+        cursor.executemany('''
+        UPDATE users 
+        SET zone_coin = zone_coin + ?, zone_gem = zone_gem + ?, 
+            zone_point = zone_point + ?, fighter_level = fighter_level + ? 
+        WHERE user_id = ?
+        ''', rows)
+        return [row[-1] for row in rows]
+
+    def committed(self):
+        with self.lock:
+            self._inflight = {}
+
+    def restore(self):
+        """برگرداندن تغییرات inflight به صف پس از rollback"""
+        with self.lock:
+            for user_id, deltas in self._inflight.items():
+                for column, amount in deltas.items():
+                    self.add(user_id, column, amount)
+            self._inflight = {}
+
+# === کش کاربران ===
+class PlayerCache:
+    """کش LRU محدود برای رکورد کاربران و موشک‌هایشان
+    
+    مقدارهای برگشتی مشترک هستند و نباید تغییر داده شوند. شمارنده generation جلوی
+    ذخیره شدن نتیجه خواندنی را می‌گیرد که پیش از یک invalidate شروع شده است.
+    """
+
+    def __init__(self, capacity: int = PLAYER_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation: int):
+        with self._lock:
+            if value is None or generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self._entries.pop(('user', user_id), None)
+                self._entries.pop(('missiles', user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+class Leaderboard:
+    """top-K یک بُعد رنکینگ که پس از هر commit به‌روز می‌شود
+
+    علاوه بر size نفر نمایشی یک بافر اضافه هم نگه داشته می‌شود. همه کاربرانی که در
+    ساختار نیستند کلیدی کمتر از floor دارند (floor برابر None یعنی همه کاربران عضو
+    هستند). اگر با کم شدن مقدار اعضا تعداد از size کمتر شود، stale می‌شود و باید
+    دوباره از دیتابیس ساخته شود.
+    """
+
+    # ستون‌هایی که برای هر عضو نگه داشته و نمایش داده می‌شوند
+    FIELDS = ('user_id', 'username', 'full_name', 'zone_coin', 'zone_gem',
+              'zone_point', 'level', 'total_damage')
+
+    def __init__(self, column: str, size: int = LEADERBOARD_SIZE, buffer: int = LEADERBOARD_BUFFER):
+        self.column = column
+        self.size = size
+        self.capacity = size + buffer
+        self.entries: Dict[int, Player] = {}
+        self.floor = None
+        self.stale = True
+        self.lock = threading.Lock()
+        self._top: Tuple[Player, ...] = ()
+        self._top_snapshot = ()
+        self.version = 0
+        self._text = None
+        self._text_version = -1
+
+    def key(self, player: Player):
+        # در مقدار برابر، user_id کوچک‌تر بالاتر است (همان ترتیب کوئری seed)
+        return getattr(player, self.column), -player.user_id
+
+    def seed(self, players: List[Player]):
+        """ساخت دوباره از نتیجه کوئری مرتب‌شده با حداکثر capacity سطر"""
+        with self.lock:
+            self.entries = {player.user_id: player for player in players}
+            self.floor = self.key(players[-1]) if len(players) >= self.capacity else None
+            self.stale = False
+            self._changed()
+
+    def update(self, player: Player):
+        """اعمال مقدار جدید یک کاربر"""
+        with self.lock:
+            key = self.key(player)
+            if player.user_id in self.entries:
+                if self.floor is not None and key < self.floor:
+                    # ممکن است کسی بیرون از ساختار حالا از او جلوتر باشد
+                    del self.entries[player.user_id]
+                    if len(self.entries) < self.size:
+                        self.stale = True
+                else:
+                    self.entries[player.user_id] = player
+            elif self.floor is None or key > self.floor:
+                self.entries[player.user_id] = player
+                if len(self.entries) > self.capacity:
+                    lowest = min(self.entries.values(), key=self.key)
+                    del self.entries[lowest.user_id]
+                    self.floor = self.key(lowest)
+            else:
+                return
+            self._changed()
+
+    def _changed(self):
+        top = tuple(sorted(self.entries.values(), key=self.key, reverse=True)[:self.size])
+        snapshot = tuple(tuple(getattr(player, name) for name in self.FIELDS) for player in top)
+        if snapshot != self._top_snapshot:
+            self._top = top
+            self._top_snapshot = snapshot
+            self.version += 1
+
+    def top(self) -> Tuple[Player, ...]:
+        with self.lock:
+            return self._top
+
+    def render(self, renderer) -> str:
+        """متن رنکینگ؛ فقط وقتی top-K تغییر کرده باشد دوباره ساخته می‌شود"""
+        with self.lock:
+            if self._text_version != self.version:
+                self._text = renderer(self._top)
+                self._text_version = self.version
+            return self._text
+
+class UserSegment:
+    """گروهی از کاربران برای عملیات دسته‌ای؛ فیلدهای None محدودیتی ندارند
+
+    فعال یعنی در active_days روز گذشته ماینر برداشت کرده یا حمله‌ای انجام داده است
+    (حملات قدیمی‌تر از دوره نگهداری دیگر شمرده نمی‌شوند).
+    """
+
+    __slots__ = ('min_level', 'max_level', 'active_days', 'has_fighter')
+
+    def __init__(self, min_level: Optional[int] = None, max_level: Optional[int] = None,
+                 active_days: Optional[int] = None, has_fighter: Optional[bool] = None):
+        self.min_level = min_level
+        self.max_level = max_level
+        self.active_days = active_days
+        self.has_fighter = has_fighter
+
+    def where(self) -> Tuple[str, tuple]:
+        """شرط WHERE روی جدول users به همراه پارامترها"""
+        clauses, params = [], []
+        if self.min_level is not None:
+            clauses.append('level >= ?')
+            params.append(self.min_level)
+        if self.max_level is not None:
+            clauses.append('level <= ?')
+            params.append(self.max_level)
+        if self.active_days is not None:
+            since = int(time.time()) - self.active_days * 86400
+            clauses.append('''(last_miner_claim > ? OR EXISTS (
+                SELECT 1 FROM attacks WHERE attacks.attacker_id = users.user_id AND attacks.timestamp > ?))''')
+            params.extend((since, since))
+        if self.has_fighter is not None:
+            clauses.append('fighter_level > 0' if self.has_fighter else 'fighter_level = 0')
+        return ' AND '.join(clauses) or '1', tuple(params)
+
+    def describe(self) -> str:
+        parts = []
+        if self.min_level is not None or self.max_level is not None:
+            parts.append(f"لول {self.min_level or 1} تا {self.max_level if self.max_level is not None else '∞'}")
+        if self.active_days is not None:
+            parts.append(f"فعال در {self.active_days} روز اخیر")
+        if self.has_fighter is not None:
+            parts.append("دارای جنگنده" if self.has_fighter else "بدون جنگنده")
+        return '، '.join(parts) or "همه کاربران"
+
+class _SettlementAborted(Exception):
+    """لغو تراکنش تسویه حمله یا خرید به همراه دلیل"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+# === کارهای چندمرحله‌ای ===
+# هر مرحله (shard, func) است و فقط روی همان شارد می‌نویسد؛ فهرستی از مراحل یعنی
+# مراحل مستقل از هم که می‌توانند هم‌زمان اجرا شوند. نتیجه هر مرحله به generator برمی‌گردد.
+Steps = Generator
+
+def run_steps(steps: Steps):
+    """اجرای مراحل به ترتیب در thread جاری؛ برای راه‌اندازی، پیش از ساخته شدن thread های نویسنده"""
+    try:
+        step = next(steps)
+        while True:
+            if isinstance(step, list):
+                result = [func() for _, func in step]
+            else:
+                result = step[1]()
+            step = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+# === کاتالوگ موشک‌ها ===
+# id شناسه ثابت موشک در دیتابیس و callback هاست و هرگز نباید تغییر کند؛
+# ترتیب این dict ترتیب نمایش (rank) است
+MISSILE_DATA = {
+    # موشک‌های معمولی
+    'شبح': {'id': 1, 'damage': 25, 'price': 20, 'min_level': 1, 'type': 'normal'},
+    'رعد': {'id': 2, 'damage': 35, 'price': 50, 'min_level': 2, 'type': 'normal'},
+    'تندر': {'id': 3, 'damage': 45, 'price': 100, 'min_level': 3, 'type': 'normal'},
+    'هاوک': {'id': 4, 'damage': 55, 'price': 200, 'min_level': 4, 'type': 'normal'},
+    'پاتریوت': {'id': 5, 'damage': 65, 'price': 500, 'min_level': 5, 'type': 'normal'},
+    
+    # موشک‌های ویژه
+    'شهاب': {'id': 6, 'damage': 125, 'price': 2500, 'min_level': 6, 'type': 'special', 'gem_cost': 1},
+    'سیل': {'id': 7, 'damage': 150, 'price': 3000, 'min_level': 7, 'type': 'special', 'gem_cost': 2},
+    'توفان': {'id': 8, 'damage': 175, 'price': 3500, 'min_level': 8, 'type': 'special', 'gem_cost': 3},
+    'تایفون': {'id': 9, 'damage': 200, 'price': 4000, 'min_level': 9, 'type': 'special', 'gem_cost': 4},
+    'آپوکالیپس': {'id': 10, 'damage': 250, 'price': 5000, 'min_level': 10, 'type': 'special', 'gem_cost': 5}
+}
+
+MISSILE_IDS = {name: data['id'] for name, data in MISSILE_DATA.items()}
+MISSILE_NAMES = {data['id']: name for name, data in MISSILE_DATA.items()}
+
+Inventory.configure((data['id'], name) for name, data in MISSILE_DATA.items())
+
+# === مایگریشن‌های شِما ===
+# ستون‌هایی که دیتابیس‌های قدیمی‌تر ندارند؛ ALTER TABLE فقط پیش‌فرض ثابت می‌پذیرد
+MIGRATION_COLUMNS = {
+    'users': {
+        'cyber_tower_level': 'INTEGER DEFAULT 0',
+        'defense_missile_level': 'INTEGER DEFAULT 0',
+        'defense_electronic_level': 'INTEGER DEFAULT 0',
+        'defense_antifighter_level': 'INTEGER DEFAULT 0',
+        'total_defense_bonus': 'REAL DEFAULT 0.0',
+        'fighter_level': 'INTEGER DEFAULT 0',
+        'last_revenge_time': 'INTEGER DEFAULT 0',
+        'total_damage': 'INTEGER DEFAULT 0'
+    },
+    'attacks': {
+        'loot_gems': 'INTEGER DEFAULT 0',
+        'can_revenge': 'BOOLEAN DEFAULT 1',
+        'revenge_taken': 'BOOLEAN DEFAULT 0'
+    }
+}
+
+def _add_missing_columns(cursor):
+    """اضافه کردن ستون‌های جاافتاده به جدول‌های موجود"""
+    for table, columns in MIGRATION_COLUMNS.items():
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        for column, definition in columns.items():
+            if column not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _backfill_total_damage(cursor):
+    """ستون total_damage برای رنکینگ خسارت، پر شده از حملات موجود و خلاصه‌ها"""
+    _add_missing_columns(cursor)
+    cursor.execute('''
+    UPDATE users SET total_damage =
+        COALESCE((SELECT SUM(damage) FROM attacks WHERE attacker_id = users.user_id), 0) +
+        COALESCE((SELECT SUM(damage_dealt) FROM attack_daily_summary WHERE user_id = users.user_id), 0)
+    ''')
+
+def _sync_missile_catalog(cursor):
+    """جدول missiles همیشه هم‌شکل MISSILE_DATA است"""
+    cursor.executemany('''
+    INSERT INTO missiles (id, name, rank) VALUES (?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET name = excluded.name, rank = excluded.rank
+    ''', [(data['id'], name, rank) for rank, (name, data) in enumerate(MISSILE_DATA.items())])
+
+def _migrate_missile_ids(cursor):
+    """نام متنی موشک در user_missiles و attacks با شناسه عددی کاتالوگ جایگزین می‌شود"""
+    _sync_missile_catalog(cursor)
+    
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(user_missiles)')}
+    if 'missile_name' in columns:
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_missiles (
+        CREATE TABLE user_missiles_new (
             user_id INTEGER,
-            missile_name TEXT,
+            missile_id INTEGER,
             quantity INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, missile_name),
-            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-        )
+            PRIMARY KEY (user_id, missile_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (missile_id) REFERENCES missiles(id)
+        ) WITHOUT ROWID
         ''')
-        
-        # جدول حمله‌ها
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attacks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            attacker_id INTEGER,
-            target_id INTEGER,
-            attack_type TEXT,
-            missile_name TEXT,
-            damage INTEGER,
-            loot_coins INTEGER,
-            loot_gems INTEGER,
-            can_revenge BOOLEAN DEFAULT 1,
-            revenge_taken BOOLEAN DEFAULT 0,
-            timestamp INTEGER DEFAULT (strftime('%s', 'now')),
-            FOREIGN KEY (attacker_id) REFERENCES users(user_id),
-            FOREIGN KEY (target_id) REFERENCES users(user_id)
-        )
+        INSERT INTO user_missiles_new (user_id, missile_id, quantity)
+        SELECT um.user_id, m.id, SUM(um.quantity)
+        FROM user_missiles um JOIN missiles m ON m.name = um.missile_name
+        GROUP BY um.user_id, m.id
         ''')
-        
-        conn.commit()
-        conn.close()
+        cursor.execute('DROP TABLE user_missiles')
+        cursor.execute('ALTER TABLE user_missiles_new RENAME TO user_missiles')
     
-    def register_user(self, user_id: int, username: str, full_name: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(attacks)')}
+    if 'missile_name' in columns:
+        cursor.execute('ALTER TABLE attacks ADD COLUMN missile_id INTEGER REFERENCES missiles(id)')
         cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, full_name) 
-        VALUES (?, ?, ?)
-        ''', (user_id, username, full_name))
-        
-        # تنظیم ادمین اگر در لیست باشد
-        if user_id in ADMIN_IDS:
-            cursor.execute('UPDATE users SET is_admin = 1 WHERE user_id = ?', (user_id,))
-        
-        # مقدار اولیه موشک‌ها
-        initial_missiles = [
-            (user_id, 'شبح', 5),
-            (user_id, 'رعد', 3),
-            (user_id, 'تندر', 1)
-        ]
+        UPDATE attacks SET missile_id = (SELECT id FROM missiles WHERE name = attacks.missile_name)
+        ''')
+        cursor.execute('ALTER TABLE attacks DROP COLUMN missile_name')
+
+def _create_intent_tables(cursor):
+    """intent های تسویه بین شاردی (شارد مهاجم) و رسیدهای اعمال‌شده (شارد هدف)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shard_intents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target_shard INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        result TEXT,
+        created_at INTEGER DEFAULT (strftime('%s', 'now')),
+        settled_at INTEGER
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_shard_intents_pending
+    ON shard_intents(status, created_at) WHERE status = 'pending'
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS intent_receipts (
+        source_shard INTEGER,
+        intent_id INTEGER,
+        result TEXT NOT NULL,
+        created_at INTEGER DEFAULT (strftime('%s', 'now')),
+        PRIMARY KEY (source_shard, intent_id)
+    ) WITHOUT ROWID
+    ''')
+
+def _create_outbox(cursor):
+    """صف اعلان‌هایی که در همان تراکنش تسویه حمله نوشته و بعداً ارسال می‌شوند"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER DEFAULT (strftime('%s', 'now'))
+    )
+    ''')
+    # پیام‌های عقب‌افتاده (در انتظار تلاش دوباره) که بقیه پیام‌های همان چت را نگه می‌دارند
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at)')
+
+# (نسخه، توضیح، دستور SQL یا تابعی که cursor می‌گیرد) - فقط به انتهای لیست اضافه شود
+SCHEMA_MIGRATIONS = [
+    (1, 'add missing columns', _add_missing_columns),
+    # حملات قابل انتقام روی یک کاربر به ترتیب زمان (get_recent_attacks_on_user)
+    (2, 'index open attacks by target',
+     'CREATE INDEX IF NOT EXISTS idx_attacks_target_open '
+     'ON attacks(target_id, can_revenge, revenge_taken, timestamp)'),
+    # آخرین حمله بین دو کاربر (انتقام سریع)
+    (3, 'index attacks by attacker and target',
+     'CREATE INDEX IF NOT EXISTS idx_attacks_pair '
+     'ON attacks(attacker_id, target_id, timestamp)'),
+    # رنکینگ بر اساس سکه
+    (4, 'index users by zone_coin',
+     'CREATE INDEX IF NOT EXISTS idx_users_zone_coin ON users(zone_coin)'),
+    # کاربران جدید در آمار ادمین
+    (5, 'index users by created_at',
+     'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)'),
+    (6, 'analyze', 'ANALYZE'),
+    # خلاصه روزانه حملات بایگانی‌شده برای هر بازیکن
+    (7, 'create attack_daily_summary', '''
+     CREATE TABLE IF NOT EXISTS attack_daily_summary (
+         day INTEGER,
+         user_id INTEGER,
+         attacks_made INTEGER DEFAULT 0,
+         attacks_received INTEGER DEFAULT 0,
+         damage_dealt INTEGER DEFAULT 0,
+         damage_taken INTEGER DEFAULT 0,
+         coins_looted INTEGER DEFAULT 0,
+         coins_lost INTEGER DEFAULT 0,
+         gems_looted INTEGER DEFAULT 0,
+         gems_lost INTEGER DEFAULT 0,
+         PRIMARY KEY (day, user_id)
+     ) WITHOUT ROWID
+     '''),
+    # کارهای پیام همگانی؛ cursor آخرین user_id ارسال‌شده است
+    (8, 'create broadcast_jobs', '''
+     CREATE TABLE IF NOT EXISTS broadcast_jobs (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         admin_chat_id INTEGER,
+         progress_message_id INTEGER,
+         text TEXT,
+         status TEXT DEFAULT 'running',
+         cursor INTEGER DEFAULT 0,
+         sent INTEGER DEFAULT 0,
+         failed INTEGER DEFAULT 0,
+         total INTEGER DEFAULT 0,
+         created_at INTEGER DEFAULT (strftime('%s', 'now')),
+         updated_at INTEGER DEFAULT (strftime('%s', 'now'))
+     )
+     '''),
+    (9, 'add users.total_damage', _backfill_total_damage),
+    # created_at در دیتابیس‌های قدیمی TIMESTAMP متنی است و با عدد مقایسه نمی‌شود
+    (10, 'normalize users.created_at to epoch seconds', '''
+     UPDATE users SET created_at = CASE
+         WHEN created_at NOT GLOB '*[^0-9]*' THEN CAST(created_at AS INTEGER)
+         ELSE COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+     END
+     WHERE typeof(created_at) = 'text'
+     '''),
+    (11, 'store missiles by catalog id', _migrate_missile_ids),
+    (12, 'create packed user_inventory', PackedInventoryStore.create_schema),
+    (13, 'create shard intent tables', _create_intent_tables),
+    (14, 'create outbox', _create_outbox)
+]
+
+# ابعاد رنکینگ و ستون هر کدام
+LEADERBOARD_COLUMNS = {
+    'coins': 'zone_coin',
+    'level': 'level',
+    'zp': 'zone_point',
+    'damage': 'total_damage'
+}
+
+# === کلاس دیتابیس ===
+class Database:
+    DEFENSE_COLUMNS = {
+        'missile': 'defense_missile_level',
+        'electronic': 'defense_electronic_level',
+        'antifighter': 'defense_antifighter_level'
+    }
+    GRANT_COLUMNS = ('zone_coin', 'zone_gem', 'zone_point')
+
+    def __init__(self, db_path='app/data/warzone.db', write_behind: bool = DB_WRITE_BEHIND,
+                 flush_interval_ms: int = DB_FLUSH_INTERVAL_MS, flush_max_ops: int = DB_FLUSH_MAX_OPS,
+                 archive_path: str = ATTACK_ARCHIVE_PATH, inventory_layout: str = DB_INVENTORY_LAYOUT):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.inventory = INVENTORY_STORES[inventory_layout]()
+        # فایل آرشیو حملات قدیمی؛ خالی یعنی حملات منقضی فقط خلاصه و حذف می‌شوند
+        self.archive_path = archive_path
+        self.connections = ConnectionManager(db_path)
+        # در حالت write-behind تغییرات منابع تا commit گروهی بعدی در حافظه می‌مانند
+        self.pending = ResourceDeltaBuffer() if write_behind else None
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_ops = flush_max_ops
+        self.cache = PlayerCache()
+        self._tx = threading.local()
+        # AsyncDatabase برای هر شارد یک thread نویسنده می‌سازد؛ اینجا فقط یک فایل
+        self.shards = (self,)
+        self.leaderboards: Dict[str, Leaderboard] = {}
+        self.init_db()
+        self.leaderboards = {name: Leaderboard(column) for name, column in LEADERBOARD_COLUMNS.items()}
+        for board in self.leaderboards.values():
+            self._seed_leaderboard(board)
+    
+    def get_connection(self):
+        """اتصال ماندگار thread جاری - نباید بسته شود"""
+        return self.connections.get()
+    
+    def route(self, name: str, args: tuple, kwargs: dict) -> int:
+        """شماره شاردی که thread نویسنده‌اش این فراخوانی را اجرا می‌کند"""
+        return 0
+    
+    # در یک فایل هر کار چندشاردی فقط یک مرحله است
+    def settle_steps(self, *args, **kwargs) -> Steps:
+        return (yield 0, functools.partial(self.settle_attack, *args, **kwargs))
+    
+    def prune_steps(self, cutoff: int, batch_size: int = ATTACK_PRUNE_BATCH) -> Steps:
+        return (yield 0, functools.partial(self.prune_attacks, cutoff, batch_size))
+    
+    def bulk_grant_steps(self, *args, **kwargs) -> Steps:
+        return (yield 0, functools.partial(self.bulk_grant, *args, **kwargs))
+
+    def cache_stats(self) -> Dict[str, float]:
+        return self.cache.stats()
+    
+    @contextmanager
+    def transaction(self):
+        """یک تراکنش نوشتنی؛ داخل تراکنش باز، به همان تراکنش می‌پیوندد"""
+        conn = self.get_connection()
+        if conn.in_transaction:
+            yield conn.cursor()
+            return
+        self._tx.touched = touched = set()
+        self._tx.touched_all = False
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.cursor()
+            # هر تراکنش تغییرات بافرشده را هم در همان commit می‌نویسد
+            if self.pending is not None:
+                touched.update(self.pending.apply(cursor))
+            yield cursor
+            # کش فقط پس از commit پاک می‌شود تا خواننده‌ها داده قدیمی را دوباره کش نکنند
+            if self.pending is None:
+                conn.execute('COMMIT')
+                self._invalidate(touched)
+            else:
+                with self.pending.lock:
+                    conn.execute('COMMIT')
+                    self.pending.committed()
+                    self._invalidate(touched)
+        except BaseException:
+            # COMMIT ناموفق (مثلاً SQLITE_BUSY) تراکنش را باز می‌گذارد؛ پس از commit موفق
+            # چیزی برای rollback نمانده و inflight هم خالی است
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if self.pending is not None:
+                self.pending.restore()
+            raise
+        self._refresh_leaderboards(touched)
+    
+    def _touch(self, *user_ids: int):
+        """علامت‌گذاری کاربران تغییرکرده در تراکنش جاری برای حذف از کش"""
+        self._tx.touched.update(user_ids)
+    
+    def _touch_all(self):
+        """تراکنش جاری روی تعداد نامشخصی از کاربران نوشته است - کل کش پاک می‌شود"""
+        self._tx.touched_all = True
+    
+    def _invalidate(self, touched):
+        if self._tx.touched_all:
+            self.cache.clear()
+        else:
+            self.cache.invalidate_users(touched)
+    
+    def _seed_leaderboard(self, board: Leaderboard):
+        board.seed(self._query_players(f'''
+        SELECT {', '.join(Leaderboard.FIELDS)} FROM users
+        ORDER BY {board.column} DESC, user_id ASC
+        LIMIT ?
+        ''', (board.capacity,)))
+    
+    def _refresh_leaderboards(self, touched):
+        """به‌روزرسانی top-K ها با مقادیر commit شده کاربران تغییرکرده"""
+        if not self.leaderboards:
+            return
+        if self._tx.touched_all:
+            for board in self.leaderboards.values():
+                self._seed_leaderboard(board)
+            return
+        if not touched:
+            return
+        placeholders = ', '.join('?' * len(touched))
+        players = self._query_players(
+            f"SELECT {', '.join(Leaderboard.FIELDS)} FROM users WHERE user_id IN ({placeholders})",
+            tuple(touched)
+        )
+        for board in self.leaderboards.values():
+            for player in players:
+                board.update(player)
+            if board.stale:
+                self._seed_leaderboard(board)
+    
+    def flush_due(self) -> bool:
+        """آیا زمان یا تعداد تغییرات بافرشده به حد flush رسیده است"""
+        if self.pending is None or not self.pending.ops:
+            return False
+        return (self.pending.ops >= self.flush_max_ops or
+                time.monotonic() - self.pending.first_op_at >= self.flush_interval)
+    
+    def flush(self):
+        """نوشتن همه تغییرات بافرشده در یک تراکنش"""
+        if self.pending is not None and self.pending.ops:
+            with self.transaction():
+                pass
+    
+    def close(self):
+        self.flush()
+        self.connections.close_all()
+    
+    def init_db(self):
+        with self.transaction() as cursor:
+            # جدول کاربران
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                full_name TEXT,
+                zone_coin INTEGER DEFAULT 1000,
+                zone_gem INTEGER DEFAULT 0,
+                zone_point INTEGER DEFAULT 500,
+                level INTEGER DEFAULT 1,
+                xp INTEGER DEFAULT 0,
+                is_admin BOOLEAN DEFAULT 0,
+                miner_level INTEGER DEFAULT 1,
+                last_miner_claim INTEGER DEFAULT (strftime('%s', 'now')),
+                cyber_tower_level INTEGER DEFAULT 0,
+                defense_missile_level INTEGER DEFAULT 0,
+                defense_electronic_level INTEGER DEFAULT 0,
+                defense_antifighter_level INTEGER DEFAULT 0,
+                total_defense_bonus REAL DEFAULT 0.0,
+                fighter_level INTEGER DEFAULT 0,
+                last_revenge_time INTEGER DEFAULT 0,
+                total_damage INTEGER DEFAULT 0,
+                created_at INTEGER DEFAULT (strftime('%s', 'now'))
+            )
+            ''')
+            
+            # کاتالوگ موشک‌ها
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS missiles (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                rank INTEGER NOT NULL
+            )
+            ''')
+            
+            # جدول موشک‌ها
+            RowInventoryStore.create_schema(cursor)
+            
+            # جدول حمله‌ها
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attacks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attacker_id INTEGER,
+                target_id INTEGER,
+                attack_type TEXT,
+                missile_id INTEGER,
+                damage INTEGER,
+                loot_coins INTEGER,
+                loot_gems INTEGER,
+                can_revenge BOOLEAN DEFAULT 1,
+                revenge_taken BOOLEAN DEFAULT 0,
+                timestamp INTEGER DEFAULT (strftime('%s', 'now')),
+                FOREIGN KEY (attacker_id) REFERENCES users(user_id),
+                FOREIGN KEY (target_id) REFERENCES users(user_id),
+                FOREIGN KEY (missile_id) REFERENCES missiles(id)
+            )
+            ''')
         
-        for missile in initial_missiles:
+        self.migrate()
+        with self.transaction() as cursor:
+            _sync_missile_catalog(cursor)
+            PackedInventoryStore.create_schema(cursor)
+        self._adopt_inventory_layout()
+    
+    def _adopt_inventory_layout(self):
+        """انتقال موجودی‌ها به چیدمان انتخاب‌شده اگر در چیدمان دیگر ذخیره شده باشند"""
+        started = time.perf_counter()
+        with self.transaction() as cursor:
+            users = self.inventory.adopt(cursor)
+        if users:
+            self.cache.clear()
+            elapsed = (time.perf_counter() - started) * 1000
+            logger.info(f"🧱 Moved inventories of {users} users to '{self.inventory.name}' layout ({elapsed:.1f} ms)")
+    
+    def migrate(self):
+        """اجرای مایگریشن‌های جدیدتر از PRAGMA user_version، هر کدام در تراکنش خودش"""
+        current = self.get_connection().execute('PRAGMA user_version').fetchone()[0]
+        for version, description, step in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            with self.transaction() as cursor:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+                # user_version داخل همان تراکنش نوشته می‌شود و با آن commit یا rollback می‌شود
+                cursor.execute(f'PRAGMA user_version = {int(version)}')
+            elapsed = (time.perf_counter() - started) * 1000
+            logger.info(f"🧱 Migration {version} applied: {description} ({elapsed:.1f} ms)")
+    
+    def register_user(self, user_id: int, username: str, full_name: str):
+        with self.transaction() as cursor:
+            self._touch(user_id)
             cursor.execute('''
-            INSERT OR IGNORE INTO user_missiles (user_id, missile_name, quantity)
+            INSERT OR IGNORE INTO users (user_id, username, full_name) 
             VALUES (?, ?, ?)
-            ''', missile)
-        
-        conn.commit()
-        conn.close()
+            ''', (user_id, username, full_name))
+            
+            # تنظیم ادمین اگر در لیست باشد
+            if user_id in ADMIN_IDS:
+                cursor.execute('UPDATE users SET is_admin = 1 WHERE user_id = ?', (user_id,))
+            
+            # مقدار اولیه موشک‌ها
+            self.inventory.seed(cursor, user_id, [
+                (MISSILE_IDS['شبح'], 5),
+                (MISSILE_IDS['رعد'], 3),
+                (MISSILE_IDS['تندر'], 1)
+            ])
     
     def get_user(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        return dict(user) if user else None
-    
-    def get_user_missiles(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT missile_name, quantity FROM user_missiles 
-        WHERE user_id = ? AND quantity > 0
-        ORDER BY 
-            CASE missile_name
-                WHEN 'شبح' THEN 1
-                WHEN 'رعد' THEN 2
-                WHEN 'تندر' THEN 3
-                WHEN 'هاوک' THEN 4
-                WHEN 'پاتریوت' THEN 5
-                WHEN 'شهاب' THEN 6
-                WHEN 'سیل' THEN 7
-                WHEN 'توفان' THEN 8
-                WHEN 'تایفون' THEN 9
-                WHEN 'آپوکالیپس' THEN 10
-                ELSE 11
-            END
-        ''', (user_id,))
-        missiles = cursor.fetchall()
-        conn.close()
-        return [dict(m) for m in missiles]
+        if self.pending is None:
+            return self._get_cached_user(user_id)
+        
+        # خواندن و تغییرات commit نشده باید با هم دیده شوند
+        with self.pending.lock:
+            user = self._get_cached_user(user_id)
+            deltas = self.pending.deltas_for(user_id)
+        if not user or not deltas:
+            return user
+        return user.with_deltas(deltas)
+    
+    def _get_cached_user(self, user_id: int) -> Optional[Player]:
+        user = self.cache.get(('user', user_id))
+        if user is not None:
+            return user
+        generation = self.cache.generation
+        users = self._query_players('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        if not users:
+            return None
+        self.cache.put(('user', user_id), users[0], generation)
+        return users[0]
+    
+    def _query_players(self, sql: str, params=()) -> List[Player]:
+        """اجرای کوئری روی جدول users با row factory رکورد Player"""
+        cursor = self.get_connection().cursor()
+        cursor.row_factory = player_factory
+        return cursor.execute(sql, params).fetchall()
+    
+    def get_user_missiles(self, user_id: int) -> Inventory:
+        """موجودی موشک‌ها؛ ترتیب نمایش از کاتالوگ Inventory می‌آید"""
+        missiles = self.cache.get(('missiles', user_id))
+        if missiles is not None:
+            return missiles
+        generation = self.cache.generation
+        missiles = self.inventory.load(self.get_connection(), user_id)
+        self.cache.put(('missiles', user_id), missiles, generation)
+        return missiles
     
     def update_user_coins(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_coin = zone_coin + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        if self.pending is not None:
+            self.pending.add(user_id, 'zone_coin', amount)
+            return
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('''
+            UPDATE users 
+            SET zone_coin = zone_coin + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
     
     def update_user_gems(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_gem = zone_gem + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        if self.pending is not None:
+            self.pending.add(user_id, 'zone_gem', amount)
+            return
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('''
+            UPDATE users 
+            SET zone_gem = zone_gem + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
     
     def update_user_zp(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_point = zone_point + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        if self.pending is not None:
+            self.pending.add(user_id, 'zone_point', amount)
+            return
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('''
+            UPDATE users 
+            SET zone_point = zone_point + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
     
     def add_xp(self, user_id: int, xp_amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT xp, level FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('SELECT xp, level FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
+            
+            if not user:
+                return False, 1
+            
             current_xp = user['xp'] + xp_amount
             level = user['level']
             xp_needed = level * 100
@@ -247,114 +1085,1275 @@ class Database:
                 SET xp = ?, level = ?, zone_coin = zone_coin + 500
                 WHERE user_id = ?
                 ''', (remaining_xp, new_level, user_id))
-                level_up = True
-            else:
-                cursor.execute('UPDATE users SET xp = ? WHERE user_id = ?', (current_xp, user_id))
-                level_up = False
+                return True, new_level
             
-            conn.commit()
-            conn.close()
-            return level_up, new_level if level_up else level
-        return False, user['level'] if user else 1
-    
-    def get_all_users(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, full_name FROM users')
-        users = cursor.fetchall()
-        conn.close()
-        return [dict(u) for u in users]
-    
-    def get_top_users(self, limit=10):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT user_id, username, full_name, zone_coin, zone_gem, zone_point, level
-        FROM users 
-        ORDER BY zone_coin DESC 
+            cursor.execute('UPDATE users SET xp = ? WHERE user_id = ?', (current_xp, user_id))
+            return False, level
+    
+    def get_users_page(self, after_user_id: int = 0, limit: int = USER_PAGE_SIZE,
+                       segment: Optional[UserSegment] = None) -> List[Player]:
+        """یک صفحه از کاربران بعد از after_user_id (صفحه‌بندی keyset روی کلید اصلی)"""
+        where, params = (segment or UserSegment()).where()
+        return self._query_players(f'''
+        SELECT user_id, username, full_name FROM users
+        WHERE user_id > ? AND {where}
+        ORDER BY user_id
         LIMIT ?
-        ''', (limit,))
-        users = cursor.fetchall()
-        conn.close()
-        return [dict(u) for u in users]
+        ''', (after_user_id, *params, limit))
+    
+    def count_users(self, segment: Optional[UserSegment] = None) -> int:
+        where, params = (segment or UserSegment()).where()
+        return self.get_connection().execute(
+            f'SELECT COUNT(*) FROM users WHERE {where}', params
+        ).fetchone()[0]
     
     def update_fighter_level(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        if self.pending is not None:
+            self.pending.add(user_id, 'fighter_level', amount)
+            return
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('''
+            UPDATE users 
+            SET fighter_level = fighter_level + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
+    
+    def add_missile(self, user_id: int, missile_id: int, quantity: int = 1):
+        """اضافه کردن موشک به کاربر"""
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            self.inventory.add(cursor, user_id, missile_id, quantity)
+    
+    # === خرید و ارتقا ===
+    # هر خرید یا ارتقا یک تراکنش با کسرهای شرطی است؛ بررسی موجودی در پایتون فقط برای
+    # پیام است و دو کلیک هم‌زمان، غارت هم‌زمان یا چند پروسه نمی‌توانند موجودی را منفی کنند.
+    # خروجی مثل settle_attack یک dict با status است و در حالت ok موجودی جدید را دارد.
+    def _charge(self, cursor, user_id: int, coins: int = 0, gems: int = 0):
+        """کسر شرطی سکه و جم"""
         cursor.execute('''
         UPDATE users 
-        SET fighter_level = fighter_level + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
-    
-    def record_attack(self, attacker_id: int, target_id: int, missile_name: str, damage: int, loot_coins: int, loot_gems: int):
+        SET zone_coin = zone_coin - ?, zone_gem = zone_gem - ? 
+        WHERE user_id = ? AND zone_coin >= ? AND zone_gem >= ?
+        ''', (coins, gems, user_id, coins, gems))
+        if cursor.rowcount == 0:
+            row = cursor.execute('SELECT zone_coin FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                raise _SettlementAborted('no_user')
+            raise _SettlementAborted('no_coins' if row['zone_coin'] < coins else 'no_gems')
+    
+    def _level_up(self, cursor, user_id: int, column: str, level: int):
+        """افزایش یک لول فقط اگر لول فعلی همان لولی باشد که هزینه از روی آن حساب شده"""
+        cursor.execute(f'UPDATE users SET {column} = {column} + 1 WHERE user_id = ? AND {column} = ?',
+                       (user_id, level))
+        if cursor.rowcount == 0:
+            raise _SettlementAborted('stale')
+    
+    def _purchase(self, user_id: int, apply) -> Dict:
+        """اجرای apply(cursor) در یک تراکنش و برگرداندن status و موجودی جدید"""
+        try:
+            with self.transaction() as cursor:
+                self._touch(user_id)
+                apply(cursor)
+                balance = cursor.execute('''
+                SELECT zone_coin, zone_gem, zone_point FROM users WHERE user_id = ?
+                ''', (user_id,)).fetchone()
+        except _SettlementAborted as e:
+            return {'status': e.reason}
+        return {'status': 'ok', **dict(balance)}
+    
+    def buy_missile(self, user_id: int, missile_id: int, price: int, gem_cost: int = 0,
+                    min_level: int = 1) -> Dict:
+        """status: ok / no_user / low_level / no_coins / no_gems"""
+        def apply(cursor):
+            row = cursor.execute('SELECT level FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                raise _SettlementAborted('no_user')
+            if row['level'] < min_level:
+                raise _SettlementAborted('low_level')
+            self._charge(cursor, user_id, price, gem_cost)
+            self.inventory.add(cursor, user_id, missile_id, 1)
+        return self._purchase(user_id, apply)
+    
+    def open_box(self, user_id: int, cost_coin: int, cost_gem: int, reward: Dict[str, int],
+                 missiles: Optional[Dict[int, int]] = None) -> Dict:
+        """کسر هزینه باکس و واریز جایزه (ستون‌های GRANT_COLUMNS و موشک‌ها) با هم
+        
+        status: ok / no_user / no_coins / no_gems
+        """
+        unknown = set(reward) - set(self.GRANT_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown reward columns: {unknown}")
+        
+        def apply(cursor):
+            self._charge(cursor, user_id, cost_coin, cost_gem)
+            for column, amount in reward.items():
+                cursor.execute(f'UPDATE users SET {column} = {column} + ? WHERE user_id = ?', (amount, user_id))
+            for missile_id, quantity in (missiles or {}).items():
+                self.inventory.add(cursor, user_id, missile_id, quantity)
+        return self._purchase(user_id, apply)
+    
+    def claim_miner(self, user_id: int, zp_amount: int, last_claim: int) -> Dict:
+        """برداشت ZP ماینر و شروع دوباره زمان‌سنج
+        
+        zp_amount از روی last_claim حساب شده است؛ اگر برداشت دیگری زودتر انجام شده باشد
+        status برابر already_claimed است.
+        """
+        def apply(cursor):
+            now = int(time.time())
+            # زمان برداشت باید جلو برود؛ وگرنه دو برداشت در یک ثانیه هر دو پذیرفته می‌شوند
+            cursor.execute('''
+            UPDATE users 
+            SET zone_point = zone_point + ?, last_miner_claim = ? 
+            WHERE user_id = ? AND last_miner_claim = ? AND last_miner_claim < ?
+            ''', (zp_amount, now, user_id, last_claim, now))
+            if cursor.rowcount == 0:
+                raise _SettlementAborted('already_claimed')
+        return self._purchase(user_id, apply)
+    
+    def upgrade_miner(self, user_id: int, level: int, cost: int) -> Dict:
+        """status: ok / stale (لول عوض شده) / no_coins"""
+        def apply(cursor):
+            self._level_up(cursor, user_id, 'miner_level', level)
+            self._charge(cursor, user_id, cost)
+        return self._purchase(user_id, apply)
+    
+    def upgrade_fighter(self, user_id: int, level: int, cost: int) -> Dict:
+        """status: ok / stale / no_coins"""
+        def apply(cursor):
+            self._level_up(cursor, user_id, 'fighter_level', level)
+            self._charge(cursor, user_id, cost)
+        return self._purchase(user_id, apply)
+    
+    def upgrade_defense(self, user_id: int, defense_type: str, level: int, cost: int) -> Dict:
+        """ارتقای یک سیستم دفاع و محاسبه دوباره بانس کل؛ status: ok / stale / no_coins"""
+        column = self.DEFENSE_COLUMNS[defense_type]
+        
+        def apply(cursor):
+            self._level_up(cursor, user_id, column, level)
+            self._charge(cursor, user_id, cost)
+            # محاسبه بانس جدید
+            cursor.execute('''
+            UPDATE users SET total_defense_bonus = 
+                (defense_missile_level * 0.05) + 
+                (defense_electronic_level * 0.03) + 
+                (defense_antifighter_level * 0.07)
+            WHERE user_id = ?
+            ''', (user_id,))
+        
+        result = self._purchase(user_id, apply)
+        if result['status'] == 'ok':
+            result['total_defense_bonus'] = self.get_connection().execute(
+                'SELECT total_defense_bonus FROM users WHERE user_id = ?', (user_id,)
+            ).fetchone()[0]
+        return result
+    
+    def set_user_level(self, user_id: int, level: int):
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (level, user_id))
+    
+    def record_attack(self, attacker_id: int, target_id: int, missile_id: int, damage: int, loot_coins: int, loot_gems: int):
         """ثبت حمله در دیتابیس"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO attacks (attacker_id, target_id, missile_name, damage, loot_coins, loot_gems)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (attacker_id, target_id, missile_name, damage, loot_coins, loot_gems))
-        attack_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return attack_id
+        with self.transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO attacks (attacker_id, target_id, missile_id, damage, loot_coins, loot_gems)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (attacker_id, target_id, missile_id, damage, loot_coins, loot_gems))
+            return cursor.lastrowid
     
     def get_recent_attacks_on_user(self, user_id: int, limit=5):
         """دریافت آخرین حملات بر روی کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        attacks = self.get_connection().execute('''
         SELECT a.*, u.username, u.full_name 
         FROM attacks a
         JOIN users u ON a.attacker_id = u.user_id
         WHERE a.target_id = ? AND a.can_revenge = 1 AND a.revenge_taken = 0
         ORDER BY a.timestamp DESC
         LIMIT ?
-        ''', (user_id, limit))
-        attacks = cursor.fetchall()
-        conn.close()
+        ''', (user_id, limit)).fetchall()
         return [dict(a) for a in attacks]
     
+    def get_revengeable_attack(self, attack_id: int):
+        """دریافت حمله‌ای که هنوز قابل انتقام است"""
+        attack = self.get_connection().execute('''
+        SELECT a.*, u.username, u.full_name 
+        FROM attacks a
+        JOIN users u ON a.attacker_id = u.user_id
+        WHERE a.id = ? AND a.can_revenge = 1 AND a.revenge_taken = 0
+        ''', (attack_id,)).fetchone()
+        return dict(attack) if attack else None
+    
+    def get_last_attack(self, attacker_id: int, target_id: int):
+        """آخرین حمله یک کاربر به کاربر دیگر"""
+        attack = self.get_connection().execute('''
+        SELECT * FROM attacks 
+        WHERE attacker_id = ? AND target_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT 1
+        ''', (attacker_id, target_id)).fetchone()
+        return dict(attack) if attack else None
+    
     def mark_revenge_taken(self, attack_id: int):
         """علامت‌گذاری انتقام گرفته شده"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE attacks SET revenge_taken = 1 WHERE id = ?', (attack_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE attacks SET revenge_taken = 1 WHERE id = ?', (attack_id,))
     
     def update_last_revenge_time(self, user_id: int):
         """آپدیت زمان آخرین انتقام"""
+        with self.transaction() as cursor:
+            self._touch(user_id)
+            cursor.execute('UPDATE users SET last_revenge_time = ? WHERE user_id = ?', 
+                          (int(time.time()), user_id))
+    
+    def _spend_for_attack(self, cursor, attacker_id: int, missile_id: int, gem_cost: int):
+        """کسر شرطی موشک و جم مهاجم"""
+        if not self.inventory.take(cursor, attacker_id, missile_id):
+            raise _SettlementAborted('no_missile')
+        
+        # کسر جم برای موشک‌های ویژه
+        if gem_cost > 0:
+            cursor.execute('''
+            UPDATE users 
+            SET zone_gem = zone_gem - ? 
+            WHERE user_id = ? AND zone_gem >= ?
+            ''', (gem_cost, attacker_id, gem_cost))
+            if cursor.rowcount == 0:
+                raise _SettlementAborted('no_gems')
+    
+    def _loot_target(self, cursor, target_id: int, revenge_of: Optional[int], loot_rate: float,
+                     loot_cap: int, gem_loot_rate: float, gem_loot_cap: int) -> Tuple[int, int]:
+        """بستن حمله اصلی (در انتقام) و کسر غنیمت از هدف؛ خروجی (سکه، جم) غنیمت"""
+        # غنیمت از موجودی لحظه‌ای هدف محاسبه می‌شود
+        cursor.execute('SELECT zone_coin, zone_gem FROM users WHERE user_id = ?', (target_id,))
+        target = cursor.fetchone()
+        if not target:
+            raise _SettlementAborted('no_target')
+        loot_coins = max(min(int(target['zone_coin'] * loot_rate), loot_cap), 0)
+        loot_gems = max(min(int(target['zone_gem'] * gem_loot_rate), gem_loot_cap), 0)
+        
+        if revenge_of is not None:
+            cursor.execute('''
+            UPDATE attacks SET revenge_taken = 1 
+            WHERE id = ? AND revenge_taken = 0
+            ''', (revenge_of,))
+            if cursor.rowcount == 0:
+                raise _SettlementAborted('revenge_taken')
+        
+        cursor.execute('''
+        UPDATE users 
+        SET zone_coin = zone_coin - ?, zone_gem = zone_gem - ? 
+        WHERE user_id = ?
+        ''', (loot_coins, loot_gems, target_id))
+        return loot_coins, loot_gems
+    
+    def _credit_attacker(self, cursor, attacker_id: int, target_id: int, missile_id: int, damage: int,
+                         xp_gained: int, loot_coins: int, loot_gems: int, revenge: bool):
+        """واریز غنیمت، خسارت و XP به مهاجم و ثبت حمله؛ خروجی (level_up, new_level, attack_id)"""
+        if revenge:
+            cursor.execute('UPDATE users SET last_revenge_time = ? WHERE user_id = ?',
+                           (int(time.time()), attacker_id))
+        cursor.execute('''
+        UPDATE users 
+        SET zone_coin = zone_coin + ?, zone_gem = zone_gem + ?, total_damage = total_damage + ?
+        WHERE user_id = ?
+        ''', (loot_coins, loot_gems, damage, attacker_id))
+        
+        level_up, new_level = self.add_xp(attacker_id, xp_gained)
+        
+        # انتقام خودش قابل انتقام نیست و ثبت نمی‌شود
+        attack_id = None
+        if not revenge:
+            attack_id = self.record_attack(attacker_id, target_id, missile_id,
+                                           damage, loot_coins, loot_gems)
+        return level_up, new_level, attack_id
+    
+    def settle_attack(self, attacker_id: int, target_id: int, missile_id: int, damage: int,
+                      xp_gained: int, gem_cost: int = 0, loot_rate: float = 0.10,
+                      loot_cap: int = 1000, gem_loot_rate: float = 0.05, gem_loot_cap: int = 5,
+                      revenge_of: Optional[int] = None, notify: Optional[Dict] = None):
+        """تسویه کامل یک حمله (یا انتقام) در یک تراکنش و یک commit
+        
+        همه کسرها شرطی هستند تا دو کلیک همزمان نتوانند یک موشک یا جم را دو بار خرج کنند.
+        notify (kind و payload) اعلان هدف است که با نتیجه تسویه در همین تراکنش در outbox نوشته می‌شود.
+        خروجی یک dict با status است: ok / no_missile / no_gems / no_target / revenge_taken
+        """
+        try:
+            with self.transaction() as cursor:
+                self._touch(attacker_id, target_id)
+                self._spend_for_attack(cursor, attacker_id, missile_id, gem_cost)
+                loot_coins, loot_gems = self._loot_target(
+                    cursor, target_id, revenge_of, loot_rate, loot_cap, gem_loot_rate, gem_loot_cap
+                )
+                level_up, new_level, attack_id = self._credit_attacker(
+                    cursor, attacker_id, target_id, missile_id, damage, xp_gained,
+                    loot_coins, loot_gems, revenge_of is not None
+                )
+                
+                balances = {
+                    row['user_id']: row for row in cursor.execute(
+                        'SELECT user_id, zone_coin, zone_gem FROM users WHERE user_id IN (?, ?)',
+                        (attacker_id, target_id)
+                    ).fetchall()
+                }
+                if notify is not None:
+                    self._enqueue_notice(
+                        cursor, target_id, notify, loot_coins, loot_gems,
+                        balances[target_id]['zone_coin'], balances[target_id]['zone_gem']
+                    )
+        except _SettlementAborted as e:
+            return {'status': e.reason}
+        
+        return {
+            'status': 'ok',
+            'attack_id': attack_id,
+            'loot_coins': loot_coins,
+            'loot_gems': loot_gems,
+            'level_up': level_up,
+            'new_level': new_level,
+            'attacker_coins': balances[attacker_id]['zone_coin'],
+            'attacker_gems': balances[attacker_id]['zone_gem'],
+            'target_coins': balances[target_id]['zone_coin'],
+            'target_gems': balances[target_id]['zone_gem']
+        }
+    
+    # === تسویه بین شاردی ===
+    # وقتی مهاجم و هدف در دو فایل جدا هستند تسویه سه مرحله دارد: ۱) کسر از مهاجم و ثبت
+    # intent در شارد مهاجم ۲) کسر غنیمت از هدف و ثبت رسید در شارد هدف ۳) واریز به
+    # مهاجم (یا برگرداندن کسرها) و بستن intent. هر مرحله یک تراکنش محلی است و مراحل
+    # ۲ و ۳ تکرارپذیرند، پس intent های نیمه‌کاره پس از ری‌استارت دوباره اجرا می‌شوند.
+    def open_attack_intent(self, target_shard: int, payload: Dict) -> Dict:
+        """مرحله ۱ روی شارد مهاجم"""
+        attacker_id = payload['attacker_id']
+        try:
+            with self.transaction() as cursor:
+                self._touch(attacker_id)
+                self._spend_for_attack(cursor, attacker_id, payload['missile_id'], payload['gem_cost'])
+                cursor.execute('''
+                INSERT INTO shard_intents (target_shard, payload) VALUES (?, ?)
+                ''', (target_shard, json.dumps(payload)))
+                return {'status': 'pending', 'intent_id': cursor.lastrowid}
+        except _SettlementAborted as e:
+            return {'status': e.reason}
+    
+    def apply_attack_intent(self, source_shard: int, intent_id: int, payload: Dict) -> Dict:
+        """مرحله ۲ روی شارد هدف؛ اجرای دوباره همان رسید قبلی را برمی‌گرداند"""
+        with self.transaction() as cursor:
+            receipt = cursor.execute('''
+            SELECT result FROM intent_receipts WHERE source_shard = ? AND intent_id = ?
+            ''', (source_shard, intent_id)).fetchone()
+            if receipt:
+                return json.loads(receipt['result'])
+            
+            target_id = payload['target_id']
+            self._touch(target_id)
+            try:
+                # savepoint تا لغو، تغییرات نیمه‌کاره این مرحله را برگرداند ولی رسید ثبت شود
+                cursor.execute('SAVEPOINT loot')
+                loot_coins, loot_gems = self._loot_target(
+                    cursor, target_id, payload['revenge_of'], payload['loot_rate'],
+                    payload['loot_cap'], payload['gem_loot_rate'], payload['gem_loot_cap']
+                )
+                cursor.execute('RELEASE loot')
+                balance = cursor.execute(
+                    'SELECT zone_coin, zone_gem FROM users WHERE user_id = ?', (target_id,)
+                ).fetchone()
+                result = {
+                    'status': 'ok', 'loot_coins': loot_coins, 'loot_gems': loot_gems,
+                    'target_coins': balance['zone_coin'], 'target_gems': balance['zone_gem']
+                }
+            except _SettlementAborted as e:
+                cursor.execute('ROLLBACK TO loot')
+                cursor.execute('RELEASE loot')
+                result = {'status': e.reason}
+            cursor.execute('''
+            INSERT INTO intent_receipts (source_shard, intent_id, result) VALUES (?, ?, ?)
+            ''', (source_shard, intent_id, json.dumps(result)))
+            return result
+    
+    def close_attack_intent(self, intent_id: int, outcome: Dict) -> Dict:
+        """مرحله ۳ روی شارد مهاجم؛ intent بسته‌شده فقط نتیجه ذخیره‌شده را برمی‌گرداند"""
+        with self.transaction() as cursor:
+            intent = cursor.execute(
+                'SELECT status, payload, result FROM shard_intents WHERE id = ?', (intent_id,)
+            ).fetchone()
+            if intent['status'] != 'pending':
+                return json.loads(intent['result'])
+            
+            payload = json.loads(intent['payload'])
+            attacker_id = payload['attacker_id']
+            self._touch(attacker_id)
+            if outcome['status'] == 'ok':
+                level_up, new_level, attack_id = self._credit_attacker(
+                    cursor, attacker_id, payload['target_id'], payload['missile_id'],
+                    payload['damage'], payload['xp_gained'], outcome['loot_coins'],
+                    outcome['loot_gems'], payload['revenge_of'] is not None
+                )
+                balance = cursor.execute(
+                    'SELECT zone_coin, zone_gem FROM users WHERE user_id = ?', (attacker_id,)
+                ).fetchone()
+                result = {
+                    'status': 'ok', 'attack_id': attack_id, 'level_up': level_up,
+                    'new_level': new_level, 'attacker_coins': balance['zone_coin'],
+                    'attacker_gems': balance['zone_gem']
+                }
+                status = 'done'
+                if payload.get('notify') is not None:
+                    self._enqueue_notice(
+                        cursor, payload['target_id'], payload['notify'], outcome['loot_coins'],
+                        outcome['loot_gems'], outcome['target_coins'], outcome['target_gems']
+                    )
+            else:
+                # برگرداندن کسرهای مرحله ۱
+                self.inventory.add(cursor, attacker_id, payload['missile_id'])
+                if payload['gem_cost'] > 0:
+                    cursor.execute('UPDATE users SET zone_gem = zone_gem + ? WHERE user_id = ?',
+                                   (payload['gem_cost'], attacker_id))
+                result = {'status': outcome['status']}
+                status = 'aborted'
+            cursor.execute('''
+            UPDATE shard_intents SET status = ?, result = ?, settled_at = ? WHERE id = ?
+            ''', (status, json.dumps(result), int(time.time()), intent_id))
+            return result
+    
+    def get_pending_intents(self, older_than: int = 0) -> List[Dict]:
+        """intent هایی که مرحله ۳ آن‌ها انجام نشده است"""
+        intents = self.get_connection().execute('''
+        SELECT id, target_shard, payload FROM shard_intents
+        WHERE status = 'pending' AND created_at <= ?
+        ORDER BY id
+        ''', (int(time.time()) - older_than,)).fetchall()
+        return [
+            {'id': row['id'], 'target_shard': row['target_shard'], 'payload': json.loads(row['payload'])}
+            for row in intents
+        ]
+    
+    def get_pending_intent_floor(self) -> Optional[int]:
+        """کوچک‌ترین شناسه intent باز این شارد"""
+        return self.get_connection().execute(
+            "SELECT MIN(id) FROM shard_intents WHERE status = 'pending'"
+        ).fetchone()[0]
+    
+    def prune_intents(self, cutoff: int, floors: List[Optional[int]]):
+        """حذف intent های بسته و رسیدهای قدیمی؛ رسید تا وقتی intent مبدأ باز است لازم است
+        
+        floors[i] خروجی get_pending_intent_floor شارد i است.
+        """
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM shard_intents WHERE status != 'pending' AND settled_at < ?", (cutoff,))
+            for source, floor in enumerate(floors):
+                cursor.execute('''
+                DELETE FROM intent_receipts
+                WHERE source_shard = ? AND created_at < ? AND intent_id < COALESCE(?, intent_id + 1)
+                ''', (source, cutoff, floor))
+    
+    # === صف اعلان‌ها (outbox) ===
+    def _enqueue_notice(self, cursor, chat_id: int, notify: Dict, loot_coins: int, loot_gems: int,
+                        target_coins: int, target_gems: int):
+        """ثبت اعلان هدف با نتیجه تسویه؛ فقط داخل تراکنش تسویه صدا زده می‌شود"""
+        payload = {
+            **notify['payload'], 'loot_coins': loot_coins, 'loot_gems': loot_gems,
+            'target_coins': target_coins, 'target_gems': target_gems
+        }
+        cursor.execute('''
+        INSERT INTO outbox (chat_id, kind, payload) VALUES (?, ?, ?)
+        ''', (chat_id, notify['kind'], json.dumps(payload, ensure_ascii=False)))
+    
+    def get_outbox_batch(self, limit: int = 100) -> Tuple[List[Dict], Set[int]]:
+        """پیام‌های آماده ارسال به ترتیب id و چت‌هایی که پیامی در انتظار تلاش دوباره دارند
+        
+        پیام‌های بعدی چت‌های دسته دوم تا ارسال پیام عقب‌افتاده نگه داشته می‌شوند.
+        """
+        now = int(time.time())
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET last_revenge_time = ? WHERE user_id = ?', 
-                      (int(time.time()), user_id))
-        conn.commit()
-        conn.close()
+        rows = conn.execute('''
+        SELECT id, chat_id, kind, payload, attempts, created_at FROM outbox
+        WHERE next_attempt_at <= ?
+        ORDER BY id
+        LIMIT ?
+        ''', (now, limit)).fetchall()
+        blocked = {
+            row[0] for row in conn.execute(
+                'SELECT DISTINCT chat_id FROM outbox WHERE next_attempt_at > ?', (now,)
+            )
+        }
+        return [dict(row) for row in rows], blocked
+    
+    def ack_outbox(self, delivered: List[int], retries: List[Tuple[int, int, int]]):
+        """حذف پیام‌های ارسال‌شده یا رهاشده و زمان‌بندی دوباره (id, attempts, next_attempt_at) بقیه"""
+        with self.transaction() as cursor:
+            cursor.executemany('DELETE FROM outbox WHERE id = ?', ((message_id,) for message_id in delivered))
+            cursor.executemany('''
+            UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?
+            ''', ((attempts, next_attempt_at, message_id) for message_id, attempts, next_attempt_at in retries))
+    
+    def bulk_grant(self, resources: Dict[str, int], missiles: Optional[Dict[str, int]] = None,
+                   segment: Optional[UserSegment] = None) -> Dict:
+        """هدیه دسته‌ای به یک گروه از کاربران با یک دستور برای هر منبع، در یک تراکنش"""
+        unknown = set(resources) - set(self.GRANT_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown grant columns: {unknown}")
+        where, params = (segment or UserSegment()).where()
+        started = time.perf_counter()
+        with self.transaction() as cursor:
+            self._touch_all()
+            # تعداد کاربران گروه، نه مجموع سطرهای دستورها (هر منبع یک UPDATE جداست)
+            rows = cursor.execute(f'SELECT COUNT(*) FROM users WHERE {where}', params).fetchone()[0]
+            for column, amount in resources.items():
+                cursor.execute(f'UPDATE users SET {column} = {column} + ? WHERE {where}',
+                               (amount, *params))
+            for missile_id, quantity in (missiles or {}).items():
+                self.inventory.grant(cursor, missile_id, quantity, where, params)
+        return {'rows': rows, 'elapsed_ms': (time.perf_counter() - started) * 1000}
+    
+    def create_broadcast_job(self, admin_chat_id: int, text: str, total: int) -> int:
+        """ثبت کار پیام همگانی جدید"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_chat_id, text, total)
+            VALUES (?, ?, ?)
+            ''', (admin_chat_id, text, total))
+            return cursor.lastrowid
+    
+    def set_broadcast_message(self, job_id: int, message_id: int):
+        """ذخیره پیام پیشرفت ادمین برای ویرایش پس از ری‌استارت"""
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?',
+                          (message_id, job_id))
+    
+    def update_broadcast_job(self, job_id: int, cursor_user_id: int, sent: int, failed: int,
+                             status: str = 'running'):
+        """ذخیره پیشرفت کار پیام همگانی"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE broadcast_jobs
+            SET cursor = ?, sent = ?, failed = ?, status = ?, updated_at = ?
+            WHERE id = ?
+            ''', (cursor_user_id, sent, failed, status, int(time.time()), job_id))
+    
+    def get_running_broadcasts(self) -> List[Dict]:
+        """کارهای پیام همگانی نیمه‌تمام"""
+        jobs = self.get_connection().execute(
+            "SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+        ).fetchall()
+        return [dict(job) for job in jobs]
+    
+    def _attach_archive(self, conn):
+        """ATTACH فایل آرشیو روی اتصال جاری - بیرون از تراکنش و یک بار برای هر اتصال"""
+        if any(row[1] == 'archive' for row in conn.execute('PRAGMA database_list')):
+            return
+        os.makedirs(os.path.dirname(self.archive_path) or '.', exist_ok=True)
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        conn.execute('PRAGMA archive.journal_mode = WAL')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.attacks (
+            id INTEGER PRIMARY KEY,
+            attacker_id INTEGER,
+            target_id INTEGER,
+            attack_type TEXT,
+            missile_id INTEGER,
+            damage INTEGER,
+            loot_coins INTEGER,
+            loot_gems INTEGER,
+            can_revenge BOOLEAN,
+            revenge_taken BOOLEAN,
+            timestamp INTEGER
+        )
+        ''')
+        # آرشیوهای قدیمی‌تر نام موشک را نگه می‌داشتند
+        columns = {row[1] for row in conn.execute('PRAGMA archive.table_info(attacks)')}
+        if 'missile_id' not in columns:
+            conn.execute('ALTER TABLE archive.attacks ADD COLUMN missile_id INTEGER')
+    
+    def prune_attacks(self, cutoff: int, batch_size: int = ATTACK_PRUNE_BATCH) -> int:
+        """خلاصه‌سازی، بایگانی و حذف یک دسته از حملات قدیمی‌تر از cutoff
+        
+        هر فراخوانی فقط یک دسته را در یک تراکنش کوتاه پردازش می‌کند تا نوشتن‌های
+        دیگر بین دسته‌ها اجرا شوند. تعداد سطرهای حذف‌شده برمی‌گردد.
+        """
+        if self.archive_path:
+            self._attach_archive(self.get_connection())
+        with self.transaction() as cursor:
+            # شناسه‌ها با زمان بالا می‌روند، پس دسته از ابتدای جدول انتخاب می‌شود
+            last_id, count = cursor.execute('''
+            SELECT MAX(id), COUNT(*) FROM (
+                SELECT id FROM attacks WHERE timestamp < ? ORDER BY id LIMIT ?
+            )
+            ''', (cutoff, batch_size)).fetchone()
+            if not count:
+                return 0
+            batch = (last_id, cutoff)
+            
+            cursor.execute('''
+            INSERT INTO attack_daily_summary (day, user_id, attacks_made, damage_dealt, coins_looted, gems_looted)
+            SELECT timestamp / 86400 * 86400, attacker_id, COUNT(*),
+                   SUM(damage), SUM(COALESCE(loot_coins, 0)), SUM(COALESCE(loot_gems, 0))
+            FROM attacks WHERE id <= ? AND timestamp < ?
+            GROUP BY 1, 2
+            ON CONFLICT(day, user_id) DO UPDATE SET
+                attacks_made = attacks_made + excluded.attacks_made,
+                damage_dealt = damage_dealt + excluded.damage_dealt,
+                coins_looted = coins_looted + excluded.coins_looted,
+                gems_looted = gems_looted + excluded.gems_looted
+            ''', batch)
+            cursor.execute('''
+            INSERT INTO attack_daily_summary (day, user_id, attacks_received, damage_taken, coins_lost, gems_lost)
+            SELECT timestamp / 86400 * 86400, target_id, COUNT(*),
+                   SUM(damage), SUM(COALESCE(loot_coins, 0)), SUM(COALESCE(loot_gems, 0))
+            FROM attacks WHERE id <= ? AND timestamp < ?
+            GROUP BY 1, 2
+            ON CONFLICT(day, user_id) DO UPDATE SET
+                attacks_received = attacks_received + excluded.attacks_received,
+                damage_taken = damage_taken + excluded.damage_taken,
+                coins_lost = coins_lost + excluded.coins_lost,
+                gems_lost = gems_lost + excluded.gems_lost
+            ''', batch)
+            
+            if self.archive_path:
+                # OR IGNORE: اگر فقط commit آرشیو انجام شده باشد، تکرار دسته بی‌خطر است
+                cursor.execute('''
+                INSERT OR IGNORE INTO archive.attacks
+                    (id, attacker_id, target_id, attack_type, missile_id, damage,
+                     loot_coins, loot_gems, can_revenge, revenge_taken, timestamp)
+                SELECT id, attacker_id, target_id, attack_type, missile_id, damage,
+                       loot_coins, loot_gems, can_revenge, revenge_taken, timestamp
+                FROM main.attacks WHERE id <= ? AND timestamp < ?
+                ''', batch)
+            
+            cursor.execute('DELETE FROM attacks WHERE id <= ? AND timestamp < ?', batch)
+            return cursor.rowcount
+    
+    def get_admin_stats(self):
+        """آمار کلی ربات برای پنل ادمین - همه تجمیع‌های کاربران در یک پیمایش جدول"""
+        conn = self.get_connection()
+        today = int(time.time()) - 86400
+        row = conn.execute('''
+        SELECT COUNT(*), SUM(zone_coin), SUM(zone_gem), SUM(zone_point), AVG(level),
+               SUM(created_at > ?)
+        FROM users
+        ''', (today,)).fetchone()
+        stats = {
+            'total_users': row[0],
+            'total_coins': row[1] or 0,
+            'total_gems': row[2] or 0,
+            'total_zp': row[3] or 0,
+            'avg_level': row[4] or 0,
+            'today_users': row[5] or 0,
+            # حملات بایگانی‌شده فقط در خلاصه روزانه شمرده می‌شوند
+            'total_attacks': conn.execute('''
+                SELECT (SELECT COUNT(*) FROM attacks) +
+                       (SELECT COALESCE(SUM(attacks_made), 0) FROM attack_daily_summary)
+            ''').fetchone()[0]
+        }
+        
+        # از ایندکس idx_users_created_at خوانده می‌شود
+        stats['recent_users'] = self._query_players('''
+        SELECT user_id, username, full_name, created_at 
+        FROM users 
+        ORDER BY created_at DESC 
+        LIMIT 5
+        ''')
+        return stats
 
-# === راه‌اندازی دیتابیس ===
-db = Database()
+# === دیتابیس شاردشده ===
+class MergedLeaderboard:
+    """top-K سراسری ساخته‌شده از top-K شاردها
 
-# === داده‌های بازی ===
-MISSILE_DATA = {
-    # موشک‌های معمولی
-    'شبح': {'damage': 25, 'price': 20, 'min_level': 1, 'type': 'normal'},
-    'رعد': {'damage': 35, 'price': 50, 'min_level': 2, 'type': 'normal'},
-    'تندر': {'damage': 45, 'price': 100, 'min_level': 3, 'type': 'normal'},
-    'هاوک': {'damage': 55, 'price': 200, 'min_level': 4, 'type': 'normal'},
-    'پاتریوت': {'damage': 65, 'price': 500, 'min_level': 5, 'type': 'normal'},
+    هر عضو top-K سراسری حتماً در top-K شارد خودش هم هست، پس ادغام top-K شاردها
+    کافی است. تا وقتی version هیچ شاردی تغییر نکرده نتیجه دوباره ساخته نمی‌شود.
+    """
+
+    def __init__(self, boards: List[Leaderboard]):
+        self.boards = boards
+        self.size = boards[0].size
+        self.key = boards[0].key
+        self.lock = threading.Lock()
+        self._versions = None
+        self._top: Tuple[Player, ...] = ()
+        self._text = None
+        self._text_versions = None
+
+    def _merge(self) -> tuple:
+        versions = tuple(board.version for board in self.boards)
+        if versions != self._versions:
+            players = [player for board in self.boards for player in board.top()]
+            self._top = tuple(heapq.nlargest(self.size, players, key=self.key))
+            self._versions = versions
+        return versions
+
+    def top(self) -> Tuple[Player, ...]:
+        with self.lock:
+            self._merge()
+            return self._top
+
+    def render(self, renderer) -> str:
+        with self.lock:
+            versions = self._merge()
+            if self._text_versions != versions:
+                self._text = renderer(self._top)
+                self._text_versions = versions
+            return self._text
+
+class ShardedDatabase:
+    """چند فایل SQLite که کاربران بر اساس user_id % N بین آن‌ها تقسیم شده‌اند
+
+    هر شارد یک Database کامل است (کش، بافر write-behind، top-K و مایگریشن خودش).
+    users، موجودی موشک‌ها و حملاتی که کاربر انجام داده در شارد همان کاربر هستند و
+    شناسه سراسری حمله local_id * N + shard است تا شارد از روی خود شناسه معلوم باشد.
+    کارهای پیام همگانی فقط در شارد ۰ نگه داشته می‌شوند. کارهایی که به چند شارد
+    می‌نویسند مراحل (*_steps) برمی‌گردانند تا هر شارد فقط از thread نویسنده خودش نوشته شود.
+    """
+
+    # متدهایی که کاملاً در شارد یک کاربر اجرا می‌شوند: نام متد -> پارامتر کاربر
+    USER_METHODS = {
+        'register_user': 'user_id', 'get_user': 'user_id', 'get_user_missiles': 'user_id',
+        'update_user_coins': 'user_id', 'update_user_gems': 'user_id', 'update_user_zp': 'user_id',
+        'add_xp': 'user_id', 'update_fighter_level': 'user_id', 'add_missile': 'user_id',
+        'claim_miner': 'user_id', 'upgrade_miner': 'user_id', 'upgrade_defense': 'user_id',
+        'upgrade_fighter': 'user_id', 'buy_missile': 'user_id', 'open_box': 'user_id',
+        'set_user_level': 'user_id', 'update_last_revenge_time': 'user_id'
+    }
+    # در شارد مهاجم اجرا می‌شوند ولی شناسه حمله را ترجمه می‌کنند
+    ATTACKER_METHODS = {
+        'record_attack': 'attacker_id', 'get_last_attack': 'attacker_id'
+    }
+    META_METHODS = frozenset({
+        'create_broadcast_job', 'set_broadcast_message', 'update_broadcast_job', 'get_running_broadcasts'
+    })
+    # intent بازِ قدیمی‌تر از این، رهاشده (مثلاً به خاطر خطا) حساب و دوباره اجرا می‌شود
+    INTENT_RECOVERY_SECONDS = 60
+
+    def __init__(self, count: int, db_path: str = 'app/data/warzone.db',
+                 archive_path: str = ATTACK_ARCHIVE_PATH, **options):
+        base, ext = os.path.splitext(db_path)
+        archive_base, archive_ext = os.path.splitext(archive_path)
+        paths = [f'{base}.shard{index}{ext}' for index in range(count)]
+        existing = [os.path.exists(path) for path in paths]
+        if (any(existing) and not all(existing)) or os.path.exists(f'{base}.shard{count}{ext}'):
+            raise RuntimeError("تعداد شاردها (DB_SHARDS) تغییر کرده است؛ جابه‌جایی کاربران بین شاردها پشتیبانی نمی‌شود")
+        
+        self.count = count
+        self.shards = tuple(
+            Database(
+                path,
+                archive_path=f'{archive_base}.shard{index}{archive_ext}' if archive_path else '',
+                **options
+            )
+            for index, path in enumerate(paths)
+        )
+        if not any(existing) and os.path.exists(db_path):
+            self._import_unsharded(db_path)
+        self.leaderboards = {
+            name: MergedLeaderboard([shard.leaderboards[name] for shard in self.shards])
+            for name in LEADERBOARD_COLUMNS
+        }
+        self.recover_intents()
+    
+    def _import_unsharded(self, path: str):
+        """انتقال یک‌باره داده‌های دیتابیس تک‌فایلی به شاردهای تازه ساخته‌شده
+        
+        فایل قدیمی تغییر نمی‌کند: یک کپی از آن مایگریت و به چیدمان موجودی شاردها برده
+        می‌شود و داده‌ها از کپی خوانده می‌شوند.
+        """
+        started = time.perf_counter()
+        snapshot = f'{path}.import'
+        # backup محتوای WAL را هم می‌آورد
+        source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        target = sqlite3.connect(snapshot)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        try:
+            Database(snapshot, write_behind=False, archive_path='',
+                     inventory_layout=self.shards[0].inventory.name).close()
+            users = self._copy_legacy(snapshot)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(snapshot + suffix):
+                    os.remove(snapshot + suffix)
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"🧱 Imported {users} users from {path} into {self.count} shards ({elapsed:.0f} ms)")
+    
+    def _copy_legacy(self, path: str) -> int:
+        """کپی سطرهای هر شارد از دیتابیس تک‌فایلیِ مایگریت‌شده؛ خروجی تعداد کاربران"""
+        users = 0
+        for index, shard in enumerate(self.shards):
+            conn = shard.get_connection()
+            conn.execute('ATTACH DATABASE ? AS legacy', (path,))
+            try:
+                with shard.transaction() as cursor:
+                    shard._touch_all()
+                    for table in ('users', 'user_missiles', 'user_inventory', 'attack_daily_summary'):
+                        columns = ', '.join(row[1] for row in cursor.execute(f'PRAGMA main.table_info({table})'))
+                        cursor.execute(f'''
+                        INSERT OR IGNORE INTO main.{table} ({columns})
+                        SELECT {columns} FROM legacy.{table} WHERE user_id % ? = ?
+                        ''', (self.count, index))
+                    users += cursor.execute('SELECT COUNT(*) FROM main.users').fetchone()[0]
+                    
+                    # شناسه‌های جدید بالاتر از همه شناسه‌های قدیمی شروع می‌شوند تا دکمه‌های
+                    # انتقامِ پیش از شاردبندی به حمله دیگری نرسند
+                    last_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM legacy.attacks').fetchone()[0]
+                    cursor.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES ('attacks', ?)", (last_id,))
+                    columns = ', '.join(
+                        row[1] for row in cursor.execute('PRAGMA main.table_info(attacks)') if row[1] != 'id'
+                    )
+                    cursor.execute(f'''
+                    INSERT INTO main.attacks ({columns})
+                    SELECT {columns} FROM legacy.attacks WHERE attacker_id % ? = ? ORDER BY id
+                    ''', (self.count, index))
+                    
+                    if index == 0:
+                        cursor.execute('INSERT INTO main.broadcast_jobs SELECT * FROM legacy.broadcast_jobs')
+                        # اعلان‌های ارسال‌نشده به ترتیب قبلی؛ OutboxDispatcher همه شاردها را می‌خواند.
+                        # payload ها فقط شناسه کاربر دارند (دکمه انتقام rv:<attacker_id> است)، پس
+                        # شماره‌گذاری دوباره حملات روی آن‌ها اثری ندارد
+                        cursor.execute('''
+                        INSERT INTO main.outbox (chat_id, kind, payload, attempts, next_attempt_at, created_at)
+                        SELECT chat_id, kind, payload, attempts, next_attempt_at, created_at
+                        FROM legacy.outbox ORDER BY id
+                        ''')
+            finally:
+                conn.execute('DETACH DATABASE legacy')
+        return users
+    
+    # === مسیریابی ===
+    def shard_index(self, user_id: int) -> int:
+        return user_id % self.count
+    
+    def _global_id(self, index: int, local_id: Optional[int]) -> Optional[int]:
+        return None if local_id is None else local_id * self.count + index
+    
+    def _split_id(self, attack_id: int) -> Tuple[int, int]:
+        """(شارد، شناسه محلی) یک شناسه سراسری حمله"""
+        return attack_id % self.count, attack_id // self.count
+    
+    def _global_attack(self, index: int, attack: Optional[Dict]) -> Optional[Dict]:
+        if attack is not None:
+            attack['id'] = self._global_id(index, attack['id'])
+        return attack
+    
+    def route(self, name: str, args: tuple, kwargs: dict) -> int:
+        param = self.USER_METHODS.get(name) or self.ATTACKER_METHODS.get(name)
+        if param is not None:
+            return self.shard_index(args[0] if args else kwargs[param])
+        if name == 'mark_revenge_taken':
+            return self._split_id(args[0] if args else kwargs['attack_id'])[0]
+        # کارهای پیام همگانی در شارد ۰ هستند؛ کارهای چندشاردی مسیر *_steps را دارند
+        return 0
+    
+    def __getattr__(self, name):
+        param = self.USER_METHODS.get(name)
+        if param is not None:
+            def call(*args, **kwargs):
+                user_id = args[0] if args else kwargs[param]
+                return getattr(self.shards[self.shard_index(user_id)], name)(*args, **kwargs)
+            call.__name__ = name
+        elif name in self.META_METHODS:
+            call = getattr(self.shards[0], name)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, call)
+        return call
+    
+    # === حملات ===
+    def record_attack(self, attacker_id: int, target_id: int, missile_id: int, damage: int,
+                      loot_coins: int, loot_gems: int):
+        index = self.shard_index(attacker_id)
+        attack_id = self.shards[index].record_attack(attacker_id, target_id, missile_id,
+                                                     damage, loot_coins, loot_gems)
+        return self._global_id(index, attack_id)
     
-    # موشک‌های ویژه
-    'شهاب': {'damage': 125, 'price': 2500, 'min_level': 6, 'type': 'special', 'gem_cost': 1},
-    'سیل': {'damage': 150, 'price': 3000, 'min_level': 7, 'type': 'special', 'gem_cost': 2},
-    'توفان': {'damage': 175, 'price': 3500, 'min_level': 8, 'type': 'special', 'gem_cost': 3},
-    'تایفون': {'damage': 200, 'price': 4000, 'min_level': 9, 'type': 'special', 'gem_cost': 4},
-    'آپوکالیپس': {'damage': 250, 'price': 5000, 'min_level': 10, 'type': 'special', 'gem_cost': 5}
-}
+    def get_recent_attacks_on_user(self, user_id: int, limit=5):
+        """حملات روی کاربر در شارد مهاجم‌ها ثبت شده‌اند، پس از همه شاردها خوانده می‌شوند"""
+        attacks = [
+            self._global_attack(index, attack)
+            for index, shard in enumerate(self.shards)
+            for attack in shard.get_recent_attacks_on_user(user_id, limit)
+        ]
+        return heapq.nlargest(limit, attacks, key=lambda attack: attack['timestamp'])
+    
+    def get_revengeable_attack(self, attack_id: int):
+        index, local_id = self._split_id(attack_id)
+        return self._global_attack(index, self.shards[index].get_revengeable_attack(local_id))
+    
+    def get_last_attack(self, attacker_id: int, target_id: int):
+        index = self.shard_index(attacker_id)
+        return self._global_attack(index, self.shards[index].get_last_attack(attacker_id, target_id))
+    
+    def mark_revenge_taken(self, attack_id: int):
+        index, local_id = self._split_id(attack_id)
+        self.shards[index].mark_revenge_taken(local_id)
+    
+    def settle_steps(self, attacker_id: int, target_id: int, missile_id: int, damage: int,
+                     xp_gained: int, gem_cost: int = 0, loot_rate: float = 0.10,
+                     loot_cap: int = 1000, gem_loot_rate: float = 0.05, gem_loot_cap: int = 5,
+                     revenge_of: Optional[int] = None, notify: Optional[Dict] = None) -> Steps:
+        """مثل Database.settle_attack؛ اگر مهاجم و هدف در دو شارد باشند با intent دو مرحله‌ای
+
+        هر مرحله فقط روی یک شارد می‌نویسد و در صف نویسنده همان شارد اجرا می‌شود.
+        اعلان هدف در تراکنش آخر (شارد مهاجم) در outbox همان شارد نوشته می‌شود.
+        """
+        source = self.shard_index(attacker_id)
+        target = self.shard_index(target_id)
+        if revenge_of is not None:
+            # حمله اصلی را هدف انجام داده، پس در شارد هدف ثبت شده است
+            revenge_shard, revenge_of = self._split_id(revenge_of)
+            if revenge_shard != target:
+                return {'status': 'revenge_taken'}
+        
+        if source == target:
+            result = yield source, functools.partial(
+                self.shards[source].settle_attack,
+                attacker_id, target_id, missile_id, damage, xp_gained, gem_cost,
+                loot_rate, loot_cap, gem_loot_rate, gem_loot_cap, revenge_of, notify
+            )
+            if result['status'] == 'ok':
+                result['attack_id'] = self._global_id(source, result['attack_id'])
+            return result
+        
+        payload = {
+            'attacker_id': attacker_id, 'target_id': target_id, 'missile_id': missile_id,
+            'damage': damage, 'xp_gained': xp_gained, 'gem_cost': gem_cost,
+            'loot_rate': loot_rate, 'loot_cap': loot_cap, 'gem_loot_rate': gem_loot_rate,
+            'gem_loot_cap': gem_loot_cap, 'revenge_of': revenge_of, 'notify': notify
+        }
+        opened = yield source, functools.partial(self.shards[source].open_attack_intent, target, payload)
+        if opened['status'] != 'pending':
+            return opened
+        outcome = yield target, functools.partial(
+            self.shards[target].apply_attack_intent, source, opened['intent_id'], payload
+        )
+        result = yield source, functools.partial(
+            self.shards[source].close_attack_intent, opened['intent_id'], outcome
+        )
+        if result['status'] != 'ok':
+            return result
+        return {
+            **result,
+            'attack_id': self._global_id(source, result['attack_id']),
+            'loot_coins': outcome['loot_coins'],
+            'loot_gems': outcome['loot_gems'],
+            'target_coins': outcome['target_coins'],
+            'target_gems': outcome['target_gems']
+        }
+    
+    def settle_attack(self, *args, **kwargs):
+        return run_steps(self.settle_steps(*args, **kwargs))
+    
+    def recover_steps(self, older_than: int = 0) -> Steps:
+        """اجرای دوباره مراحل ۲ و ۳ برای intent هایی که نیمه‌کاره مانده‌اند"""
+        pending = yield [
+            (index, functools.partial(shard.get_pending_intents, older_than))
+            for index, shard in enumerate(self.shards)
+        ]
+        recovered = 0
+        for index, intents in enumerate(pending):
+            for intent in intents:
+                target = intent['target_shard']
+                outcome = yield target, functools.partial(
+                    self.shards[target].apply_attack_intent, index, intent['id'], intent['payload']
+                )
+                yield index, functools.partial(self.shards[index].close_attack_intent, intent['id'], outcome)
+                recovered += 1
+        if recovered:
+            logger.info(f"🔁 Recovered {recovered} pending cross-shard settlements")
+        return recovered
+    
+    def recover_intents(self, older_than: int = 0) -> int:
+        return run_steps(self.recover_steps(older_than))
+    
+    def prune_steps(self, cutoff: int, batch_size: int = ATTACK_PRUNE_BATCH) -> Steps:
+        """یک دسته از هر شارد؛ مجموع کمتر از batch_size یعنی همه شاردها تمام شده‌اند"""
+        pruned = yield [
+            (index, functools.partial(shard.prune_attacks, cutoff, batch_size))
+            for index, shard in enumerate(self.shards)
+        ]
+        yield from self.recover_steps(self.INTENT_RECOVERY_SECONDS)
+        floors = yield [(index, shard.get_pending_intent_floor) for index, shard in enumerate(self.shards)]
+        yield [
+            (index, functools.partial(shard.prune_intents, cutoff, floors))
+            for index, shard in enumerate(self.shards)
+        ]
+        return sum(pruned)
+    
+    def prune_attacks(self, cutoff: int, batch_size: int = ATTACK_PRUNE_BATCH) -> int:
+        return run_steps(self.prune_steps(cutoff, batch_size))
+    
+    # === کاربران و تجمیع‌ها ===
+    def get_users_page(self, after_user_id: int = 0, limit: int = USER_PAGE_SIZE,
+                       segment: Optional[UserSegment] = None) -> List[Player]:
+        """ادغام صفحه‌های مرتب شاردها روی user_id"""
+        pages = [shard.get_users_page(after_user_id, limit, segment) for shard in self.shards]
+        return list(itertools.islice(heapq.merge(*pages, key=lambda player: player.user_id), limit))
+    
+    def count_users(self, segment: Optional[UserSegment] = None) -> int:
+        return sum(shard.count_users(segment) for shard in self.shards)
+    
+    def bulk_grant_steps(self, resources: Dict[str, int], missiles: Optional[Dict[str, int]] = None,
+                         segment: Optional[UserSegment] = None) -> Steps:
+        """هدیه در همه شاردها، هر شارد در صف نویسنده خودش"""
+        started = time.perf_counter()
+        results = yield [
+            (index, functools.partial(shard.bulk_grant, resources, missiles, segment))
+            for index, shard in enumerate(self.shards)
+        ]
+        rows = sum(result['rows'] for result in results)
+        return {'rows': rows, 'elapsed_ms': (time.perf_counter() - started) * 1000}
+    
+    def bulk_grant(self, *args, **kwargs) -> Dict:
+        return run_steps(self.bulk_grant_steps(*args, **kwargs))
+    
+    def get_admin_stats(self):
+        parts = [shard.get_admin_stats() for shard in self.shards]
+        stats = {
+            name: sum(part[name] for part in parts)
+            for name in ('total_users', 'total_coins', 'total_gems', 'total_zp', 'today_users', 'total_attacks')
+        }
+        stats['avg_level'] = (
+            sum(part['avg_level'] * part['total_users'] for part in parts) / stats['total_users']
+            if stats['total_users'] else 0
+        )
+        stats['recent_users'] = heapq.nlargest(
+            5, (user for part in parts for user in part['recent_users']), key=lambda user: user.created_at
+        )
+        return stats
+    
+    def cache_stats(self) -> Dict[str, float]:
+        parts = [shard.cache_stats() for shard in self.shards]
+        stats = {name: sum(part[name] for part in parts) for name in ('size', 'capacity', 'hits', 'misses')}
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+    
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+    
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+# === دسترسی غیرهمزمان به دیتابیس ===
+class AsyncDatabase:
+    """نمای async روی Database؛ نوشتن‌ها در thread نویسنده هر شارد و خواندن‌ها در executor"""
 
+    READ_METHODS = frozenset({
+        'get_user', 'get_user_missiles', 'get_users_page', 'count_users',
+        'get_recent_attacks_on_user', 'get_revengeable_attack', 'get_last_attack',
+        'get_admin_stats', 'get_running_broadcasts'
+    })
+    WRITE_METHODS = frozenset({
+        'register_user', 'update_user_coins', 'update_user_gems', 'update_user_zp',
+        'add_xp', 'update_fighter_level', 'add_missile', 'claim_miner',
+        'upgrade_miner', 'upgrade_defense', 'upgrade_fighter', 'buy_missile', 'open_box',
+        'set_user_level', 'record_attack',
+        'mark_revenge_taken', 'update_last_revenge_time',
+        'create_broadcast_job', 'set_broadcast_message', 'update_broadcast_job'
+    })
+
+    def __init__(self, database, read_workers: int = DB_READ_WORKERS):
+        self.sync = database
+        self._writes = [queue.SimpleQueue() for _ in database.shards]
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader')
+        self._writers = [
+            threading.Thread(target=self._writer_loop, args=(index,), name=f'db-writer-{index}', daemon=True)
+            for index in range(len(database.shards))
+        ]
+        for writer in self._writers:
+            writer.start()
+
+    def _writer_loop(self, index: int):
+        """تنها thread نویسنده شارد index؛ کارها به ترتیب ورود اجرا می‌شوند"""
+        shard = self.sync.shards[index]
+        writes = self._writes[index]
+        while True:
+            try:
+                job = writes.get(timeout=self._flush_timeout(shard))
+            except queue.Empty:
+                self._flush(shard)
+                continue
+            if job is None:
+                break
+            func, args, kwargs, future = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            if shard.flush_due():
+                self._flush(shard)
+        self._flush(shard)
+
+    def _flush_timeout(self, shard: Database) -> Optional[float]:
+        """مدت انتظار تا flush بعدی در حالت write-behind"""
+        pending = shard.pending
+        if pending is None or not pending.ops:
+            return None
+        return max(shard.flush_interval - (time.monotonic() - pending.first_op_at), 0)
+
+    def _flush(self, shard: Database):
+        try:
+            shard.flush()
+        except Exception as e:
+            logger.error(f"Write-behind flush error: {e}")
+
+    async def write(self, func, *args, shard: int = 0, **kwargs):
+        """اجرای یک تابع نوشتنی در صف thread نویسنده یک شارد"""
+        future = concurrent.futures.Future()
+        self._writes[shard].put((func, args, kwargs, future))
+        return await asyncio.wrap_future(future)
+
+    async def read(self, func, *args, **kwargs):
+        """اجرای یک تابع خواندنی در executor خواننده‌ها"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(func, *args, **kwargs))
+
+    async def run_steps(self, steps: Steps):
+        """اجرای یک کار چندشاردی؛ هر مرحله در صف نویسنده شارد خودش و مراحل یک فهرست هم‌زمان"""
+        try:
+            step = next(steps)
+            while True:
+                if isinstance(step, list):
+                    result = await asyncio.gather(*(self.write(func, shard=shard) for shard, func in step))
+                else:
+                    shard, func = step
+                    result = await self.write(func, shard=shard)
+                step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def settle_attack(self, *args, **kwargs) -> Dict:
+        return await self.run_steps(self.sync.settle_steps(*args, **kwargs))
+
+    async def prune_attacks(self, cutoff: int, batch_size: int = ATTACK_PRUNE_BATCH) -> int:
+        return await self.run_steps(self.sync.prune_steps(cutoff, batch_size))
+
+    async def bulk_grant(self, *args, **kwargs) -> Dict:
+        return await self.run_steps(self.sync.bulk_grant_steps(*args, **kwargs))
+
+    async def flush(self):
+        """flush بافر write-behind هر شارد در thread نویسنده خودش"""
+        await asyncio.gather(*(
+            self.write(shard.flush, shard=index) for index, shard in enumerate(self.sync.shards)
+        ))
+
+    async def iter_users(self, page_size: int = USER_PAGE_SIZE, segment: Optional[UserSegment] = None,
+                         after_user_id: int = 0) -> AsyncIterator[Player]:
+        """پیمایش کاربران بعد از after_user_id صفحه به صفحه بدون نگه داشتن کل لیست در حافظه
+
+        صفحه بعد هم‌زمان با مصرف صفحه فعلی خوانده می‌شود.
+        """
+        next_page = asyncio.ensure_future(
+            self.read(self.sync.get_users_page, after_user_id, page_size, segment)
+        )
+        try:
+            while True:
+                page = await next_page
+                if len(page) == page_size:
+                    next_page = asyncio.ensure_future(
+                        self.read(self.sync.get_users_page, page[-1].user_id, page_size, segment)
+                    )
+                for user in page:
+                    yield user
+                if len(page) < page_size:
+                    return
+        finally:
+            next_page.cancel()
+
+    def __getattr__(self, name):
+        if name in self.WRITE_METHODS:
+            method = getattr(self.sync, name)
+
+            async def call(*args, **kwargs):
+                shard = self.sync.route(name, args, kwargs)
+                return await self.write(method, *args, shard=shard, **kwargs)
+        elif name in self.READ_METHODS:
+            method = getattr(self.sync, name)
+
+            async def call(*args, **kwargs):
+                return await self.read(method, *args, **kwargs)
+        else:
+            raise AttributeError(name)
+
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+
+    async def close(self):
+        """تخلیه صف نوشتن، flush تغییرات بافرشده و بستن اتصال‌ها"""
+        for writes in self._writes:
+            writes.put(None)
+        for writer in self._writers:
+            await asyncio.to_thread(writer.join)
+        self._readers.shutdown(wait=True)
+        self.sync.close()
+
+# === راه‌اندازی دیتابیس ===
+database = ShardedDatabase(DB_SHARDS) if DB_SHARDS > 1 else Database()
+db = AsyncDatabase(database)
+broadcasts = BroadcastEngine(
+    bot, db,
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    page_size=BROADCAST_PAGE_SIZE,
+    progress_interval=BROADCAST_PROGRESS_SECONDS
+)
+# رندرکننده‌ها پایین‌تر کنار هندلرهای حمله تعریف شده‌اند و هنگام ارسال صدا زده می‌شوند
+outbox = OutboxDispatcher(
+    bot, db,
+    renderers={
+        'attack': lambda payload: render_attack_notice(payload),
+        'revenge': lambda payload: render_revenge_notice(payload)
+    },
+    bucket=broadcasts.bucket,
+    batch_size=OUTBOX_BATCH_SIZE,
+    concurrency=OUTBOX_CONCURRENCY,
+    poll_interval=OUTBOX_POLL_SECONDS,
+    max_attempts=OUTBOX_MAX_ATTEMPTS
+)
+
+# === آمار ادمین ===
+class AdminStatsSnapshot:
+    """آخرین آمار ادمین که در پس‌زمینه به‌روز می‌شود؛ دکمه آمار فقط همین را می‌خواند"""
+
+    def __init__(self, db: AsyncDatabase, refresh_seconds: int = ADMIN_STATS_REFRESH_SECONDS):
+        self.db = db
+        self.refresh_seconds = refresh_seconds
+        self.stats: Optional[Dict] = None
+        self.taken_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> Dict:
+        # درخواست‌های هم‌زمان منتظر همان یک محاسبه می‌مانند
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._compute())
+        return await asyncio.shield(self._refreshing)
+
+    async def _compute(self) -> Dict:
+        self.stats = await self.db.get_admin_stats()
+        self.taken_at = time.time()
+        return self.stats
+
+    async def get(self) -> Tuple[Dict, float]:
+        """(آمار، عمر snapshot به ثانیه)؛ فقط بار اول منتظر محاسبه می‌ماند"""
+        if self.stats is None:
+            await self.refresh()
+        return self.stats, time.time() - self.taken_at
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Admin stats refresh error: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+admin_stats = AdminStatsSnapshot(db)
+
+# === داده‌های بازی ===
 MINER_LEVELS = {
     1: {'zp_per_hour': 50, 'upgrade_cost': 50},
     2: {'zp_per_hour': 100, 'upgrade_cost': 100},
@@ -387,9 +2386,17 @@ FIGHTER_LEVELS = {
     10: {'damage_bonus': 0.50, 'defense_bonus': 0.20, 'upgrade_cost': 5000}
 }
 
-# === توابع کمکی ===
-def create_main_keyboard():
-    keyboard = ReplyKeyboardMarkup(
+# === کیبوردهای ثابت ===
+# یک بار در شروع ساخته می‌شوند و همه هندلرها همین اشیا را می‌فرستند
+def buy_button(missile_name: str) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=missile_name, callback_data=routes.pack('buy', MISSILE_IDS[missile_name]))
+
+def build_static_keyboards():
+    back_row = [InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))]
+    normal = [name for name, data in MISSILE_DATA.items() if data['type'] == 'normal']
+    special = [name for name, data in MISSILE_DATA.items() if data['type'] == 'special']
+
+    screens.register('main', ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="👤 پروفایل"), KeyboardButton(text="⚔️ حمله")],
             [KeyboardButton(text="🏪 بازار"), KeyboardButton(text="🎁 باکس")],
@@ -399,22 +2406,81 @@ def create_main_keyboard():
         ],
         resize_keyboard=True,
         input_field_placeholder="انتخاب کنید..."
-    )
-    return keyboard
+    ))
 
-def create_admin_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👑 پنل ادمین")],
-            [KeyboardButton(text="📊 آمار کامل"), KeyboardButton(text="📢 پیام همگانی")],
-            [KeyboardButton(text="🎁 هدیه همگانی"), KeyboardButton(text="➕ سکه")],
-            [KeyboardButton(text="💎 جم"), KeyboardButton(text="⚡ ZP")],
-            [KeyboardButton(text="📈 تغییر لول"), KeyboardButton(text="🔙 بازگشت")]
-        ],
+    admin_rows = [
+        [KeyboardButton(text="📊 آمار کامل"), KeyboardButton(text="📢 پیام همگانی")],
+        [KeyboardButton(text="🎁 هدیه همگانی"), KeyboardButton(text="➕ سکه")],
+        [KeyboardButton(text="💎 جم"), KeyboardButton(text="⚡ ZP")],
+        [KeyboardButton(text="📈 تغییر لول"), KeyboardButton(text="🔙 بازگشت")]
+    ]
+    screens.register('admin', ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="👑 پنل ادمین")], *admin_rows],
         resize_keyboard=True,
         input_field_placeholder="دستور ادمین..."
-    )
-    return keyboard
+    ))
+    screens.register('admin_panel', ReplyKeyboardMarkup(keyboard=admin_rows, resize_keyboard=True))
+
+    # بازار: موشک‌ها دو به دو و دکمه جابه‌جایی در کنار آخرین موشک
+    normal_rows = [
+        [buy_button(normal[0]), buy_button(normal[1])],
+        [buy_button(normal[2]), buy_button(normal[3])],
+        [buy_button(normal[4]), InlineKeyboardButton(text="⏩ ویژه", callback_data=routes.pack('market_special'))]
+    ]
+    screens.register('market', InlineKeyboardMarkup(inline_keyboard=[*normal_rows, back_row]))
+    screens.register('market_normal', InlineKeyboardMarkup(inline_keyboard=normal_rows))
+    screens.register('market_special', InlineKeyboardMarkup(inline_keyboard=[
+        [buy_button(special[0]), buy_button(special[1])],
+        [buy_button(special[2]), buy_button(special[3])],
+        [buy_button(special[4]), InlineKeyboardButton(text="⏪ معمولی", callback_data=routes.pack('market_normal'))]
+    ]))
+
+    screens.register('boxes', InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🎁 باکس سکه (50 سکه)", callback_data=routes.pack('box', 'coin')),
+            InlineKeyboardButton(text="🎁 باکس ZP (100 سکه)", callback_data=routes.pack('box', 'zp'))
+        ],
+        [
+            InlineKeyboardButton(text="💎 باکس ویژه (2 جم)", callback_data=routes.pack('box', 'special')),
+            InlineKeyboardButton(text="👑 باکس افسانه‌ای (5 جم)", callback_data=routes.pack('box', 'legendary'))
+        ],
+        [
+            InlineKeyboardButton(text="🆓 باکس رایگان", callback_data=routes.pack('box', 'free')),
+            InlineKeyboardButton(text="📦 موجودی", callback_data=routes.pack('box_inventory'))
+        ],
+        back_row
+    ]))
+
+build_static_keyboards()
+
+def missile_picker(missiles: Inventory, action: str, *args, limit: Optional[int] = None,
+                   back: bool = True) -> InlineKeyboardMarkup:
+    """کیبورد انتخاب موشک؛ برای هر شکل موجودی (تعدادها + callback) یک بار ساخته می‌شود"""
+    def build():
+        items = list(missiles.with_ids())[:limit]
+        keyboard_buttons = [
+            [
+                InlineKeyboardButton(
+                    text=f"{missile_name} ({quantity})",
+                    callback_data=routes.pack(action, *args, missile_id)
+                )
+                for missile_id, missile_name, quantity in items[i:i + 2]
+            ]
+            for i in range(0, len(items), 2)
+        ]
+        if back:
+            keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))])
+        return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+    key = (action, args, limit, back, missiles.counts.tobytes())
+    return screens.picker(key, build)
+
+# === توابع کمکی ===
+def create_main_keyboard():
+    return screens['main']
+
+def create_admin_keyboard():
+    return screens['admin']
 
 def is_admin(user_id: int):
     """بررسی ادمین بودن کاربر"""
@@ -428,7 +2494,7 @@ async def cmd_start(message: Message):
     full_name = message.from_user.full_name
     
     # ثبت کاربر
-    db.register_user(user_id, username, full_name)
+    await db.register_user(user_id, username, full_name)
     
     welcome_text = f"""
 🚀 <b>به جنگ‌افزار خوش آمدید {full_name}!</b>
@@ -456,73 +2522,73 @@ async def cmd_start(message: Message):
     
     await message.answer(welcome_text, reply_markup=create_main_keyboard())
 
-@dp.message(F.text == "👤 پروفایل")
+@routes.text("👤 پروفایل")
 async def cmd_profile(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # محاسبه ZP قابل دریافت از ماینر (همیشه)
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
-        zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
+    if user.last_miner_claim:
+        time_passed = int(time.time()) - user.last_miner_claim
+        zp_per_hour = MINER_LEVELS[user.miner_level]['zp_per_hour']
         miner_zp = int((time_passed / 3600) * zp_per_hour)
     else:
         miner_zp = 0
     
     # دریافت موشک‌ها
-    missiles = db.get_user_missiles(user_id)
+    missiles = await db.get_user_missiles(user_id)
     missiles_text = ""
     if missiles:
-        for missile in missiles[:5]:
-            missiles_text += f"• {missile['missile_name']}: {missile['quantity']}\n"
+        for missile_name, quantity in list(missiles)[:5]:
+            missiles_text += f"• {missile_name}: {quantity}\n"
         if len(missiles) > 5:
             missiles_text += f"• و {len(missiles) - 5} موشک دیگر...\n"
     
     profile_text = f"""
 📊 <b>پروفایل جنگ‌افزار</b>
 ━━━━━━━━━━━━━━
-👤 نام: {user['full_name']}
-🆔 آیدی: {user['user_id']}
-🎯 لول: {user['level']}
-⭐ XP: {user['xp']}/{user['level'] * 100}
+👤 نام: {user.full_name}
+🆔 آیدی: {user.user_id}
+🎯 لول: {user.level}
+⭐ XP: {user.xp}/{user.level * 100}
 ━━━━━━━━━━━━━━
-💰 سکه: {user['zone_coin']}
-💎 جم: {user['zone_gem']}
-⚡ امتیاز: {user['zone_point']} ZP
+💰 سکه: {user.zone_coin}
+💎 جم: {user.zone_gem}
+⚡ امتیاز: {user.zone_point} ZP
 ━━━━━━━━━━━━━━
-⛏️ ماینر: لول {user['miner_level']}
+⛏️ ماینر: لول {user.miner_level}
 📦 ZP قابل دریافت: {miner_zp}
 ━━━━━━━━━━━━━━
 💣 موشک‌ها:
 {missiles_text if missiles_text else "• هیچ موشکی ندارید!"}
 ━━━━━━━━━━━━━━
-✈️ جنگنده: لول {user['fighter_level']}
+✈️ جنگنده: لول {user.fighter_level}
 🏰 سیستم دفاع:
-• 🚀 دفاع موشکی: لول {user['defense_missile_level']}
-• 📡 جنگ الکترونیک: لول {user['defense_electronic_level']}
-• ✈️ ضد جنگنده: لول {user['defense_antifighter_level']}
-• 🛡️ بانس کلی: {user['total_defense_bonus']*100:.1f}%
+• 🚀 دفاع موشکی: لول {user.defense_missile_level}
+• 📡 جنگ الکترونیک: لول {user.defense_electronic_level}
+• ✈️ ضد جنگنده: لول {user.defense_antifighter_level}
+• 🛡️ بانس کلی: {user.total_defense_bonus*100:.1f}%
 ━━━━━━━━━━━━━━
-👑 وضعیت: {"🛡️ ادمین" if user['is_admin'] else "👤 کاربر عادی"}
-📅 عضویت: {datetime.fromtimestamp(user['created_at']).strftime('%Y/%m/%d')}
+👑 وضعیت: {"🛡️ ادمین" if user.is_admin else "👤 کاربر عادی"}
+📅 عضویت: {datetime.fromtimestamp(user.created_at).strftime('%Y/%m/%d')}
     """
     
     await message.answer(profile_text)
 
-@dp.message(F.text == "⚔️ حمله")
+@routes.text("⚔️ حمله")
 async def cmd_attack(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    missiles = db.get_user_missiles(user_id)
+    missiles = await db.get_user_missiles(user_id)
     
     if not missiles:
         await message.answer("""
@@ -535,32 +2601,12 @@ async def cmd_attack(message: Message):
         """)
         return
     
-    keyboard_buttons = []
-    row = []
-    
-    for i, missile in enumerate(missiles):
-        if i > 0 and i % 2 == 0:
-            keyboard_buttons.append(row)
-            row = []
-        
-        missile_name = missile['missile_name']
-        quantity = missile['quantity']
-        row.append(InlineKeyboardButton(
-            text=f"{missile_name} ({quantity})", 
-            callback_data=f"attack_with_{missile_name}"
-        ))
-    
-    if row:
-        keyboard_buttons.append(row)
-    
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    keyboard = missile_picker(missiles, 'atk')
     
     attack_info = f"""
 ⚔️ <b>حمله لول‌دار</b>
 ━━━━━━━━━━━━━━
-🎯 لول شما: {user['level']}
+🎯 لول شما: {user.level}
 
 📝 <b>روش حمله:</b>
 1. روی پیام کاربر مورد نظر <b>ریپلای (Reply)</b> کنید
@@ -574,11 +2620,14 @@ async def cmd_attack(message: Message):
     
     await message.answer(attack_info, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("attack_with_"))
-async def process_attack_with_missile(callback: CallbackQuery):
-    missile_name = callback.data.replace("attack_with_", "")
+@routes.callback('atk', group='attack', missile_id=int)
+async def process_attack_with_missile(callback: CallbackQuery, missile_id: int):
+    missile_name = MISSILE_NAMES.get(missile_id)
+    if not missile_name:
+        await callback.answer("❌ موشک نامعتبر!")
+        return
     
-    missile_data = MISSILE_DATA.get(missile_name, {})
+    missile_data = MISSILE_DATA[missile_name]
     damage = missile_data.get('damage', 0)
     
     await callback.message.edit_text(f"""
@@ -594,7 +2643,7 @@ async def process_attack_with_missile(callback: CallbackQuery):
     
     await callback.answer()
 
-@dp.message(F.text.startswith("حمله با"))
+@dp.message(F.text.startswith(ATTACK_TEXT_PREFIX))
 async def cmd_attack_with_missile(message: Message):
     if not message.reply_to_message:
         await message.answer("""
@@ -606,7 +2655,7 @@ async def cmd_attack_with_missile(message: Message):
         """)
         return
     
-    missile_name = message.text.replace("حمله با", "").strip()
+    missile_name = message.text.replace(ATTACK_TEXT_PREFIX, "").strip()
     
     if not missile_name or missile_name not in MISSILE_DATA:
         await message.answer(f"""
@@ -621,7 +2670,7 @@ async def cmd_attack_with_missile(message: Message):
         return
     
     attacker_id = message.from_user.id
-    attacker = db.get_user(attacker_id)
+    attacker = await db.get_user(attacker_id)
     
     if not attacker:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
@@ -634,23 +2683,21 @@ async def cmd_attack_with_missile(message: Message):
         await message.answer("❌ نمی‌توانید به خود حمله کنید!")
         return
     
-    target = db.get_user(target_id)
+    target = await db.get_user(target_id)
     if not target:
         await message.answer("❌ کاربر هدف در ربات ثبت‌نام نکرده است!")
         return
     
-    missiles = db.get_user_missiles(attacker_id)
-    missile_qty = next((m['quantity'] for m in missiles if m['missile_name'] == missile_name), 0)
-    
-    if missile_qty < 1:
+    missiles = await db.get_user_missiles(attacker_id)
+    if missiles[missile_name] < 1:
         await message.answer(f"❌ {missile_name} کافی ندارید!")
         return
     
     await execute_missile_attack(attacker_id, target_id, missile_name, message)
 
 async def execute_missile_attack(attacker_id: int, target_id: int, missile_name: str, message_obj):
-    attacker = db.get_user(attacker_id)
-    target = db.get_user(target_id)
+    attacker = await db.get_user(attacker_id)
+    target = await db.get_user(target_id)
     
     if not attacker or not target:
         await message_obj.answer("❌ کاربر یافت نشد!")
@@ -666,62 +2713,54 @@ async def execute_missile_attack(attacker_id: int, target_id: int, missile_name:
         await message_obj.answer("❌ موشک نامعتبر!")
         return
     
-    if attacker['level'] < missile_data['min_level']:
+    if attacker.level < missile_data['min_level']:
         await message_obj.answer(f"❌ برای این موشک حداقل لول {missile_data['min_level']} نیاز دارید!")
         return
     
     if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        if attacker['zone_gem'] < missile_data['gem_cost']:
+        if attacker.zone_gem < missile_data['gem_cost']:
             await message_obj.answer(f"❌ جم کافی ندارید! نیاز: {missile_data['gem_cost']} جم")
             return
     
     # محاسبه خسارت
     base_damage = missile_data['damage']
-    fighter_bonus = FIGHTER_LEVELS.get(attacker['fighter_level'], {}).get('damage_bonus', 0)
+    fighter_bonus = FIGHTER_LEVELS.get(attacker.fighter_level, {}).get('damage_bonus', 0)
     
     # بانس اضافی برای انتقام (اگر کاربر تحت حمله بوده)
     revenge_bonus = 0.0
-    if target['last_revenge_time'] > 0:
-        time_since_revenge = time.time() - target['last_revenge_time']
+    if target.last_revenge_time > 0:
+        time_since_revenge = time.time() - target.last_revenge_time
         if time_since_revenge < 3600:  # 1 ساعت
             revenge_bonus = 0.2  # 20% بانس اضافی
     
-    actual_damage = int(base_damage * (1 + fighter_bonus + revenge_bonus) * (1 - target['total_defense_bonus']))
-    
-    # محاسبه غنیمت
-    loot_coins = min(int(target['zone_coin'] * 0.10), 1000)
-    loot_gems = min(int(target['zone_gem'] * 0.05), 5)
+    actual_damage = int(base_damage * (1 + fighter_bonus + revenge_bonus) * (1 - target.total_defense_bonus))
     
-    # کسر و اضافه منابع
-    new_target_coins = max(target['zone_coin'] - loot_coins, 0)
-    new_target_gems = max(target['zone_gem'] - loot_gems, 0)
-    
-    db.update_user_coins(target_id, -loot_coins)
-    db.update_user_gems(target_id, -loot_gems)
-    db.update_user_coins(attacker_id, loot_coins)
-    db.update_user_gems(attacker_id, loot_gems)
-    
-    # کسر موشک
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    UPDATE user_missiles 
-    SET quantity = quantity - 1 
-    WHERE user_id = ? AND missile_name = ?
-    ''', (attacker_id, missile_name))
-    conn.commit()
-    conn.close()
-    
-    # کسر جم برای موشک‌های ویژه
-    if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        db.update_user_gems(attacker_id, -missile_data['gem_cost'])
-    
-    # اضافه کردن XP
+    # تسویه حمله (غنیمت، کسر موشک و جم، XP و ثبت حمله) در یک تراکنش
     xp_gained = missile_data['damage'] // 5
-    level_up, new_level = db.add_xp(attacker_id, xp_gained)
+    # اعلان هدف در همان تراکنش در outbox ثبت و در پس‌زمینه ارسال می‌شود
+    notify = {'kind': 'attack', 'payload': {
+        'attacker_id': attacker_id, 'attacker_name': attacker.full_name, 'missile_name': missile_name,
+        'damage': actual_damage, 'defense_bonus': target.total_defense_bonus
+    }}
+    settlement = await db.settle_attack(
+        attacker_id, target_id, missile_data['id'], actual_damage, xp_gained,
+        gem_cost=missile_data.get('gem_cost', 0) if missile_data['type'] == 'special' else 0,
+        notify=notify
+    )
     
-    # ثبت حمله برای انتقام
-    db.record_attack(attacker_id, target_id, missile_name, actual_damage, loot_coins, loot_gems)
+    if settlement['status'] == 'no_missile':
+        await message_obj.answer(f"❌ {missile_name} کافی ندارید!")
+        return
+    if settlement['status'] == 'no_gems':
+        await message_obj.answer(f"❌ جم کافی ندارید! نیاز: {missile_data['gem_cost']} جم")
+        return
+    if settlement['status'] != 'ok':
+        await message_obj.answer("❌ کاربر یافت نشد!")
+        return
+    
+    loot_coins = settlement['loot_coins']
+    loot_gems = settlement['loot_gems']
+    level_up = settlement['level_up']
     
     # ارسال گزارش
     bonus_text = ""
@@ -733,11 +2772,11 @@ async def execute_missile_attack(attacker_id: int, target_id: int, missile_name:
     report_text = f"""
 🎯 <b>حمله موفق!</b>
 ━━━━━━━━━━━━━━
-⚔️ حمله‌کننده: {attacker['full_name']}
-🎯 هدف: {target['full_name']}
+⚔️ حمله‌کننده: {attacker.full_name}
+🎯 هدف: {target.full_name}
 💣 موشک: {missile_name}
 💢 قدرت پایه: {missile_data['damage']} آسیب{bonus_text}
-🛡️ کاهش دفاع: {target['total_defense_bonus']*100:.1f}%
+🛡️ کاهش دفاع: {target.total_defense_bonus*100:.1f}%
 💥 خسارت نهایی: {actual_damage}
 ━━━━━━━━━━━━━━
 💰 غنیمت سکه: {loot_coins}
@@ -746,45 +2785,44 @@ async def execute_missile_attack(attacker_id: int, target_id: int, missile_name:
 {'🎉 سطح شما افزایش یافت!' if level_up else ''}
     """
     
+    outbox.wake()
     await message_obj.answer(report_text)
+
+def render_attack_notice(payload: Dict):
+    """اعلان حمله برای هدف با دکمه انتقام"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⚡ انتقام بگیر", callback_data=routes.pack('rv', payload['attacker_id']))]
+    ])
     
-    # اطلاع به هدف با دکمه انتقام
-    try:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⚡ انتقام بگیر", callback_data=f"revenge_{attacker_id}")]
-        ])
-        
-        target_report = f"""
+    target_report = f"""
 🚨 <b>تحت حمله قرار گرفتید!</b>
 ━━━━━━━━━━━━━━
-⚔️ حمله‌کننده: {attacker['full_name']}
-💣 موشک: {missile_name}
-💢 خسارت: {actual_damage}
-💰 سکه از دست رفته: {loot_coins}
-💎 جم از دست رفته: {loot_gems}
-🛡️ دفاع شما {target['total_defense_bonus']*100:.1f}% خسارت را کاهش داد
+⚔️ حمله‌کننده: {payload['attacker_name']}
+💣 موشک: {payload['missile_name']}
+💢 خسارت: {payload['damage']}
+💰 سکه از دست رفته: {payload['loot_coins']}
+💎 جم از دست رفته: {payload['loot_gems']}
+🛡️ دفاع شما {payload['defense_bonus']*100:.1f}% خسارت را کاهش داد
 ━━━━━━━━━━━━━━
 ⚡ <b>شما می‌توانید انتقام بگیرید!</b>
 • تا ۱ ساعت فرصت دارید
 • ۲۰% بانس آسیب اضافی
 • XP دو برابر
-        """
-        await bot.send_message(target_id, target_report, reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Failed to send attack report to target: {e}")
+    """
+    return target_report, keyboard
 
-@dp.message(F.text == "⚡ انتقام")
+@routes.text("⚡ انتقام")
 async def cmd_revenge(message: Message):
     """نمایش لیست حملات برای انتقام"""
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # دریافت آخرین حملات
-    recent_attacks = db.get_recent_attacks_on_user(user_id, limit=10)
+    recent_attacks = await db.get_recent_attacks_on_user(user_id, limit=10)
     
     if not recent_attacks:
         await message.answer("""
@@ -811,7 +2849,7 @@ async def cmd_revenge(message: Message):
         keyboard_buttons.append([
             InlineKeyboardButton(
                 text=button_text,
-                callback_data=f"revenge_attack_{attack['id']}"
+                callback_data=routes.pack('rva', attack['id'])
             )
         ])
     
@@ -819,7 +2857,7 @@ async def cmd_revenge(message: Message):
         await message.answer("⏳ تمام حملات قدیمی شده‌اند یا انتقام گرفته شده‌اند.")
         return
     
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")])
+    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
@@ -841,22 +2879,11 @@ async def cmd_revenge(message: Message):
     
     await message.answer(revenge_info, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("revenge_attack_"))
-async def process_revenge_attack(callback: CallbackQuery):
+@routes.callback('rva', group='attack', attack_id=int)
+async def process_revenge_attack(callback: CallbackQuery, attack_id: int):
     """پردازش انتخاب حمله برای انتقام"""
-    attack_id = int(callback.data.replace("revenge_attack_", ""))
-    
     # دریافت اطلاعات حمله
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT a.*, u.username, u.full_name 
-    FROM attacks a
-    JOIN users u ON a.attacker_id = u.user_id
-    WHERE a.id = ? AND a.can_revenge = 1 AND a.revenge_taken = 0
-    ''', (attack_id,))
-    attack = cursor.fetchone()
-    conn.close()
+    attack = await db.get_revengeable_attack(attack_id)
     
     if not attack:
         await callback.answer("❌ این حمله برای انتقام موجود نیست!")
@@ -870,37 +2897,17 @@ async def process_revenge_attack(callback: CallbackQuery):
         await callback.answer("❌ زمان انتقام گذشته است (بیشتر از 24 ساعت)")
         return
     
-    user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    
-    # دریافت موشک‌های کاربر برای انتقام
-    missiles = db.get_user_missiles(user_id)
-    
-    if not missiles:
-        await callback.answer("❌ برای انتقام نیاز به موشک دارید!")
-        return
-    
-    keyboard_buttons = []
-    row = []
-    
-    for i, missile in enumerate(missiles):
-        if i > 0 and i % 2 == 0:
-            keyboard_buttons.append(row)
-            row = []
-        
-        missile_name = missile['missile_name']
-        quantity = missile['quantity']
-        row.append(InlineKeyboardButton(
-            text=f"{missile_name} ({quantity})", 
-            callback_data=f"revenge_with_{attack_id}_{missile_name}"
-        ))
+    user_id = callback.from_user.id
+    user = await db.get_user(user_id)
     
-    if row:
-        keyboard_buttons.append(row)
+    # دریافت موشک‌های کاربر برای انتقام
+    missiles = await db.get_user_missiles(user_id)
     
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")])
+    if not missiles:
+        await callback.answer("❌ برای انتقام نیاز به موشک دارید!")
+        return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    keyboard = missile_picker(missiles, 'rvw', attack_id)
     
     revenge_text = f"""
 ⚡ <b>انتقام از:</b> {attacker_name}
@@ -915,49 +2922,39 @@ async def process_revenge_attack(callback: CallbackQuery):
     await callback.message.edit_text(revenge_text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("revenge_with_"))
-async def execute_revenge(callback: CallbackQuery):
+@routes.callback('rvw', group='attack', attack_id=int, missile_id=int)
+async def execute_revenge(callback: CallbackQuery, attack_id: int, missile_id: int):
     """انجام انتقام"""
     try:
-        parts = callback.data.split("_")
-        attack_id = int(parts[2])
-        missile_name = parts[3]
+        missile_name = MISSILE_NAMES.get(missile_id)
+        if not missile_name:
+            await callback.answer("❌ موشک نامعتبر!")
+            return
         
         user_id = callback.from_user.id
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
         
         if not user:
             await callback.answer("❌ کاربر یافت نشد!")
             return
         
         # دریافت اطلاعات حمله اصلی
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT a.*, u.username, u.full_name 
-        FROM attacks a
-        JOIN users u ON a.attacker_id = u.user_id
-        WHERE a.id = ? AND a.can_revenge = 1 AND a.revenge_taken = 0
-        ''', (attack_id,))
-        original_attack = cursor.fetchone()
-        conn.close()
+        original_attack = await db.get_revengeable_attack(attack_id)
         
         if not original_attack:
             await callback.answer("❌ این حمله برای انتقام موجود نیست!")
             return
         
         attacker_id = original_attack['attacker_id']
-        attacker = db.get_user(attacker_id)
+        attacker = await db.get_user(attacker_id)
         
         if not attacker:
             await callback.answer("❌ حمله‌کننده یافت نشد!")
             return
         
         # بررسی موجودی موشک
-        missiles = db.get_user_missiles(user_id)
-        missile_qty = next((m['quantity'] for m in missiles if m['missile_name'] == missile_name), 0)
-        
-        if missile_qty < 1:
+        missiles = await db.get_user_missiles(user_id)
+        if missiles[missile_name] < 1:
             await callback.answer(f"❌ {missile_name} کافی ندارید!")
             return
         
@@ -969,58 +2966,52 @@ async def execute_revenge(callback: CallbackQuery):
         
         # محاسبه خسارت انتقام (20% بیشتر + بانس جنگنده)
         base_damage = missile_data['damage']
-        fighter_bonus = FIGHTER_LEVELS.get(user['fighter_level'], {}).get('damage_bonus', 0)
+        fighter_bonus = FIGHTER_LEVELS.get(user.fighter_level, {}).get('damage_bonus', 0)
         revenge_bonus = 0.2  # 20% بانس انتقام
         
-        actual_damage = int(base_damage * (1 + fighter_bonus + revenge_bonus) * (1 - attacker['total_defense_bonus']))
-        
-        # محاسبه غنیمت (50% بیشتر از معمول)
-        loot_coins = min(int(attacker['zone_coin'] * 0.15), 1500)  # 15% به جای 10%
-        loot_gems = min(int(attacker['zone_gem'] * 0.075), 8)      # 7.5% به جای 5%
-        
-        # کسر و اضافه منابع
-        new_attacker_coins = max(attacker['zone_coin'] - loot_coins, 0)
-        new_attacker_gems = max(attacker['zone_gem'] - loot_gems, 0)
+        actual_damage = int(base_damage * (1 + fighter_bonus + revenge_bonus) * (1 - attacker.total_defense_bonus))
         
-        db.update_user_coins(attacker_id, -loot_coins)
-        db.update_user_gems(attacker_id, -loot_gems)
-        db.update_user_coins(user_id, loot_coins)
-        db.update_user_gems(user_id, loot_gems)
-        
-        # کسر موشک
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE user_missiles 
-        SET quantity = quantity - 1 
-        WHERE user_id = ? AND missile_name = ?
-        ''', (user_id, missile_name))
-        conn.commit()
-        conn.close()
-        
-        # کسر جم برای موشک‌های ویژه
-        if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-            db.update_user_gems(user_id, -missile_data['gem_cost'])
-        
-        # اضافه کردن XP (دو برابر)
+        # تسویه انتقام در یک تراکنش - غنیمت 50% بیشتر از معمول و XP دو برابر
         xp_gained = (missile_data['damage'] // 5) * 2
-        level_up, new_level = db.add_xp(user_id, xp_gained)
+        notify = {'kind': 'revenge', 'payload': {'avenger_name': user.full_name, 'damage': actual_damage}}
+        settlement = await db.settle_attack(
+            user_id, attacker_id, missile_data['id'], actual_damage, xp_gained,
+            gem_cost=missile_data.get('gem_cost', 0) if missile_data['type'] == 'special' else 0,
+            loot_rate=0.15, loot_cap=1500,       # 15% به جای 10%
+            gem_loot_rate=0.075, gem_loot_cap=8,  # 7.5% به جای 5%
+            revenge_of=attack_id,
+            notify=notify
+        )
+        
+        if settlement['status'] == 'no_missile':
+            await callback.answer(f"❌ {missile_name} کافی ندارید!")
+            return
+        if settlement['status'] == 'no_gems':
+            await callback.answer(f"❌ جم کافی ندارید! نیاز: {missile_data['gem_cost']} جم")
+            return
+        if settlement['status'] == 'revenge_taken':
+            await callback.answer("❌ این حمله برای انتقام موجود نیست!")
+            return
+        if settlement['status'] != 'ok':
+            await callback.answer("❌ حمله‌کننده یافت نشد!")
+            return
         
-        # علامت‌گذاری انتقام گرفته شده
-        db.mark_revenge_taken(attack_id)
-        db.update_last_revenge_time(user_id)
+        outbox.wake()
+        loot_coins = settlement['loot_coins']
+        loot_gems = settlement['loot_gems']
+        level_up = settlement['level_up']
         
         # ارسال گزارش
         report_text = f"""
 ⚡ <b>انتقام موفق!</b>
 ━━━━━━━━━━━━━━
-🎯 انتقام‌گیرنده: {user['full_name']}
-⚔️ هدف: {attacker['full_name']}
+🎯 انتقام‌گیرنده: {user.full_name}
+⚔️ هدف: {attacker.full_name}
 💣 موشک: {missile_name}
 💢 قدرت پایه: {missile_data['damage']} آسیب
 ✈️ بانس جنگنده: +{fighter_bonus*100:.0f}%
 ⚡ بانس انتقام: +{revenge_bonus*100:.0f}%
-🛡️ کاهش دفاع: {attacker['total_defense_bonus']*100:.1f}%
+🛡️ کاهش دفاع: {attacker.total_defense_bonus*100:.1f}%
 💥 خسارت نهایی: {actual_damage}
 ━━━━━━━━━━━━━━
 💰 غنیمت سکه: {loot_coins} (50% بیشتر)
@@ -1033,48 +3024,36 @@ async def execute_revenge(callback: CallbackQuery):
         
         await callback.message.edit_text(report_text)
         await callback.answer("✅ انتقام با موفقیت انجام شد!")
-        
-        # اطلاع به هدف انتقام
-        try:
-            target_report = f"""
-⚡ <b>از شما انتقام گرفته شد!</b>
-━━━━━━━━━━━━━━
-🎯 انتقام‌گیرنده: {user['full_name']}
-💢 خسارت: {actual_damage}
-💰 سکه از دست رفته: {loot_coins}
-💎 جم از دست رفته: {loot_gems}
-📊 موجودی جدید:
-• سکه: {new_attacker_coins}
-• جم: {new_attacker_gems}
-━━━━━━━━━━━━━━
-⚠️ این انتقام برای حمله شما به {user['full_name']} بود.
-            """
-            await bot.send_message(attacker_id, target_report)
-        except Exception as e:
-            logger.error(f"Failed to send revenge report to target: {e}")
     
     except Exception as e:
         logger.error(f"Revenge error: {e}")
         await callback.answer("❌ خطا در انجام انتقام!")
 
-@dp.callback_query(F.data.startswith("revenge_"))
-async def quick_revenge(callback: CallbackQuery):
+def render_revenge_notice(payload: Dict):
+    """اعلان انتقام برای حمله‌کننده اصلی"""
+    target_report = f"""
+⚡ <b>از شما انتقام گرفته شد!</b>
+━━━━━━━━━━━━━━
+🎯 انتقام‌گیرنده: {payload['avenger_name']}
+💢 خسارت: {payload['damage']}
+💰 سکه از دست رفته: {payload['loot_coins']}
+💎 جم از دست رفته: {payload['loot_gems']}
+📊 موجودی جدید:
+• سکه: {payload['target_coins']}
+• جم: {payload['target_gems']}
+━━━━━━━━━━━━━━
+⚠️ این انتقام برای حمله شما به {payload['avenger_name']} بود.
+    """
+    return target_report, None
+
+@routes.callback('rv', group='attack', attacker_id=int)
+async def quick_revenge(callback: CallbackQuery, attacker_id: int):
     """انتقام سریع از پیام حمله"""
     try:
-        attacker_id = int(callback.data.replace("revenge_", ""))
         user_id = callback.from_user.id
         
         # بررسی اینکه آیا حمله اخیرا اتفاق افتاده
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT * FROM attacks 
-        WHERE attacker_id = ? AND target_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 1
-        ''', (attacker_id, user_id))
-        recent_attack = cursor.fetchone()
-        conn.close()
+        recent_attack = await db.get_last_attack(attacker_id, user_id)
         
         if not recent_attack:
             await callback.answer("❌ حمله‌ای برای انتقام پیدا نشد!")
@@ -1089,44 +3068,26 @@ async def quick_revenge(callback: CallbackQuery):
 
 async def execute_revenge_from_attack(user_id: int, attacker_id: int, attack_id: int, callback: CallbackQuery):
     """انجام انتقام از یک حمله خاص"""
-    user = db.get_user(user_id)
-    attacker = db.get_user(attacker_id)
+    user = await db.get_user(user_id)
+    attacker = await db.get_user(attacker_id)
     
     if not user or not attacker:
         await callback.answer("❌ کاربر یافت نشد!")
         return
     
     # دریافت موشک‌های کاربر
-    missiles = db.get_user_missiles(user_id)
+    missiles = await db.get_user_missiles(user_id)
     
     if not missiles:
         await callback.answer("❌ برای انتقام نیاز به موشک دارید!")
         return
     
-    keyboard_buttons = []
-    row = []
-    
-    for i, missile in enumerate(missiles[:8]):  # حداکثر 8 موشک
-        if i > 0 and i % 2 == 0:
-            keyboard_buttons.append(row)
-            row = []
-        
-        missile_name = missile['missile_name']
-        quantity = missile['quantity']
-        row.append(InlineKeyboardButton(
-            text=f"{missile_name} ({quantity})", 
-            callback_data=f"revenge_with_{attack_id}_{missile_name}"
-        ))
-    
-    if row:
-        keyboard_buttons.append(row)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+    keyboard = missile_picker(missiles, 'rvw', attack_id, limit=8, back=False)
     
     revenge_text = f"""
 ⚡ <b>انتقام سریع</b>
 ━━━━━━━━━━━━━━
-🎯 هدف: {attacker['full_name']}
+🎯 هدف: {attacker.full_name}
 💢 خسارت دریافتی: اخیراً
 
 💣 <b>انتخاب موشک برای انتقام:</b>
@@ -1138,46 +3099,31 @@ async def execute_revenge_from_attack(user_id: int, attacker_id: int, attack_id:
     await callback.message.edit_text(revenge_text, reply_markup=keyboard)
     await callback.answer()
 
-@dp.message(F.text == "🏪 بازار")
+@routes.text("🏪 بازار")
 async def cmd_market(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    user_missiles = db.get_user_missiles(user_id)
-    user_missiles_dict = {m['missile_name']: m['quantity'] for m in user_missiles}
+    user_missiles = await db.get_user_missiles(user_id)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شبح", callback_data="buy_ghost"),
-            InlineKeyboardButton(text="رعد", callback_data="buy_thunder")
-        ],
-        [
-            InlineKeyboardButton(text="تندر", callback_data="buy_boomer"),
-            InlineKeyboardButton(text="هاوک", callback_data="buy_hawk")
-        ],
-        [
-            InlineKeyboardButton(text="پاتریوت", callback_data="buy_patriot"),
-            InlineKeyboardButton(text="⏩ ویژه", callback_data="market_special")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
+    keyboard = screens['market']
     
     missiles_text = ""
     common_missiles = ['شبح', 'رعد', 'تندر']
     for missile_name in common_missiles:
-        qty = user_missiles_dict.get(missile_name, 0)
+        qty = user_missiles[missile_name]
         missiles_text += f"• {missile_name}: {qty} عدد\n"
     
     market_text = f"""
 🏪 <b>بازار جنگ‌افزار</b>
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
-💎 جم شما: {user['zone_gem']}
-🎯 لول: {user['level']}
+💰 سکه شما: {user.zone_coin}
+💎 جم شما: {user.zone_gem}
+🎯 لول: {user.level}
 ━━━━━━━━━━━━━━
 📊 <b>موشک‌های شما:</b>
 {missiles_text if missiles_text else "• هیچ موشکی ندارید!"}
@@ -1212,32 +3158,19 @@ async def cmd_market(message: Message):
     
     await message.answer(market_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data == "market_special")
+@routes.callback('market_special')
 async def cmd_market_special(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شهاب", callback_data="buy_meteor"),
-            InlineKeyboardButton(text="سیل", callback_data="buy_tsunami")
-        ],
-        [
-            InlineKeyboardButton(text="توفان", callback_data="buy_storm"),
-            InlineKeyboardButton(text="تایفون", callback_data="buy_typhoon")
-        ],
-        [
-            InlineKeyboardButton(text="آپوکالیپس", callback_data="buy_apocalypse"),
-            InlineKeyboardButton(text="⏪ معمولی", callback_data="market_normal")
-        ]
-    ])
+    keyboard = screens['market_special']
     
     special_text = f"""
 💎 <b>موشک‌های ویژه</b>
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
-💎 جم شما: {user['zone_gem']}
-🎯 لول: {user['level']}
+💰 سکه شما: {user.zone_coin}
+💎 جم شما: {user.zone_gem}
+🎯 لول: {user.level}
 ━━━━━━━━━━━━━━
 💣 <b>موشک‌های ویژه:</b>
 
@@ -1269,32 +3202,19 @@ async def cmd_market_special(callback: CallbackQuery):
     
     await callback.message.edit_text(special_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data == "market_normal")
+@routes.callback('market_normal')
 async def cmd_market_normal(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شبح", callback_data="buy_ghost"),
-            InlineKeyboardButton(text="رعد", callback_data="buy_thunder")
-        ],
-        [
-            InlineKeyboardButton(text="تندر", callback_data="buy_boomer"),
-            InlineKeyboardButton(text="هاوک", callback_data="buy_hawk")
-        ],
-        [
-            InlineKeyboardButton(text="پاتریوت", callback_data="buy_patriot"),
-            InlineKeyboardButton(text="⏩ ویژه", callback_data="market_special")
-        ]
-    ])
+    keyboard = screens['market_normal']
     
     market_text = f"""
 🏪 <b>بازار جنگ‌افزار</b>
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
-💎 جم شما: {user['zone_gem']}
-🎯 لول: {user['level']}
+💰 سکه شما: {user.zone_coin}
+💎 جم شما: {user.zone_gem}
+🎯 لول: {user.level}
 ━━━━━━━━━━━━━━
 📦 <b>موشک‌های معمولی:</b>
 
@@ -1307,28 +3227,14 @@ async def cmd_market_normal(callback: CallbackQuery):
     
     await callback.message.edit_text(market_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("buy_"))
-async def process_buy(callback: CallbackQuery):
-    missile_type = callback.data.replace("buy_", "")
-    
-    missile_map = {
-        'ghost': 'شبح',
-        'thunder': 'رعد',
-        'boomer': 'تندر',
-        'hawk': 'هاوک',
-        'patriot': 'پاتریوت',
-        'meteor': 'شهاب',
-        'tsunami': 'سیل',
-        'storm': 'توفان',
-        'typhoon': 'تایفون',
-        'apocalypse': 'آپوکالیپس'
-    }
+@routes.callback('buy', group='economy', missile_id=int)
+async def process_buy(callback: CallbackQuery, missile_id: int):
+    missile_name = MISSILE_NAMES.get(missile_id)
     
-    if missile_type not in missile_map:
+    if not missile_name:
         await callback.answer("❌ این آیتم موجود نیست!")
         return
     
-    missile_name = missile_map[missile_type]
     missile_data = MISSILE_DATA.get(missile_name)
     
     if not missile_data:
@@ -1336,36 +3242,27 @@ async def process_buy(callback: CallbackQuery):
         return
     
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    gem_cost = missile_data.get('gem_cost', 0) if missile_data['type'] == 'special' else 0
+    # بررسی لول و موجودی و کسر هزینه در یک تراکنش شرطی انجام می‌شود
+    async with user_locks.hold(user_id):
+        result = await db.buy_missile(
+            user_id, missile_data['id'], missile_data['price'], gem_cost, missile_data['min_level']
+        )
     
-    if user['level'] < missile_data['min_level']:
-        await callback.answer(f"❌ نیاز به لول {missile_data['min_level']} دارید! (لول شما: {user['level']})")
+    status = result['status']
+    if status == 'no_user':
+        await callback.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
-    
-    if user['zone_coin'] < missile_data['price']:
+    if status == 'low_level':
+        user = await db.get_user(user_id)
+        await callback.answer(f"❌ نیاز به لول {missile_data['min_level']} دارید! (لول شما: {user.level})")
+        return
+    if status == 'no_coins':
         await callback.answer(f"❌ سکه کافی ندارید! نیاز: {missile_data['price']} سکه")
         return
-    
-    if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        if user['zone_gem'] < missile_data['gem_cost']:
-            await callback.answer(f"❌ جم کافی ندارید! نیاز: {missile_data['gem_cost']} جم")
-            return
-    
-    db.update_user_coins(user_id, -missile_data['price'])
-    
-    if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        db.update_user_gems(user_id, -missile_data['gem_cost'])
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO user_missiles (user_id, missile_name, quantity)
-    VALUES (?, ?, 1)
-    ON CONFLICT(user_id, missile_name) 
-    DO UPDATE SET quantity = quantity + 1
-    ''', (user_id, missile_name))
-    conn.commit()
-    conn.close()
+    if status == 'no_gems':
+        await callback.answer(f"❌ جم کافی ندارید! نیاز: {gem_cost} جم")
+        return
     
     gem_text = f" + {missile_data['gem_cost']} جم" if missile_data.get('gem_cost', 0) > 0 else ""
     
@@ -1377,44 +3274,30 @@ async def process_buy(callback: CallbackQuery):
 💥 قدرت: {missile_data['damage']} آسیب
 🎯 نیاز لول: {missile_data['min_level']}
 ━━━━━━━━━━━━━━
-💰 سکه باقی‌مانده: {user['zone_coin'] - missile_data['price']}
-💎 جم باقی‌مانده: {user['zone_gem'] - missile_data.get('gem_cost', 0)}
+💰 سکه باقی‌مانده: {result['zone_coin']}
+💎 جم باقی‌مانده: {result['zone_gem']}
     """
     
     await callback.message.edit_text(report_text)
     await callback.answer("✅ خرید با موفقیت انجام شد!")
 
-@dp.message(F.text == "🎁 باکس")
+@routes.text("🎁 باکس")
 async def cmd_boxes(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🎁 باکس سکه (50 سکه)", callback_data="box_coin"),
-            InlineKeyboardButton(text="🎁 باکس ZP (100 سکه)", callback_data="box_zp")
-        ],
-        [
-            InlineKeyboardButton(text="💎 باکس ویژه (2 جم)", callback_data="box_special"),
-            InlineKeyboardButton(text="👑 باکس افسانه‌ای (5 جم)", callback_data="box_legendary")
-        ],
-        [
-            InlineKeyboardButton(text="🆓 باکس رایگان", callback_data="box_free"),
-            InlineKeyboardButton(text="📦 موجودی", callback_data="box_inventory")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
+    keyboard = screens['boxes']
     
     box_text = f"""
 🎁 <b>فروشگاه باکس‌ها</b>
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
-💎 جم شما: {user['zone_gem']}
-⚡ ZP شما: {user['zone_point']}
+💰 سکه شما: {user.zone_coin}
+💎 جم شما: {user.zone_gem}
+⚡ ZP شما: {user.zone_point}
 ━━━━━━━━━━━━━━
 🎰 شانس خود را امتحان کنید!
 
@@ -1442,16 +3325,8 @@ async def cmd_boxes(message: Message):
     
     await message.answer(box_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("box_"))
-async def process_box(callback: CallbackQuery):
-    box_type = callback.data.replace("box_", "")
-    user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    
-    if not user:
-        await callback.answer("❌ کاربر یافت نشد!")
-        return
-    
+@routes.callback('box', group='economy', box_type=str)
+async def process_box(callback: CallbackQuery, box_type: str):
     rewards = {
         'coin': {'min': 10, 'max': 200, 'cost_coin': 50, 'cost_gem': 0},
         'zp': {'min': 25, 'max': 100, 'cost_coin': 100, 'cost_gem': 0},
@@ -1466,20 +3341,9 @@ async def process_box(callback: CallbackQuery):
     
     reward = rewards[box_type]
     
-    if box_type != 'free':
-        if user['zone_coin'] < reward['cost_coin']:
-            await callback.answer("❌ سکه کافی ندارید!")
-            return
-        
-        if user['zone_gem'] < reward['cost_gem']:
-            await callback.answer("❌ جم کافی ندارید!")
-            return
-    
-    if reward['cost_coin'] > 0:
-        db.update_user_coins(user_id, -reward['cost_coin'])
-    if reward['cost_gem'] > 0:
-        db.update_user_gems(user_id, -reward['cost_gem'])
-    
+    # جایزه پیش از تراکنش انتخاب می‌شود و همراه کسر هزینه یک‌جا ثبت می‌شود
+    grant = {}
+    missiles = {}
     prize_text = ""
     prize_value = 0
     
@@ -1488,11 +3352,11 @@ async def process_box(callback: CallbackQuery):
         prize_type = random.choice(['coin', 'zp', 'missile'])
         
         if prize_type == 'coin':
-            db.update_user_coins(user_id, prize)
+            grant['zone_coin'] = prize
             prize_text = f"{prize} سکه"
             prize_value = prize
         elif prize_type == 'zp':
-            db.update_user_zp(user_id, prize)
+            grant['zone_point'] = prize
             prize_text = f"{prize} ZP"
             prize_value = prize
         else:
@@ -1501,16 +3365,7 @@ async def process_box(callback: CallbackQuery):
             missile = random.choice(free_missiles)
             qty = random.randint(1, 3)
             
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT INTO user_missiles (user_id, missile_name, quantity)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id, missile_name) 
-            DO UPDATE SET quantity = quantity + ?
-            ''', (user_id, missile, qty, qty))
-            conn.commit()
-            conn.close()
+            missiles[MISSILE_IDS[missile]] = qty
             
             prize_text = f"{qty} عدد {missile}"
             prize_value = MISSILE_DATA[missile]['price'] * qty
@@ -1519,16 +3374,7 @@ async def process_box(callback: CallbackQuery):
         special_missiles = ['شهاب', 'سیل', 'توفان']
         missile = random.choice(special_missiles)
         
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO user_missiles (user_id, missile_name, quantity)
-        VALUES (?, ?, 1)
-        ON CONFLICT(user_id, missile_name) 
-        DO UPDATE SET quantity = quantity + 1
-        ''', (user_id, missile))
-        conn.commit()
-        conn.close()
+        missiles[MISSILE_IDS[missile]] = 1
         
         prize_text = f"1 عدد {missile}"
         prize_value = MISSILE_DATA[missile]['price']
@@ -1536,25 +3382,37 @@ async def process_box(callback: CallbackQuery):
     elif box_type == 'legendary':
         if random.random() < 0.1:
             prize = random.randint(500, 2000)
-            db.update_user_coins(user_id, prize)
             prize_text = f"🎉 جکپات! {prize} سکه"
-            prize_value = prize
         else:
             prize = random.randint(reward['min'], reward['max'])
-            db.update_user_coins(user_id, prize)
             prize_text = f"{prize} سکه"
-            prize_value = prize
+        grant['zone_coin'] = prize
+        prize_value = prize
     
     else:
         prize = random.randint(reward['min'], reward['max'])
         if box_type == 'coin':
-            db.update_user_coins(user_id, prize)
+            grant['zone_coin'] = prize
             prize_text = f"{prize} سکه"
-            prize_value = prize
         else:
-            db.update_user_zp(user_id, prize)
+            grant['zone_point'] = prize
             prize_text = f"{prize} ZP"
-            prize_value = prize
+        prize_value = prize
+    
+    user_id = callback.from_user.id
+    async with user_locks.hold(user_id):
+        result = await db.open_box(user_id, reward['cost_coin'], reward['cost_gem'], grant, missiles)
+    
+    status = result['status']
+    if status == 'no_user':
+        await callback.answer("❌ کاربر یافت نشد!")
+        return
+    if status == 'no_coins':
+        await callback.answer("❌ سکه کافی ندارید!")
+        return
+    if status == 'no_gems':
+        await callback.answer("❌ جم کافی ندارید!")
+        return
     
     box_names = {
         'coin': 'باکس سکه',
@@ -1571,48 +3429,48 @@ async def process_box(callback: CallbackQuery):
 🎰 جایزه: {prize_text}
 💰 ارزش تقریبی: {prize_value} سکه
 ━━━━━━━━━━━━━━
-💰 سکه فعلی: {user['zone_coin'] - reward['cost_coin'] + (prize if box_type == 'coin' or box_type == 'legendary' else 0)}
-💎 جم فعلی: {user['zone_gem'] - reward['cost_gem']}
-⚡ ZP فعلی: {user['zone_point'] + (prize if box_type == 'zp' else 0)}
+💰 سکه فعلی: {result['zone_coin']}
+💎 جم فعلی: {result['zone_gem']}
+⚡ ZP فعلی: {result['zone_point']}
     """
     
     await callback.message.edit_text(report_text)
     await callback.answer("✅ باکس با موفقیت باز شد!")
 
-@dp.message(F.text == "⛏️ ماینر")
+@routes.text("⛏️ ماینر")
 async def cmd_miner(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     miner_zp = 0
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
+    if user.last_miner_claim:
+        time_passed = int(time.time()) - user.last_miner_claim
         if time_passed > 0:
-            zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
+            zp_per_hour = MINER_LEVELS[user.miner_level]['zp_per_hour']
             miner_zp = int((time_passed / 3600) * zp_per_hour)
     
     keyboard_buttons = []
     
     # دکمه برداشت همیشه نمایش داده می‌شود
-    keyboard_buttons.append([InlineKeyboardButton(text=f"📦 برداشت {miner_zp} ZP", callback_data="claim_miner")])
+    keyboard_buttons.append([InlineKeyboardButton(text=f"📦 برداشت {miner_zp} ZP", callback_data=routes.pack('claim_miner'))])
     
-    current_level = user['miner_level']
+    current_level = user.miner_level
     if current_level < 15:
         upgrade_cost = MINER_LEVELS[current_level]['upgrade_cost']
-        keyboard_buttons.append([InlineKeyboardButton(text=f"⬆️ ارتقا به لول {current_level + 1}", callback_data="upgrade_miner")])
+        keyboard_buttons.append([InlineKeyboardButton(text=f"⬆️ ارتقا به لول {current_level + 1}", callback_data=routes.pack('upgrade_miner'))])
     
-    keyboard_buttons.append([InlineKeyboardButton(text="📊 اطلاعات ماینر", callback_data="miner_info")])
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")])
+    keyboard_buttons.append([InlineKeyboardButton(text="📊 اطلاعات ماینر", callback_data=routes.pack('miner_info'))])
+    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
     last_claim_time = "هرگز"
-    if user['last_miner_claim']:
-        last_claim_time = datetime.fromtimestamp(user['last_miner_claim']).strftime('%H:%M')
+    if user.last_miner_claim:
+        last_claim_time = datetime.fromtimestamp(user.last_miner_claim).strftime('%H:%M')
     
     next_level_info = ""
     if current_level < 15:
@@ -1636,84 +3494,85 @@ async def cmd_miner(message: Message):
 ━━━━━━━━━━━━━━
 📦 ZP قابل برداشت: {miner_zp}
 ⏰ آخرین برداشت: {last_claim_time}
-⏳ زمان سپری شده: {time_passed // 3600 if user['last_miner_claim'] else 0} ساعت
+⏳ زمان سپری شده: {time_passed // 3600 if user.last_miner_claim else 0} ساعت
 ━━━━━━━━━━━━━━
 {next_level_info}
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
+💰 سکه شما: {user.zone_coin}
     """
     
     await message.answer(miner_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data == "claim_miner")
+@routes.callback('claim_miner', group='economy')
 async def process_claim_miner(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    async with user_locks.hold(user_id):
+        user = await db.get_user(user_id)
     
-    if not user:
-        await callback.answer("❌ کاربر یافت نشد!")
-        return
+        if not user:
+            await callback.answer("❌ کاربر یافت نشد!")
+            return
     
-    miner_zp = 0
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
-        if time_passed > 0:
-            zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
-            miner_zp = int((time_passed / 3600) * zp_per_hour)
+        miner_zp = 0
+        if user.last_miner_claim:
+            time_passed = int(time.time()) - user.last_miner_claim
+            if time_passed > 0:
+                zp_per_hour = MINER_LEVELS[user.miner_level]['zp_per_hour']
+                miner_zp = int((time_passed / 3600) * zp_per_hour)
+    
+        if miner_zp <= 0:
+            await callback.answer("❌ هنوز ZP جدیدی تولید نشده!")
+            return
+    
+        # فقط اگر از زمان خوانده‌شده برداشت دیگری نشده باشد ثبت می‌شود
+        result = await db.claim_miner(user_id, miner_zp, user.last_miner_claim)
     
-    if miner_zp <= 0:
+    if result['status'] != 'ok':
         await callback.answer("❌ هنوز ZP جدیدی تولید نشده!")
         return
     
-    db.update_user_zp(user_id, miner_zp)
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_miner_claim = ? WHERE user_id = ?', 
-                  (int(time.time()), user_id))
-    conn.commit()
-    conn.close()
-    
     await callback.message.edit_text(f"""
 ✅ <b>برداشت موفق!</b>
 ━━━━━━━━━━━━━━
 ⛏️ ZP برداشت شده: {miner_zp}
-💰 ZP کل: {user['zone_point'] + miner_zp} ZP
+💰 ZP کل: {result['zone_point']} ZP
 ⏰ زمان برداشت: {datetime.now().strftime('%H:%M')}
 ━━━━━━━━━━━━━━
 ⚡ ماینر دوباره شروع به کار کرد!
-📊 تولید فعلی: {MINER_LEVELS[user['miner_level']]['zp_per_hour']} ZP/ساعت
+📊 تولید فعلی: {MINER_LEVELS[user.miner_level]['zp_per_hour']} ZP/ساعت
     """)
     await callback.answer(f"✅ {miner_zp} ZP برداشت شد!")
 
-@dp.callback_query(F.data == "upgrade_miner")
+@routes.callback('upgrade_miner', group='economy')
 async def process_upgrade_miner(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    async with user_locks.hold(user_id):
+        user = await db.get_user(user_id)
     
-    if not user:
-        await callback.answer("❌ کاربر یافت نشد!")
-        return
+        if not user:
+            await callback.answer("❌ کاربر یافت نشد!")
+            return
     
-    current_level = user['miner_level']
+        current_level = user.miner_level
     
-    if current_level >= 15:
-        await callback.answer("🎉 ماینر شما در ماکس لول است!")
-        return
+        if current_level >= 15:
+            await callback.answer("🎉 ماینر شما در ماکس لول است!")
+            return
     
-    upgrade_cost = MINER_LEVELS[current_level]['upgrade_cost']
+        upgrade_cost = MINER_LEVELS[current_level]['upgrade_cost']
     
-    if user['zone_coin'] < upgrade_cost:
-        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
-        return
+        if user.zone_coin < upgrade_cost:
+            await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
+            return
     
-    db.update_user_coins(user_id, -upgrade_cost)
+        result = await db.upgrade_miner(user_id, current_level, upgrade_cost)
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET miner_level = miner_level + 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    if result['status'] == 'stale':
+        await callback.answer("❌ سطح ماینر تغییر کرده، دوباره تلاش کنید!")
+        return
+    if result['status'] != 'ok':
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
+        return
     
     new_level = current_level + 1
     
@@ -1724,7 +3583,7 @@ async def process_upgrade_miner(callback: CallbackQuery):
 ⚡ تولید جدید: {MINER_LEVELS[new_level]['zp_per_hour']} ZP/ساعت
 💰 هزینه پرداختی: {upgrade_cost} سکه
 ━━━━━━━━━━━━━━
-💰 سکه باقی‌مانده: {user['zone_coin'] - upgrade_cost} سکه
+💰 سکه باقی‌مانده: {result['zone_coin']} سکه
 🎉 ماینر شما با قدرت بیشتر کار می‌کند!
 
 📊 <b>آینده:</b>
@@ -1733,25 +3592,25 @@ async def process_upgrade_miner(callback: CallbackQuery):
     """)
     await callback.answer(f"✅ ماینر به سطح {new_level} ارتقا یافت!")
 
-@dp.message(F.text == "✈️ جنگنده")
+@routes.text("✈️ جنگنده")
 async def cmd_fighter(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    current_level = user['fighter_level']
+    current_level = user.fighter_level
     fighter_data = FIGHTER_LEVELS.get(current_level, {})
     next_level_data = FIGHTER_LEVELS.get(current_level + 1, {})
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text=f"⬆️ ارتقا جنگنده", callback_data="upgrade_fighter"),
-            InlineKeyboardButton(text="📊 اطلاعات", callback_data="fighter_info")
+            InlineKeyboardButton(text=f"⬆️ ارتقا جنگنده", callback_data=routes.pack('upgrade_fighter')),
+            InlineKeyboardButton(text="📊 اطلاعات", callback_data=routes.pack('fighter_info'))
         ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
+        [InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))]
     ])
     
     fighter_text = f"""
@@ -1775,36 +3634,43 @@ async def cmd_fighter(message: Message):
     
     fighter_text += f"""
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
+💰 سکه شما: {user.zone_coin}
     """
     
     await message.answer(fighter_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data == "upgrade_fighter")
+@routes.callback('upgrade_fighter', group='economy')
 async def process_upgrade_fighter(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    async with user_locks.hold(user_id):
+        user = await db.get_user(user_id)
     
-    if not user:
-        await callback.answer("❌ کاربر یافت نشد!")
-        return
+        if not user:
+            await callback.answer("❌ کاربر یافت نشد!")
+            return
     
-    current_level = user['fighter_level']
+        current_level = user.fighter_level
     
-    if current_level >= 10:
-        await callback.answer("🎉 جنگنده شما در ماکس لول است!")
-        return
+        if current_level >= 10:
+            await callback.answer("🎉 جنگنده شما در ماکس لول است!")
+            return
     
-    next_level_data = FIGHTER_LEVELS.get(current_level + 1, {})
-    upgrade_cost = next_level_data.get('upgrade_cost', 0)
+        next_level_data = FIGHTER_LEVELS.get(current_level + 1, {})
+        upgrade_cost = next_level_data.get('upgrade_cost', 0)
+    
+        if user.zone_coin < upgrade_cost:
+            await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
+            return
     
-    if user['zone_coin'] < upgrade_cost:
+        result = await db.upgrade_fighter(user_id, current_level, upgrade_cost)
+    
+    if result['status'] == 'stale':
+        await callback.answer("❌ سطح جنگنده تغییر کرده، دوباره تلاش کنید!")
+        return
+    if result['status'] != 'ok':
         await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
         return
     
-    db.update_user_coins(user_id, -upgrade_cost)
-    db.update_fighter_level(user_id, 1)
-    
     new_level = current_level + 1
     new_data = FIGHTER_LEVELS.get(new_level, {})
     
@@ -1816,7 +3682,7 @@ async def process_upgrade_fighter(callback: CallbackQuery):
 🛡️ بانس دفاع جدید: +{new_data.get('defense_bonus', 0)*100:.0f}%
 💰 هزینه پرداختی: {upgrade_cost} سکه
 ━━━━━━━━━━━━━━
-💰 سکه باقی‌مانده: {user['zone_coin'] - upgrade_cost} سکه
+💰 سکه باقی‌مانده: {result['zone_coin']} سکه
 🎉 جنگنده شما قوی‌تر شد!
 
 📊 <b>تاثیر:</b>
@@ -1825,31 +3691,31 @@ async def process_upgrade_fighter(callback: CallbackQuery):
     """)
     await callback.answer(f"✅ جنگنده به سطح {new_level} ارتقا یافت!")
 
-@dp.message(F.text == "🏰 دفاع")
+@routes.text("🏰 دفاع")
 async def cmd_defense(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # محاسبه بانس دفاع کل
-    total_defense_bonus = (user['defense_missile_level'] * 0.05) + \
-                         (user['defense_electronic_level'] * 0.03) + \
-                         (user['defense_antifighter_level'] * 0.07)
+    total_defense_bonus = (user.defense_missile_level * 0.05) + \
+                         (user.defense_electronic_level * 0.03) + \
+                         (user.defense_antifighter_level * 0.07)
     total_defense_bonus = min(total_defense_bonus, 0.5)  # حداکثر 50%
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="🚀 دفاع موشکی", callback_data="upgrade_missile_def"),
-            InlineKeyboardButton(text="📡 جنگ الکترونیک", callback_data="upgrade_electronic_def")
+            InlineKeyboardButton(text="🚀 دفاع موشکی", callback_data=routes.pack('def', 'missile')),
+            InlineKeyboardButton(text="📡 جنگ الکترونیک", callback_data=routes.pack('def', 'electronic'))
         ],
         [
-            InlineKeyboardButton(text="✈️ ضد جنگنده", callback_data="upgrade_antifighter_def"),
-            InlineKeyboardButton(text="📊 اطلاعات دفاع", callback_data="defense_info")
+            InlineKeyboardButton(text="✈️ ضد جنگنده", callback_data=routes.pack('def', 'antifighter')),
+            InlineKeyboardButton(text="📊 اطلاعات دفاع", callback_data=routes.pack('defense_info'))
         ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
+        [InlineKeyboardButton(text="🔙 بازگشت", callback_data=routes.pack('back_to_main'))]
     ])
     
     defense_text = f"""
@@ -1858,87 +3724,70 @@ async def cmd_defense(message: Message):
 🛡️ بانس دفاع کلی: {total_defense_bonus*100:.1f}%
 ━━━━━━━━━━━━━━
 🚀 <b>دفاع موشکی</b>
-   • لول: {user['defense_missile_level']}
-   • بانس: {user['defense_missile_level'] * 5}%
-   • هزینه ارتقا: {(user['defense_missile_level'] + 1) * 100} سکه
+   • لول: {user.defense_missile_level}
+   • بانس: {user.defense_missile_level * 5}%
+   • هزینه ارتقا: {(user.defense_missile_level + 1) * 100} سکه
 
 📡 <b>جنگ الکترونیک</b>
-   • لول: {user['defense_electronic_level']}
-   • بانس: {user['defense_electronic_level'] * 3}%
-   • هزینه ارتقا: {(user['defense_electronic_level'] + 1) * 80} سکه
+   • لول: {user.defense_electronic_level}
+   • بانس: {user.defense_electronic_level * 3}%
+   • هزینه ارتقا: {(user.defense_electronic_level + 1) * 80} سکه
 
 ✈️ <b>ضد جنگنده</b>
-   • لول: {user['defense_antifighter_level']}
-   • بانس: {user['defense_antifighter_level'] * 7}%
-   • هزینه ارتقا: {(user['defense_antifighter_level'] + 1) * 120} سکه
+   • لول: {user.defense_antifighter_level}
+   • بانس: {user.defense_antifighter_level * 7}%
+   • هزینه ارتقا: {(user.defense_antifighter_level + 1) * 120} سکه
 ━━━━━━━━━━━━━━
-💰 سکه شما: {user['zone_coin']}
+💰 سکه شما: {user.zone_coin}
     """
     
     await message.answer(defense_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("upgrade_"))
-async def process_upgrade_defense(callback: CallbackQuery):
-    defense_type = callback.data.replace("upgrade_", "").replace("_def", "")
+@routes.callback('def', group='economy', defense_type=str)
+async def process_upgrade_defense(callback: CallbackQuery, defense_type: str):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    
-    if not user:
-        await callback.answer("❌ کاربر یافت نشد!")
-        return
-    
-    current_level = 0
-    cost_multiplier = 0
-    defense_name = ""
-    
-    if defense_type == 'missile':
-        current_level = user['defense_missile_level']
-        cost_multiplier = 100
-        defense_name = "دفاع موشکی"
-    elif defense_type == 'electronic':
-        current_level = user['defense_electronic_level']
-        cost_multiplier = 80
-        defense_name = "جنگ الکترونیک"
-    elif defense_type == 'antifighter':
-        current_level = user['defense_antifighter_level']
-        cost_multiplier = 120
-        defense_name = "ضد جنگنده"
-    else:
-        await callback.answer("❌ سیستم دفاع نامعتبر!")
-        return
-    
-    upgrade_cost = (current_level + 1) * cost_multiplier
-    
-    if user['zone_coin'] < upgrade_cost:
-        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
-        return
+    async with user_locks.hold(user_id):
+        user = await db.get_user(user_id)
     
-    db.update_user_coins(user_id, -upgrade_cost)
+        if not user:
+            await callback.answer("❌ کاربر یافت نشد!")
+            return
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
+        current_level = 0
+        cost_multiplier = 0
+        defense_name = ""
+    
+        if defense_type == 'missile':
+            current_level = user.defense_missile_level
+            cost_multiplier = 100
+            defense_name = "دفاع موشکی"
+        elif defense_type == 'electronic':
+            current_level = user.defense_electronic_level
+            cost_multiplier = 80
+            defense_name = "جنگ الکترونیک"
+        elif defense_type == 'antifighter':
+            current_level = user.defense_antifighter_level
+            cost_multiplier = 120
+            defense_name = "ضد جنگنده"
+        else:
+            await callback.answer("❌ سیستم دفاع نامعتبر!")
+            return
     
-    if defense_type == 'missile':
-        cursor.execute('UPDATE users SET defense_missile_level = defense_missile_level + 1 WHERE user_id = ?', (user_id,))
-    elif defense_type == 'electronic':
-        cursor.execute('UPDATE users SET defense_electronic_level = defense_electronic_level + 1 WHERE user_id = ?', (user_id,))
-    elif defense_type == 'antifighter':
-        cursor.execute('UPDATE users SET defense_antifighter_level = defense_antifighter_level + 1 WHERE user_id = ?', (user_id,))
+        upgrade_cost = (current_level + 1) * cost_multiplier
     
-    # محاسبه بانس جدید
-    cursor.execute('''
-    UPDATE users SET total_defense_bonus = 
-        (defense_missile_level * 0.05) + 
-        (defense_electronic_level * 0.03) + 
-        (defense_antifighter_level * 0.07)
-    WHERE user_id = ?
-    ''', (user_id,))
+        if user.zone_coin < upgrade_cost:
+            await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
+            return
     
-    conn.commit()
-    conn.close()
+        result = await db.upgrade_defense(user_id, defense_type, current_level, upgrade_cost)
     
-    updated_user = db.get_user(user_id)
-    new_total_bonus = min(updated_user['total_defense_bonus'], 0.5) * 100
+    if result['status'] == 'stale':
+        await callback.answer("❌ سطح دفاع تغییر کرده، دوباره تلاش کنید!")
+        return
+    if result['status'] != 'ok':
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} سکه")
+        return
+    new_total_bonus = min(result['total_defense_bonus'], 0.5) * 100
     
     await callback.message.edit_text(f"""
 🛡️ <b>ارتقا موفق!</b>
@@ -1948,33 +3797,50 @@ async def process_upgrade_defense(callback: CallbackQuery):
 💰 هزینه: {upgrade_cost} سکه
 ━━━━━━━━━━━━━━
 🛡️ بانس دفاع کلی: {new_total_bonus:.1f}%
-💰 سکه باقی‌مانده: {user['zone_coin'] - upgrade_cost} سکه
+💰 سکه باقی‌مانده: {result['zone_coin']} سکه
 ━━━━━━━━━━━━━━
 ✅ سیستم دفاع شما تقویت شد!
 ⚠️ حداکثر بانس دفاع: 50%
     """)
     await callback.answer(f"✅ {defense_name} ارتقا یافت!")
 
-@dp.message(F.text == "📊 رنکینگ")
-async def cmd_ranking(message: Message):
-    top_users = db.get_top_users(15)
-    
+# ابعاد رنکینگ: (متن دکمه، واحد مقدار)
+RANKING_DIMENSIONS = {
+    'coins': ("💰 سکه", "سکه"),
+    'level': ("🎯 لول", "لول"),
+    'zp': ("⚡ ZP", "ZP"),
+    'damage': ("💥 خسارت", "خسارت")
+}
+
+def create_ranking_keyboard(active: str):
+    buttons = [
+        InlineKeyboardButton(
+            text=f"✅ {title}" if dimension == active else title,
+            callback_data=routes.pack('rank', dimension)
+        )
+        for dimension, (title, _) in RANKING_DIMENSIONS.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[:2], buttons[2:]])
+
+def render_ranking(dimension: str, top_users) -> str:
+    """ساخت متن رنکینگ یک بُعد از top-K کش‌شده"""
     if not top_users:
-        await message.answer("📭 هنوز کاربری در رنکینگ وجود ندارد!")
-        return
+        return "📭 هنوز کاربری در رنکینگ وجود ندارد!"
     
-    ranking_text = "🏆 <b>رنکینگ برترین‌های جنگ‌افزار</b>\n━━━━━━━━━━━━━━━━━━\n"
+    title, unit = RANKING_DIMENSIONS[dimension]
+    column = LEADERBOARD_COLUMNS[dimension]
+    ranking_text = f"🏆 <b>رنکینگ برترین‌های جنگ‌افزار</b> ({title})\n━━━━━━━━━━━━━━━━━━\n"
     
     for i, user in enumerate(top_users, 1):
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
         
-        username = user['username'] or user['full_name']
+        username = user.username or user.full_name or str(user.user_id)
         if len(username) > 15:
             username = username[:15] + "..."
         
         ranking_text += f"{medal} <b>{username}</b>\n"
-        ranking_text += f"   💰 {user['zone_coin']:,} سکه | 💎 {user['zone_gem']} جم | ⚡ {user['zone_point']} ZP\n"
-        ranking_text += f"   🎯 لول {user['level']} | 👤 {user['user_id']}\n"
+        ranking_text += f"   💰 {user.zone_coin:,} سکه | 💎 {user.zone_gem} جم | ⚡ {user.zone_point} ZP\n"
+        ranking_text += f"   🎯 لول {user.level} | 💥 {user.total_damage:,} خسارت | 👤 {user.user_id}\n"
         
         if i < len(top_users):
             ranking_text += "━━━━━━━━━━━━━━\n"
@@ -1983,13 +3849,37 @@ async def cmd_ranking(message: Message):
 ━━━━━━━━━━━━━━━━━━
 📈 <b>آمار کلی:</b>
 • تعداد کاربران در رنکینگ: {len(top_users)}
-• بیشترین سکه: {top_users[0]['zone_coin']:,} سکه
-• بالاترین لول: لول {max(u['level'] for u in top_users)}
+• بیشترین {unit}: {getattr(top_users[0], column):,}
+• بالاترین لول: لول {max(u.level for u in top_users)}
     """
+    return ranking_text
+
+def get_ranking_text(dimension: str) -> str:
+    # رنکینگ از top-K درون حافظه خوانده می‌شود و کوئری دیتابیس ندارد
+    board = db.sync.leaderboards[dimension]
+    return board.render(functools.partial(render_ranking, dimension))
+
+@routes.text("📊 رنکینگ")
+async def cmd_ranking(message: Message):
+    await message.answer(get_ranking_text('coins'), reply_markup=create_ranking_keyboard('coins'))
+
+@routes.callback('rank', dimension=str)
+async def process_ranking_dimension(callback: CallbackQuery, dimension: str):
+    if dimension not in RANKING_DIMENSIONS:
+        await callback.answer("❌ رنکینگ نامعتبر!", show_alert=True)
+        return
     
-    await message.answer(ranking_text)
+    try:
+        await callback.message.edit_text(
+            get_ranking_text(dimension),
+            reply_markup=create_ranking_keyboard(dimension)
+        )
+    except TelegramBadRequest:
+        # همان رنکینگ بدون تغییر دوباره انتخاب شده است
+        pass
+    await callback.answer()
 
-@dp.message(F.text == "🆘 پشتیبانی")
+@routes.text("🆘 پشتیبانی")
 async def cmd_support(message: Message):
     support_text = """
 🆘 <b>پشتیبانی و راهنما</b>
@@ -2022,7 +3912,7 @@ async def cmd_support(message: Message):
     
     await message.answer(support_text)
 
-@dp.callback_query(F.data == "miner_info")
+@routes.callback('miner_info')
 async def cmd_miner_info(callback: CallbackQuery):
     miner_info = """
 ⛏️ <b>اطلاعات ماینر</b>
@@ -2048,7 +3938,7 @@ async def cmd_miner_info(callback: CallbackQuery):
     await callback.message.edit_text(miner_info)
     await callback.answer()
 
-@dp.callback_query(F.data == "defense_info")
+@routes.callback('defense_info')
 async def cmd_defense_info(callback: CallbackQuery):
     defense_info = """
 🏰 <b>اطلاعات سیستم دفاع</b>
@@ -2075,7 +3965,7 @@ async def cmd_defense_info(callback: CallbackQuery):
     await callback.message.edit_text(defense_info)
     await callback.answer()
 
-@dp.callback_query(F.data == "fighter_info")
+@routes.callback('fighter_info')
 async def cmd_fighter_info(callback: CallbackQuery):
     fighter_info = """
 ✈️ <b>اطلاعات جنگنده</b>
@@ -2103,42 +3993,42 @@ async def cmd_fighter_info(callback: CallbackQuery):
     await callback.message.edit_text(fighter_info)
     await callback.answer()
 
-@dp.callback_query(F.data == "box_inventory")
+@routes.callback('box_inventory')
 async def cmd_box_inventory(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
-    missiles = db.get_user_missiles(user_id)
+    missiles = await db.get_user_missiles(user_id)
     
     inventory_text = f"""
 📦 <b>موجودی شما</b>
 ━━━━━━━━━━━━━━
-💰 سکه: {user['zone_coin']}
-💎 جم: {user['zone_gem']}
-⚡ ZP: {user['zone_point']}
+💰 سکه: {user.zone_coin}
+💎 جم: {user.zone_gem}
+⚡ ZP: {user.zone_point}
 ━━━━━━━━━━━━━━
 💣 <b>موشک‌ها:</b>
     """
     
     if missiles:
-        for missile in missiles:
-            inventory_text += f"\n• {missile['missile_name']}: {missile['quantity']} عدد"
+        for missile_name, quantity in missiles:
+            inventory_text += f"\n• {missile_name}: {quantity} عدد"
     else:
         inventory_text += "\n• هیچ موشکی ندارید!"
     
     inventory_text += f"""
 ━━━━━━━━━━━━━━
-🎯 لول: {user['level']}
-⭐ XP: {user['xp']}/{user['level'] * 100}
-✈️ جنگنده: لول {user['fighter_level']}
-⛏️ ماینر: لول {user['miner_level']}
+🎯 لول: {user.level}
+⭐ XP: {user.xp}/{user.level * 100}
+✈️ جنگنده: لول {user.fighter_level}
+⛏️ ماینر: لول {user.miner_level}
     """
     
     await callback.message.edit_text(inventory_text)
     await callback.answer()
 
 # === دستورات ادمین ===
-@dp.message(F.text == "👑 پنل ادمین")
+@routes.text("👑 پنل ادمین")
 async def cmd_admin_panel(message: Message):
     user_id = message.from_user.id
     
@@ -2146,8 +4036,8 @@ async def cmd_admin_panel(message: Message):
         await message.answer("❌ دسترسی ممنوع! شما ادمین نیستید.")
         return
     
-    user = db.get_user(user_id)
-    if not user or not user['is_admin']:
+    user = await db.get_user(user_id)
+    if not user or not user.is_admin:
         await message.answer("❌ دسترسی ممنوع! شما ادمین نیستید.")
         return
     
@@ -2169,19 +4059,9 @@ async def cmd_admin_panel(message: Message):
 ⚠️ دسترسی فقط برای ادمین‌ها
     """
     
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📊 آمار کامل"), KeyboardButton(text="📢 پیام همگانی")],
-            [KeyboardButton(text="🎁 هدیه همگانی"), KeyboardButton(text="➕ سکه")],
-            [KeyboardButton(text="💎 جم"), KeyboardButton(text="⚡ ZP")],
-            [KeyboardButton(text="📈 تغییر لول"), KeyboardButton(text="🔙 بازگشت")]
-        ],
-        resize_keyboard=True
-    )
-    
-    await message.answer(admin_text, reply_markup=keyboard)
+    await message.answer(admin_text, reply_markup=screens['admin_panel'])
 
-@dp.message(F.text == "📊 آمار کامل")
+@routes.text("📊 آمار کامل")
 async def cmd_admin_stats(message: Message):
     user_id = message.from_user.id
     
@@ -2189,64 +4069,52 @@ async def cmd_admin_stats(message: Message):
         await message.answer("❌ دسترسی ممنوع!")
         return
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) as total_users FROM users')
-    total_users = cursor.fetchone()['total_users']
-    
-    cursor.execute('SELECT COUNT(*) as total_attacks FROM attacks')
-    total_attacks = cursor.fetchone()['total_attacks']
-    
-    cursor.execute('SELECT SUM(zone_coin) as total_coins FROM users')
-    total_coins = cursor.fetchone()['total_coins'] or 0
-    
-    cursor.execute('SELECT SUM(zone_gem) as total_gems FROM users')
-    total_gems = cursor.fetchone()['total_gems'] or 0
-    
-    cursor.execute('SELECT SUM(zone_point) as total_zp FROM users')
-    total_zp = cursor.fetchone()['total_zp'] or 0
-    
-    cursor.execute('SELECT AVG(level) as avg_level FROM users')
-    avg_level = cursor.fetchone()['avg_level'] or 0
-    
-    cursor.execute('''
-    SELECT user_id, username, full_name, created_at 
-    FROM users 
-    ORDER BY created_at DESC 
-    LIMIT 5
-    ''')
-    recent_users = cursor.fetchall()
-    
-    today = int(time.time()) - 86400
-    cursor.execute('SELECT COUNT(*) as today_users FROM users WHERE created_at > ?', (today,))
-    today_users = cursor.fetchone()['today_users']
-    
-    conn.close()
+    stats, age = await admin_stats.get()
+    cache_stats = db.sync.cache_stats()
+    keyboard_stats = screens.stats()
+    http_stats = http.metrics.snapshot()
+    lock_stats = user_locks.stats()
+    throttle_stats = throttling.stats()
+    prefilter_stats = dp.prefilter.stats()
+    outbox_stats = outbox.stats()
+    route_stats = routes.stats()
     
     stats_text = f"""
 📊 <b>آمار کامل ربات</b>
 ━━━━━━━━━━━━━━
-👥 تعداد کاربران: {total_users}
-👤 کاربران امروز: {today_users}
-⚔️ تعداد حمله‌ها: {total_attacks}
-🎯 میانگین لول: {avg_level:.1f}
+👥 تعداد کاربران: {stats['total_users']}
+👤 کاربران امروز: {stats['today_users']}
+⚔️ تعداد حمله‌ها: {stats['total_attacks']}
+🎯 میانگین لول: {stats['avg_level']:.1f}
+━━━━━━━━━━━━━━
+💰 کل سکه‌ها: {stats['total_coins']:,}
+💎 کل جم‌ها: {stats['total_gems']:,}  
+⚡ کل ZP: {stats['total_zp']:,}
+━━━━━━━━━━━━━━
+🗃️ کش کاربران: {cache_stats['size']}/{cache_stats['capacity']}
+🎯 hit: {cache_stats['hits']:,} | miss: {cache_stats['misses']:,} ({cache_stats['hit_rate']*100:.1f}%)
+⌨️ کیبورد انتخاب موشک: {keyboard_stats['pickers']} (hit: {keyboard_stats['hits']:,} | miss: {keyboard_stats['misses']:,})
+🌐 HTTP: {http_stats['requests']:,} درخواست | استفاده مجدد اتصال {http_stats['reuse_rate']*100:.1f}%
+🔌 اتصال جدید: {http_stats['new_connections']} ({http_stats['connect_ms_avg']:.0f} ms) | انتظار استخر: {http_stats['queue_wait_ms_avg']:.1f}/{http_stats['queue_wait_ms_max']:.0f} ms
+🔒 قفل کاربران: {lock_stats['active']} فعال (بیشینه {lock_stats['peak']}) | هم‌زمانی رد شده: {lock_stats['contended']:,}
+🚦 آپدیت‌های محدودشده: {throttle_stats['throttled']:,} از {throttle_stats['passed'] + throttle_stats['throttled']:,} (اقتصاد: {throttle_stats['by_class']['economy']:,} | حمله: {throttle_stats['by_class']['attack']:,})
+🧹 پیش‌فیلتر گروه: {prefilter_stats['dropped']:,} از {prefilter_stats['received']:,} آپدیت دور ریخته شد ({prefilter_stats['drop_ratio']*100:.1f}%)
+📨 اعلان‌ها: {outbox_stats['sent']:,} ارسال | {outbox_stats['retried']:,} تلاش دوباره | {outbox_stats['dropped']:,} رها شده
+🧭 مسیریابی: {route_stats['dispatched']:,} اجرا | دکمه نامعتبر: {route_stats['invalid']:,} | ناشناخته: {route_stats['unknown']:,}
 ━━━━━━━━━━━━━━
-💰 کل سکه‌ها: {total_coins:,}
-💎 کل جم‌ها: {total_gems:,}  
-⚡ کل ZP: {total_zp:,}
+🕒 به‌روزرسانی آمار: {int(age)} ثانیه پیش
 ━━━━━━━━━━━━━━
 📅 <b>آخرین کاربران:</b>
     """
     
-    for user in recent_users:
-        date = datetime.fromtimestamp(user['created_at']).strftime('%Y/%m/%d %H:%M')
-        username = user['username'] or user['full_name']
-        stats_text += f"\n• {username} (ID: {user['user_id']}) - {date}"
+    for user in stats['recent_users']:
+        date = datetime.fromtimestamp(user.created_at).strftime('%Y/%m/%d %H:%M')
+        username = user.username or user.full_name
+        stats_text += f"\n• {username} (ID: {user.user_id}) - {date}"
     
     await message.answer(stats_text)
 
-@dp.message(F.text == "📢 پیام همگانی")
+@routes.text("📢 پیام همگانی")
 async def cmd_broadcast(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -2260,35 +4128,16 @@ async def cmd_broadcast(message: Message, state: FSMContext):
 @dp.message(UserStates.waiting_for_broadcast)
 async def process_broadcast(message: Message, state: FSMContext):
     broadcast_text = message.text
-    
-    users = db.get_all_users()
-    
-    success = 0
-    failed = 0
-    
-    for user in users:
-        try:
-            await bot.send_message(
-                user['user_id'], 
-                f"📢 <b>پیام همگانی از مدیریت</b>\n━━━━━━━━━━━━━━\n{broadcast_text}"
-            )
-            success += 1
-            await asyncio.sleep(0.05)
-        except:
-            failed += 1
-    
-    await message.answer(f"""
-✅ <b>ارسال پیام همگانی</b>
-━━━━━━━━━━━━━━
-📤 ارسال شده به: {success} کاربر
-❌ ناموفق: {failed} کاربر
-📝 متن ارسالی:
-{broadcast_text[:100]}...
-    """)
-    
     await state.clear()
+    
+    # ارسال در پس‌زمینه انجام می‌شود و پیشرفت در یک پیام زنده نمایش داده می‌شود
+    job_id = await broadcasts.start(
+        message.chat.id,
+        f"📢 <b>پیام همگانی از مدیریت</b>\n━━━━━━━━━━━━━━\n{broadcast_text}"
+    )
+    logger.info(f"📢 Broadcast {job_id} started by {message.from_user.id}")
 
-@dp.message(F.text == "🎁 هدیه همگانی")
+@routes.text("🎁 هدیه همگانی")
 async def cmd_global_gift(message: Message):
     user_id = message.from_user.id
     
@@ -2297,63 +4146,48 @@ async def cmd_global_gift(message: Message):
         return
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💰 500 سکه به همه", callback_data="gift_all_coins_500")],
-        [InlineKeyboardButton(text="💎 5 جم به همه", callback_data="gift_all_gems_5")],
-        [InlineKeyboardButton(text="⚡ 250 ZP به همه", callback_data="gift_all_zp_250")],
-        [InlineKeyboardButton(text="🎁 همه موارد بالا", callback_data="gift_all_everything")],
-        [InlineKeyboardButton(text="💣 3 موشک شبح به همه", callback_data="gift_all_missiles")]
+        [InlineKeyboardButton(text="💰 500 سکه به همه", callback_data=routes.pack('gift', 'coins_500'))],
+        [InlineKeyboardButton(text="💎 5 جم به همه", callback_data=routes.pack('gift', 'gems_5'))],
+        [InlineKeyboardButton(text="⚡ 250 ZP به همه", callback_data=routes.pack('gift', 'zp_250'))],
+        [InlineKeyboardButton(text="🎁 همه موارد بالا", callback_data=routes.pack('gift', 'everything'))],
+        [InlineKeyboardButton(text="💣 3 موشک شبح به همه", callback_data=routes.pack('gift', 'missiles'))]
     ])
     
     await message.answer("🎁 انتخاب هدیه همگانی:", reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("gift_all_"))
-async def process_global_gift(callback: CallbackQuery):
-    gift_type = callback.data.replace("gift_all_", "")
-    
-    users = db.get_all_users()
-    
-    if gift_type == 'coins_500':
-        for user in users:
-            db.update_user_coins(user['user_id'], 500)
-        gift_text = "500 سکه"
-    elif gift_type == 'gems_5':
-        for user in users:
-            db.update_user_gems(user['user_id'], 5)
-        gift_text = "5 جم"
-    elif gift_type == 'zp_250':
-        for user in users:
-            db.update_user_zp(user['user_id'], 250)
-        gift_text = "250 ZP"
-    elif gift_type == 'everything':
-        for user in users:
-            db.update_user_coins(user['user_id'], 500)
-            db.update_user_gems(user['user_id'], 5)
-            db.update_user_zp(user['user_id'], 250)
-        gift_text = "500 سکه + 5 جم + 250 ZP"
-    elif gift_type == 'missiles':
-        for user in users:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT INTO user_missiles (user_id, missile_name, quantity)
-            VALUES (?, ?, 3)
-            ON CONFLICT(user_id, missile_name) 
-            DO UPDATE SET quantity = quantity + 3
-            ''', (user['user_id'], 'شبح'))
-            conn.commit()
-            conn.close()
-        gift_text = "3 موشک شبح"
+# هدیه‌های همگانی: (منابع، موشک‌ها، متن نمایشی)
+GLOBAL_GIFTS = {
+    'coins_500': ({'zone_coin': 500}, None, "500 سکه"),
+    'gems_5': ({'zone_gem': 5}, None, "5 جم"),
+    'zp_250': ({'zone_point': 250}, None, "250 ZP"),
+    'everything': ({'zone_coin': 500, 'zone_gem': 5, 'zone_point': 250}, None, "500 سکه + 5 جم + 250 ZP"),
+    'missiles': ({}, {MISSILE_IDS['شبح']: 3}, "3 موشک شبح")
+}
+
+@routes.callback('gift', gift_type=str)
+async def process_global_gift(callback: CallbackQuery, gift_type: str):
+    
+    if gift_type not in GLOBAL_GIFTS:
+        await callback.answer("❌ هدیه نامعتبر!", show_alert=True)
+        return
+    
+    resources, missiles, gift_text = GLOBAL_GIFTS[gift_type]
+    segment = UserSegment()
+    result = await db.bulk_grant(resources, missiles, segment)
+    logger.info(f"🎁 Global gift {gift_type}: {result['rows']} users in {result['elapsed_ms']:.0f} ms")
     
     await callback.message.edit_text(f"""
 🎉 <b>هدیه همگانی ارسال شد!</b>
 ━━━━━━━━━━━━━━
 🎁 هدیه: {gift_text}
-👥 تعداد کاربران: {len(users)}
+🎯 گروه: {segment.describe()}
+👥 تعداد کاربران: {result['rows']}
+⏱ مدت اجرا: {result['elapsed_ms']:.0f} ms
 ⏰ زمان: {datetime.now().strftime('%H:%M')}
     """)
     await callback.answer("✅ هدیه ارسال شد!")
 
-@dp.message(F.text == "➕ سکه")
+@routes.text("➕ سکه")
 async def cmd_add_coins(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -2364,7 +4198,7 @@ async def cmd_add_coins(message: Message, state: FSMContext):
     await message.answer("🆔 آیدی کاربر + مقدار سکه (مثال: 123456 1000):")
     await state.set_state(UserStates.waiting_for_gift_amount)
 
-@dp.message(F.text == "💎 جم")
+@routes.text("💎 جم")
 async def cmd_add_gems(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -2375,7 +4209,7 @@ async def cmd_add_gems(message: Message, state: FSMContext):
     await message.answer("🆔 آیدی کاربر + مقدار جم (مثال: 123456 50):")
     await state.set_state(UserStates.waiting_for_gift_amount)
 
-@dp.message(F.text == "⚡ ZP")
+@routes.text("⚡ ZP")
 async def cmd_add_zp(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -2386,7 +4220,7 @@ async def cmd_add_zp(message: Message, state: FSMContext):
     await message.answer("🆔 آیدی کاربر + مقدار ZP (مثال: 123456 500):")
     await state.set_state(UserStates.waiting_for_gift_amount)
 
-@dp.message(F.text == "📈 تغییر لول")
+@routes.text("📈 تغییر لول")
 async def cmd_change_level(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
@@ -2408,29 +4242,25 @@ async def process_gift_amount(message: Message, state: FSMContext):
         target_id = int(parts[0])
         amount = int(parts[1])
         
-        target_user = db.get_user(target_id)
+        target_user = await db.get_user(target_id)
         if not target_user:
             await message.answer("❌ کاربر یافت نشد!")
             return
         
         if "سکه" in message.reply_to_message.text:
-            db.update_user_coins(target_id, amount)
+            await db.update_user_coins(target_id, amount)
             gift_type = "سکه"
-            new_amount = target_user['zone_coin'] + amount
+            new_amount = target_user.zone_coin + amount
         elif "جم" in message.reply_to_message.text:
-            db.update_user_gems(target_id, amount)
+            await db.update_user_gems(target_id, amount)
             gift_type = "جم"
-            new_amount = target_user['zone_gem'] + amount
+            new_amount = target_user.zone_gem + amount
         elif "ZP" in message.reply_to_message.text:
-            db.update_user_zp(target_id, amount)
+            await db.update_user_zp(target_id, amount)
             gift_type = "ZP"
-            new_amount = target_user['zone_point'] + amount
+            new_amount = target_user.zone_point + amount
         elif "لول" in message.reply_to_message.text:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (amount, target_id))
-            conn.commit()
-            conn.close()
+            await db.set_user_level(target_id, amount)
             gift_type = "لول"
             new_amount = amount
         else:
@@ -2440,7 +4270,7 @@ async def process_gift_amount(message: Message, state: FSMContext):
         await message.answer(f"""
 ✅ <b>هدیه با موفقیت ارسال شد!</b>
 ━━━━━━━━━━━━━━
-👤 کاربر: {target_user['full_name']}
+👤 کاربر: {target_user.full_name}
 🆔 آیدی: {target_id}
 🎁 هدیه: {amount} {gift_type}
 📊 مقدار جدید: {new_amount} {gift_type}
@@ -2455,11 +4285,11 @@ async def process_gift_amount(message: Message, state: FSMContext):
         logger.error(f"Gift error: {e}")
         await message.answer("❌ خطا در ارسال هدیه!")
 
-@dp.message(F.text == "🔙 بازگشت")
+@routes.text("🔙 بازگشت")
 async def cmd_back_to_main(message: Message):
     await message.answer("🔙 بازگشت به منوی اصلی", reply_markup=create_main_keyboard())
 
-@dp.callback_query(F.data == "back_to_main")
+@routes.callback('back_to_main')
 async def callback_back_to_main(callback: CallbackQuery):
     await callback.message.edit_text("🔙 بازگشت به منوی اصلی")
     await callback.message.answer("منوی اصلی:", reply_markup=create_main_keyboard())
@@ -2469,12 +4299,79 @@ async def keep_alive():
     """ارسال درخواست Keep-Alive"""
     if KEEP_ALIVE_URL:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(KEEP_ALIVE_URL) as resp:
-                    logger.info(f"Keep-Alive sent: {resp.status}")
+            session = await http.session()
+            async with session.get(KEEP_ALIVE_URL) as resp:
+                logger.info(f"Keep-Alive sent: {resp.status}")
         except Exception as e:
             logger.error(f"Keep-Alive error: {e}")
 
+async def prune_expired_attacks() -> int:
+    """بایگانی حملات قدیمی‌تر از دوره نگهداری، دسته به دسته"""
+    cutoff = int(time.time()) - ATTACK_RETENTION_HOURS * 3600
+    started = time.perf_counter()
+    total = 0
+    while True:
+        # هر دسته یک نوبت جدا در صف نویسنده است و نوشتن‌های دیگر بینشان اجرا می‌شوند
+        pruned = await db.prune_attacks(cutoff)
+        total += pruned
+        if pruned < ATTACK_PRUNE_BATCH:
+            break
+    if total:
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"🗄️ Archived {total} attacks older than {ATTACK_RETENTION_HOURS}h ({elapsed:.0f} ms)")
+    return total
+
+async def run_polling():
+    """دریافت آپدیت‌ها با long polling (حالت پیش‌فرض)"""
+    # webhook قبلی باید حذف شود وگرنه getUpdates خطا می‌دهد
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    logger.info(f"🤖 Bot is starting to poll... (allowed_updates={allowed_updates})")
+    await dp.start_polling(bot, allowed_updates=allowed_updates)
+    logger.info("🛑 Bot polling stopped")
+
+async def run_webhook():
+    """دریافت آپدیت‌ها با webhook روی سرور aiohttp
+
+    هر درخواست بعد از بررسی secret token بلافاصله با 200 پاسخ داده می‌شود و
+    پردازش آپدیت در پس‌زمینه انجام می‌شود.
+    """
+    app = web.Application()
+    app.router.add_get('/', lambda request: web.Response(text="OK"))
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host='0.0.0.0', port=PORT).start()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"🌐 Webhook listening on port {PORT} at {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+    # مثل start_polling(handle_signals=True): SIGTERM پلتفرم باید به پاک‌سازی main() برسد
+    # (flush بافر write-behind، توقف outbox و پیام همگانی، بستن دیتابیس)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+        logger.info("🛑 Shutdown signal received")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        # webhook ثبت‌شده باقی می‌ماند تا آپدیت‌های زمان ری‌استارت در تلگرام صف شوند
+        await runner.cleanup()
+        logger.info("🛑 Webhook server stopped")
+
 async def main():
     """تابع اصلی"""
     logger.info("🚀 Starting Warzone Bot v3.0...")
@@ -2484,11 +4381,36 @@ async def main():
             await keep_alive()
             await asyncio.sleep(300)
     
-    asyncio.create_task(keep_alive_task())
+    # در حالت webhook خود درخواست‌های تلگرام سرویس را بیدار نگه می‌دارند
+    if not WEBHOOK_URL:
+        asyncio.create_task(keep_alive_task())
     
-    logger.info("🤖 Bot is starting to poll...")
-    await dp.start_polling(bot)
-    logger.info("🛑 Bot polling stopped")
+    async def attack_retention_task():
+        while True:
+            try:
+                await prune_expired_attacks()
+            except Exception as e:
+                logger.error(f"Attack retention error: {e}")
+            await asyncio.sleep(ATTACK_PRUNE_INTERVAL_MIN * 60)
+    
+    asyncio.create_task(attack_retention_task())
+    asyncio.create_task(admin_stats.run())
+    await broadcasts.resume()
+    # اعلان‌های ثبت‌شده پیش از ری‌استارت هم در اولین دور ارسال می‌شوند
+    outbox.start()
+    
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await broadcasts.stop()
+        await outbox.stop()
+        # تغییرات بافرشده (write-behind) پیش از خروج نوشته می‌شوند
+        await db.flush()
+        await db.close()
+        await http.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
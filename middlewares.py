@@ -0,0 +1,132 @@
+"""
+کنترل سیل درخواست - middleware بیرونی با سطل توکن برای هر کاربر و هر دسته هندلر
+
+هر آپدیت قبل از رسیدن به فیلترها، هندلرها و دیتابیس از دو سطل رد می‌شود: سطل کلی
+کاربر و سطل دسته‌ای که classify برای آن آپدیت برمی‌گرداند (مثلاً اقتصاد یا حمله).
+سطل‌ها در یک OrderedDict به ترتیب آخرین استفاده نگه داشته می‌شوند؛ سطلی که آن‌قدر
+بیکار مانده که دوباره پر شده با سطل نبودن فرقی ندارد و از ابتدای صف حذف می‌شود.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+# (rate توکن در ثانیه, burst ظرفیت سطل)
+Limit = Tuple[float, float]
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'stamp', 'refill_at', 'warned')
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+        # زمانی که سطل دوباره پر می‌شود و می‌توان آن را دور ریخت
+        self.refill_at = stamp
+        self.warned = False
+
+
+class TokenBuckets:
+    """نگاشت کلید -> سطل توکن با حذف سطل‌های پرشده"""
+
+    def __init__(self, max_size: int = 200000):
+        self.max_size = max_size
+        self._buckets: 'OrderedDict[Hashable, _Bucket]' = OrderedDict()
+        self.evicted = 0
+
+    def take(self, key: Hashable, limit: Limit, now: float) -> Optional[_Bucket]:
+        """برداشتن یک توکن؛ None یعنی مجاز است و در غیر این صورت سطل خالی برمی‌گردد"""
+        rate, burst = limit
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.stamp) * rate)
+            bucket.stamp = now
+            self._buckets.move_to_end(key)
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            bucket.refill_at = now + (burst - bucket.tokens) / rate
+            self._sweep(now)
+            return None
+        return bucket
+
+    def _sweep(self, now: float):
+        buckets = self._buckets
+        # ترتیب بر اساس آخرین استفاده است نه زمان پر شدن، پس حذف با اولین سطل هنوز پرنشده متوقف می‌شود
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket.refill_at > now and len(buckets) <= self.max_size:
+                break
+            del buckets[key]
+            self.evicted += 1
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """middleware بیرونی dp.update برای رد کردن آپدیت‌های بیش از حد مجاز
+
+    آپدیت رد شده به هیچ هندلری نمی‌رسد. برای callback ها فقط اولین رد شدن در هر
+    دوره خالی بودن سطل با یک answer کوتاه پاسخ داده می‌شود تا خود پاسخ‌ها سیل
+    درخواست به Bot API نسازند؛ پیام‌ها بی‌صدا دور ریخته می‌شوند.
+    """
+
+    def __init__(self, user_limit: Limit, class_limits: Dict[str, Limit],
+                 classify: Callable[[Update], Optional[str]], exempt: Iterable[int] = (),
+                 notice: str = "⏳ کمی آهسته‌تر!", max_size: int = 200000):
+        self.user_limit = user_limit
+        self.class_limits = class_limits
+        self.classify = classify
+        self.exempt = exempt
+        self.notice = notice
+        self.buckets = TokenBuckets(max_size)
+        self.passed = 0
+        self.throttled: Dict[str, int] = {'user': 0, **{name: 0 for name in class_limits}}
+        self.answered = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get('event_from_user')
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        group = 'user'
+        empty = self.buckets.take(user.id, self.user_limit, now)
+        if empty is None:
+            group = self.classify(event)
+            limit = self.class_limits.get(group) if group else None
+            if limit is not None:
+                empty = self.buckets.take((user.id, group), limit, now)
+
+        if empty is None:
+            self.passed += 1
+            return await handler(event, data)
+
+        self.throttled[group] += 1
+        if event.callback_query is not None and not empty.warned:
+            empty.warned = True
+            self.answered += 1
+            await event.callback_query.answer(self.notice)
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'passed': self.passed,
+            'throttled': sum(self.throttled.values()),
+            'by_class': dict(self.throttled),
+            'answered': self.answered,
+            'buckets': len(self.buckets),
+            'evicted': self.buckets.evicted
+        }
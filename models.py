@@ -0,0 +1,142 @@
+"""
+مدل‌های فشرده داده - رکورد کاربر و موجودی موشک
+"""
+
+from array import array
+from datetime import datetime
+from typing import Dict, Iterator, Tuple
+
+
+class Player:
+    """رکورد کاربر با __slots__ به جای dict یا tuple
+
+    هر دو شِمای دیتابیس (main.py و database.py) روی همین ساختار نگاشت می‌شوند؛
+    ستون‌هایی که در یک شِما وجود ندارند مقدار پیش‌فرض می‌گیرند.
+    """
+
+    __slots__ = (
+        'user_id', 'username', 'full_name', 'zone_coin', 'zone_gem', 'zone_point',
+        'level', 'xp', 'is_admin', 'miner_level', 'last_miner_claim',
+        'cyber_tower_level', 'defense_missile_level', 'defense_electronic_level',
+        'defense_antifighter_level', 'total_defense_bonus', 'fighter_level',
+        'last_revenge_time', 'total_damage', 'created_at'
+    )
+
+    DEFAULTS = {
+        'user_id': 0, 'username': None, 'full_name': None, 'zone_coin': 0,
+        'zone_gem': 0, 'zone_point': 0, 'level': 1, 'xp': 0, 'is_admin': 0,
+        'miner_level': 1, 'last_miner_claim': 0, 'cyber_tower_level': 0,
+        'defense_missile_level': 0, 'defense_electronic_level': 0,
+        'defense_antifighter_level': 0, 'total_defense_bonus': 0.0,
+        'fighter_level': 0, 'last_revenge_time': 0, 'total_damage': 0, 'created_at': 0
+    }
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name, self.DEFAULTS[name]))
+
+    def __repr__(self):
+        return f"Player(user_id={self.user_id}, level={self.level}, zone_coin={self.zone_coin})"
+
+    def with_deltas(self, deltas: Dict[str, int]) -> 'Player':
+        """کپی رکورد با اعمال تغییرات عددی (رکورد اصلی دست نمی‌خورد)"""
+        player = Player.__new__(Player)
+        for name in self.__slots__:
+            setattr(player, name, getattr(self, name))
+        for name, amount in deltas.items():
+            setattr(player, name, getattr(player, name) + amount)
+        return player
+
+
+# نگاشت ستون‌های هر cursor.description به ایندکس‌ها، یک بار برای هر شکل کوئری
+_player_layouts: Dict[Tuple[str, ...], Tuple[Tuple[str, int], ...]] = {}
+
+
+def _to_timestamp(value):
+    """created_at در شِمای قدیمی TIMESTAMP متنی است"""
+    if isinstance(value, str):
+        try:
+            return int(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp())
+        except ValueError:
+            return int(value) if value.isdigit() else 0
+    return value or 0
+
+
+def player_factory(cursor, row) -> Player:
+    """row_factory برای sqlite3 که به جای Row یک Player می‌سازد"""
+    columns = tuple(description[0] for description in cursor.description)
+    layout = _player_layouts.get(columns)
+    if layout is None:
+        layout = tuple(
+            (name, columns.index(name)) for name in Player.__slots__ if name in columns
+        )
+        _player_layouts[columns] = layout
+
+    player = Player.__new__(Player)
+    for name, default in Player.DEFAULTS.items():
+        setattr(player, name, default)
+    for name, index in layout:
+        setattr(player, name, row[index])
+    player.created_at = _to_timestamp(player.created_at)
+    return player
+
+
+class Inventory:
+    """موجودی موشک‌های یک کاربر - آرایه‌ای از تعدادها به ترتیب کاتالوگ
+
+    پیمایش فقط موشک‌هایی با تعداد مثبت را به صورت (نام، تعداد) برمی‌گرداند.
+    """
+
+    __slots__ = ('user_id', 'counts')
+
+    catalog: Tuple[str, ...] = ()
+    ids: Tuple[int, ...] = ()
+    slots: Dict[str, int] = {}
+    id_slots: Dict[int, int] = {}
+
+    @classmethod
+    def configure(cls, missiles):
+        """تنظیم کاتالوگ از (شناسه، نام) ها به ترتیب نمایش"""
+        missiles = tuple(missiles)
+        cls.ids = tuple(missile_id for missile_id, _ in missiles)
+        cls.catalog = tuple(name for _, name in missiles)
+        cls.slots = {name: index for index, name in enumerate(cls.catalog)}
+        cls.id_slots = {missile_id: index for index, missile_id in enumerate(cls.ids)}
+
+    def __init__(self, user_id: int, counts=None):
+        self.user_id = user_id
+        self.counts = counts if counts is not None else array('i', bytes(4 * len(self.catalog)))
+
+    @classmethod
+    def from_rows(cls, user_id: int, rows) -> 'Inventory':
+        """ساخت موجودی از سطرهای (missile_id, quantity)"""
+        inventory = cls(user_id)
+        for missile_id, quantity in rows:
+            index = cls.id_slots.get(missile_id)
+            if index is not None:
+                inventory.counts[index] = quantity
+        return inventory
+
+    def __getitem__(self, missile_name: str) -> int:
+        index = self.slots.get(missile_name)
+        return self.counts[index] if index is not None else 0
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        for name, quantity in zip(self.catalog, self.counts):
+            if quantity > 0:
+                yield name, quantity
+
+    def with_ids(self) -> Iterator[Tuple[int, str, int]]:
+        """مثل پیمایش عادی ولی به همراه شناسه موشک: (شناسه، نام، تعداد)"""
+        for missile_id, name, quantity in zip(self.ids, self.catalog, self.counts):
+            if quantity > 0:
+                yield missile_id, name, quantity
+
+    def __len__(self) -> int:
+        return sum(1 for quantity in self.counts if quantity > 0)
+
+    def __bool__(self) -> bool:
+        return any(quantity > 0 for quantity in self.counts)
+
+    def __repr__(self):
+        return f"Inventory(user_id={self.user_id}, {dict(self)})"
@@ -0,0 +1,162 @@
+"""
+ارسال‌کننده اعلان‌های outbox - تحویل پیام‌هایی که در تراکنش تسویه حمله ثبت شده‌اند
+
+اعلان هدف حمله و انتقام به جای ارسال در خود هندلر، در همان تراکنش تسویه در جدول
+outbox نوشته می‌شود؛ پس پاسخ مهاجم منتظر درخواست دوم تلگرام نمی‌ماند و crash بین
+commit و ارسال هم اعلان را گم نمی‌کند. OutboxDispatcher پیام‌ها را دسته‌ای از همه
+شاردها می‌خواند، چت‌های مختلف را هم‌زمان و پیام‌های هر چت را به ترتیب می‌فرستد.
+تحویل «حداقل یک بار» است: اگر پروسه بین ارسال و حذف سطر متوقف شود پیام دوباره می‌رود.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.types import InlineKeyboardMarkup
+
+from broadcast import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# kind -> تابعی که payload را به (متن، کیبورد) تبدیل می‌کند
+Renderer = Callable[[Dict], Tuple[str, Optional[InlineKeyboardMarkup]]]
+
+
+class OutboxDispatcher:
+    """تخلیه پس‌زمینه جدول outbox با دسته‌بندی، تلاش دوباره و حفظ ترتیب هر چت
+
+    خطای شبکه و سرور با backoff نمایی دوباره امتحان می‌شود و تا آن زمان بقیه
+    پیام‌های همان چت منتظر می‌مانند. خطاهای دائمی (بلاک شدن ربات و ...) و پیام‌هایی
+    که به max_attempts رسیده‌اند دور ریخته می‌شوند.
+    """
+
+    def __init__(self, bot: Bot, db, renderers: Dict[str, Renderer], bucket: Optional[TokenBucket] = None,
+                 batch_size: int = 100, concurrency: int = 8, poll_interval: float = 1.0,
+                 max_attempts: int = 8):
+        self.bot = bot
+        self.db = db
+        self.renderers = renderers
+        # محدودیت نرخ تلگرام برای کل ربات است؛ معمولاً همان سطل پیام همگانی داده می‌شود
+        self.bucket = bucket or TokenBucket(25)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        """بیدار کردن ارسال‌کننده بلافاصله پس از commit یک اعلان جدید"""
+        self._wake.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """توقف؛ پیام‌های ارسال‌نشده در outbox می‌مانند و در اجرای بعد فرستاده می‌شوند"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                processed = await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatch error: {e}")
+                processed = 0
+            # دسته پر یعنی احتمالاً پیام دیگری مانده است
+            if processed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain_once(self) -> int:
+        """یک دسته از هر شارد؛ خروجی تعداد پیام‌های خوانده‌شده"""
+        shards = self.db.sync.shards
+        batches = await asyncio.gather(
+            *(self.db.read(shard.get_outbox_batch, self.batch_size) for shard in shards)
+        )
+
+        chats: Dict[int, List[Tuple[int, Dict]]] = {}
+        blocked = set().union(*(chats_waiting for _, chats_waiting in batches))
+        total = 0
+        for index, (rows, _) in enumerate(batches):
+            total += len(rows)
+            for row in rows:
+                if row['chat_id'] not in blocked:
+                    chats.setdefault(row['chat_id'], []).append((index, row))
+        if not chats:
+            return total
+
+        delivered: List[List[int]] = [[] for _ in shards]
+        retries: List[List[Tuple[int, int, int]]] = [[] for _ in shards]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_chat(messages: List[Tuple[int, Dict]]):
+            async with semaphore:
+                # بین شاردها ترتیب با زمان ثبت و داخل هر شارد با id حفظ می‌شود
+                for index, row in sorted(messages, key=lambda item: (item[1]['created_at'], item[0], item[1]['id'])):
+                    retry_at = await self._deliver(row)
+                    if retry_at is None:
+                        delivered[index].append(row['id'])
+                        continue
+                    attempts = row['attempts'] + 1
+                    if attempts >= self.max_attempts:
+                        logger.warning(f"Outbox message {row['id']} to {row['chat_id']} dropped after {attempts} attempts")
+                        self.dropped += 1
+                        delivered[index].append(row['id'])
+                        continue
+                    self.retried += 1
+                    retries[index].append((row['id'], attempts, retry_at))
+                    # پیام‌های بعدی این چت تا تحویل این پیام صبر می‌کنند
+                    break
+
+        await asyncio.gather(*(send_chat(messages) for messages in chats.values()))
+        for index, shard in enumerate(shards):
+            if delivered[index] or retries[index]:
+                await self.db.write(shard.ack_outbox, delivered[index], retries[index], shard=index)
+        return total
+
+    async def _deliver(self, row: Dict) -> Optional[int]:
+        """ارسال یک پیام؛ None یعنی تمام‌شده (ارسال یا رها شده) و در غیر این صورت زمان تلاش بعدی"""
+        try:
+            text, reply_markup = self.renderers[row['kind']](json.loads(row['payload']))
+        except Exception as e:
+            logger.error(f"Outbox message {row['id']} ({row['kind']}) render error: {e}")
+            self.dropped += 1
+            return None
+
+        await self.bucket.acquire()
+        try:
+            await self.bot.send_message(row['chat_id'], text, reply_markup=reply_markup)
+            self.sent += 1
+            return None
+        except TelegramRetryAfter as e:
+            logger.warning(f"Outbox flood control: retry after {e.retry_after}s")
+            self.bucket.pause(e.retry_after)
+            return int(time.time()) + e.retry_after
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.warning(f"Outbox message {row['id']} to {row['chat_id']} failed: {e}")
+            return int(time.time()) + min(2 ** (row['attempts'] + 1), 300)
+        except TelegramAPIError as e:
+            # ربات بلاک شده، چت حذف شده و ...
+            logger.info(f"Outbox message {row['id']} to {row['chat_id']} not deliverable: {e}")
+            self.dropped += 1
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        return {'sent': self.sent, 'retried': self.retried, 'dropped': self.dropped}
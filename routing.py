@@ -0,0 +1,214 @@
+"""
+جدول مسیریابی callback ها و دکمه‌های متنی - پیدا کردن هندلر با یک جستجوی dict
+
+callback_data در قالب فشرده «action:arg1:arg2» ساخته می‌شود و هر action فیلدهای
+نوع‌دار خودش را دارد؛ رشته یک بار تجزیه و هندلر با مقدارهای تبدیل‌شده به عنوان
+آرگومان صدا زده می‌شود. متن دکمه‌های کیبورد اصلی هم مستقیم به هندلر نگاشت می‌شود.
+RoutingTable فقط یک هندلر callback و یک هندلر پیام روی router ثبت می‌کند، پس هزینه
+انتخاب هندلر با اضافه شدن قابلیت‌های جدید ثابت می‌ماند و ترتیب ثبت پیشوندها اهمیتی ندارد.
+"""
+
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.types import CallbackQuery, Message, Update
+
+SEPARATOR = ':'
+# محدودیت تلگرام برای callback_data
+MAX_CALLBACK_BYTES = 64
+
+
+class CallbackRoute:
+    __slots__ = ('action', 'fields', 'group', 'handler')
+
+    def __init__(self, action: str, fields: Dict[str, type], group: Optional[str], handler: Callable):
+        self.action = action
+        self.fields = tuple(fields.items())
+        self.group = group
+        self.handler = CallableObject(handler)
+
+    def unpack(self, rest: str, separator: str = SEPARATOR) -> Optional[Dict[str, Any]]:
+        """تبدیل بخش آرگومان‌ها به مقدارهای نوع‌دار؛ None یعنی callback_data نامعتبر است"""
+        if not self.fields:
+            return {} if not rest else None
+        # فیلد آخر می‌تواند خودش شامل جداکننده باشد
+        parts = rest.split(separator, len(self.fields) - 1)
+        if len(parts) != len(self.fields):
+            return None
+        try:
+            return {name: kind(part) for (name, kind), part in zip(self.fields, parts)}
+        except ValueError:
+            return None
+
+
+class RoutingTable:
+    """نگاشت action -> هندلر callback و متن دکمه -> هندلر پیام"""
+
+    def __init__(self):
+        self._callbacks: Dict[str, CallbackRoute] = {}
+        self._texts: Dict[str, CallableObject] = {}
+        # پیشوندهای قالب قدیمی (مثل revenge_123) برای دکمه‌هایی که قبلاً در چت‌ها ارسال شده‌اند
+        self._legacy: Dict[str, str] = {}
+        self.dispatched = 0
+        # action ثبت‌شده با آرگومان‌های نامعتبر
+        self.invalid = 0
+        # action یا پیشوند قدیمی ناشناخته
+        self.unknown = 0
+
+    # === ثبت ===
+    def callback(self, action: str, group: Optional[str] = None, **fields: type):
+        """ثبت هندلر callback؛ فیلدها به ترتیب در callback_data می‌آیند و با همین نام به هندلر داده می‌شوند"""
+        if SEPARATOR in action:
+            raise ValueError(f"action must not contain '{SEPARATOR}': {action}")
+
+        def decorator(handler: Callable) -> Callable:
+            if action in self._callbacks:
+                raise ValueError(f"callback action already registered: {action}")
+            self._callbacks[action] = CallbackRoute(action, fields, group, handler)
+            return handler
+        return decorator
+
+    def text(self, *labels: str):
+        """ثبت هندلر برای متن دقیق یک یا چند دکمه کیبورد"""
+        def decorator(handler: Callable) -> Callable:
+            callable_object = CallableObject(handler)
+            for label in labels:
+                if label in self._texts:
+                    raise ValueError(f"text button already registered: {label}")
+                self._texts[label] = callable_object
+            return handler
+        return decorator
+
+    def legacy(self, prefix: str, action: str):
+        """پذیرفتن callback_data قدیمی «prefix + آرگومان‌ها با _» برای action"""
+        self._legacy[prefix] = action
+
+    # === ساخت و تجزیه callback_data ===
+    @staticmethod
+    def pack(action: str, *values: Any) -> str:
+        data = SEPARATOR.join((action, *map(str, values)))
+        if len(data.encode()) > MAX_CALLBACK_BYTES:
+            raise ValueError(f"callback_data longer than {MAX_CALLBACK_BYTES} bytes: {data}")
+        return data
+
+    def parse(self, data: Optional[str]) -> Optional[Tuple[CallbackRoute, Dict[str, Any]]]:
+        if not data:
+            return None
+        action, _, rest = data.partition(SEPARATOR)
+        route = self._callbacks.get(action)
+        if route is not None:
+            values = route.unpack(rest)
+        else:
+            route, values = self._parse_legacy(data)
+        if route is None:
+            self.unknown += 1
+            return None
+        if values is None:
+            self.invalid += 1
+            return None
+        return route, values
+
+    def _parse_legacy(self, data: str):
+        for prefix, action in self._legacy.items():
+            if data.startswith(prefix):
+                route = self._callbacks.get(action)
+                if route is not None:
+                    return route, route.unpack(data[len(prefix):], '_')
+        return None, None
+
+    def group(self, data: Optional[str]) -> Optional[str]:
+        """دسته محدودیت (throttling) یک callback بدون تبدیل آرگومان‌ها"""
+        route = self._callbacks.get((data or '').partition(SEPARATOR)[0])
+        return route.group if route is not None else None
+
+    # === اتصال به aiogram ===
+    def attach(self, router: Router):
+        """ثبت دو هندلر جدول روی router؛ باید قبل از هندلرهای دیگر صدا زده شود تا اولویت آن‌ها حفظ شود"""
+        router.callback_query.register(self._dispatch_callback, self._match_callback)
+        router.message.register(self._dispatch_text, self._match_text)
+
+    def _match_callback(self, callback: CallbackQuery):
+        parsed = self.parse(callback.data)
+        if parsed is None:
+            return False
+        return {'route': parsed[0], 'route_values': parsed[1]}
+
+    async def _dispatch_callback(self, callback: CallbackQuery, route: CallbackRoute,
+                                 route_values: Dict[str, Any], **data):
+        self.dispatched += 1
+        return await route.handler.call(callback, **data, **route_values)
+
+    def has_text(self, text: Optional[str]) -> bool:
+        return text in self._texts
+
+    def _match_text(self, message: Message):
+        handler = self._texts.get(message.text)
+        if handler is None:
+            return False
+        return {'text_handler': handler}
+
+    async def _dispatch_text(self, message: Message, text_handler: CallableObject, **data):
+        self.dispatched += 1
+        return await text_handler.call(message, **data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'callbacks': len(self._callbacks),
+            'texts': len(self._texts),
+            'dispatched': self.dispatched,
+            'invalid': self.invalid,
+            'unknown': self.unknown
+        }
+
+
+class UpdatePrefilter:
+    """مرحله اول و ارزان رد کردن پیام‌های گروه که به هیچ هندلری نمی‌رسند
+
+    حمله با ریپلای در گروه انجام می‌شود، پس ربات همه پیام‌های گروه را دریافت می‌کند.
+    پیام گروه فقط وقتی وارد dispatcher می‌شود که متن آن دکمه ثبت‌شده جدول باشد یا با
+    یکی از prefixes (دستورها و «حمله با») شروع شود. چت خصوصی و callback ها همیشه پذیرفته
+    می‌شوند چون state های FSM (مثل متن پیام همگانی) هر متنی را می‌پذیرند.
+    """
+
+    GROUP_CHATS = frozenset(('group', 'supergroup'))
+
+    def __init__(self, routes: RoutingTable, prefixes: Iterable[str] = ('/',)):
+        self.routes = routes
+        self.prefixes = tuple(prefixes)
+        self.received = 0
+        self.dropped = 0
+
+    def accepts(self, update: Update) -> bool:
+        self.received += 1
+        message = update.message
+        if message is None or message.chat.type not in self.GROUP_CHATS:
+            return True
+        text = message.text
+        if text and (text.startswith(self.prefixes) or self.routes.has_text(text)):
+            return True
+        self.dropped += 1
+        return False
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.received - self.dropped,
+            'drop_ratio': self.dropped / self.received if self.received else 0.0
+        }
+
+
+class PrefilterDispatcher(Dispatcher):
+    """Dispatcher که آپدیت‌های رد شده prefilter را پیش از middleware ها کنار می‌گذارد
+
+    feed_update نقطه ورود مشترک polling و webhook است.
+    """
+
+    prefilter: Optional[UpdatePrefilter] = None
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        if self.prefilter is not None and not self.prefilter.accepts(update):
+            return UNHANDLED
+        return await super().feed_update(bot, update, **kwargs)
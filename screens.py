@@ -0,0 +1,103 @@
+"""
+رجیستری کیبوردها و صفحه‌های ثابت - ساخت یک‌باره markup ها و کش فرم سریال‌شده آن‌ها
+
+کیبوردهای ثابت یک بار در شروع برنامه ساخته و با نام ثبت می‌شوند؛ کیبوردهایی که به
+موجودی کاربر وابسته‌اند (انتخاب موشک) برای هر «شکل» موجودی یک بار ساخته و در یک
+LRU نگه داشته می‌شوند. RegistrySession هنگام ارسال، JSON آماده همین اشیا را به جای
+model_dump و سریال‌سازی دوباره در فرم درخواست می‌گذارد.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple, Union
+
+from aiogram import Bot
+from aiogram.methods import TelegramMethod
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+from aiohttp import FormData
+
+from http_client import HttpClient, SharedSession
+
+Markup = Union[InlineKeyboardMarkup, ReplyKeyboardMarkup]
+
+
+class ScreenRegistry:
+    """نگهداری markup های از پیش ساخته و JSON آن‌ها
+
+    اشیای ثبت‌شده مشترک بین همه درخواست‌ها هستند و نباید بعد از ثبت تغییر کنند.
+    کلید کش سریال‌شده id شیء است؛ چون خود شیء هم در کش نگه داشته می‌شود، id تا
+    زمان حذف از کش دوباره استفاده نمی‌شود.
+    """
+
+    def __init__(self, picker_cache_size: int = 2048):
+        self.picker_cache_size = picker_cache_size
+        self._static: Dict[str, Markup] = {}
+        self._pickers: 'OrderedDict[Hashable, Markup]' = OrderedDict()
+        self._serialized: Dict[int, Tuple[Markup, Optional[str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, name: str, markup: Markup) -> Markup:
+        self._static[name] = markup
+        self._serialized[id(markup)] = (markup, None)
+        return markup
+
+    def __getitem__(self, name: str) -> Markup:
+        return self._static[name]
+
+    def picker(self, key: Hashable, build: Callable[[], Markup]) -> Markup:
+        """کیبورد وابسته به موجودی؛ build فقط برای شکل‌های جدید صدا زده می‌شود"""
+        markup = self._pickers.get(key)
+        if markup is not None:
+            self._pickers.move_to_end(key)
+            self.hits += 1
+            return markup
+
+        self.misses += 1
+        markup = build()
+        self._pickers[key] = markup
+        self._serialized[id(markup)] = (markup, None)
+        while len(self._pickers) > self.picker_cache_size:
+            _, evicted = self._pickers.popitem(last=False)
+            self._serialized.pop(id(evicted), None)
+        return markup
+
+    def serialized(self, markup, dump: Callable[[Markup], str]) -> Optional[str]:
+        """JSON کش‌شده یک markup ثبت‌شده؛ None یعنی این شیء در رجیستری نیست"""
+        entry = self._serialized.get(id(markup))
+        if entry is None or entry[0] is not markup:
+            return None
+        if entry[1] is None:
+            entry = (markup, dump(markup))
+            self._serialized[id(markup)] = entry
+        return entry[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'static': len(self._static),
+            'pickers': len(self._pickers),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class RegistrySession(SharedSession):
+    """سشن ربات که reply_markup های رجیستری را از کش JSON ارسال می‌کند"""
+
+    def __init__(self, registry: ScreenRegistry, client: HttpClient, **kwargs):
+        super().__init__(client, **kwargs)
+        self.registry = registry
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        markup = getattr(method, 'reply_markup', None)
+        if markup is None:
+            return super().build_form_data(bot, method)
+
+        serialized = self.registry.serialized(
+            markup, lambda value: self.prepare_value(value, bot=bot, files={})
+        )
+        if serialized is None:
+            return super().build_form_data(bot, method)
+
+        form = super().build_form_data(bot, method.model_copy(update={'reply_markup': None}))
+        form.add_field('reply_markup', serialized)
+        return form
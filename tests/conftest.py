@@ -0,0 +1,29 @@
+"""
+تنظیمات مشترک تست‌ها
+
+main.py هنگام import توکن ربات لازم دارد و دیتابیس پیش‌فرض را در app/data مسیر جاری
+می‌سازد؛ پس پیش از import شدن ماژول‌ها مسیر جاری به یک پوشه موقت برده می‌شود.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('BOT_TOKEN', '123456:ABCdefGhIJKlmNoPQRstuVWxyz12345678')
+os.chdir(tempfile.mkdtemp(prefix='warzone-tests-'))
+
+
+@pytest.fixture
+def database(tmp_path):
+    """یک Database تک‌فایلی تازه با دو کاربر ۱ و ۲"""
+    from main import Database
+
+    db = Database(str(tmp_path / 'warzone.db'), write_behind=False, archive_path='')
+    db.register_user(1, 'u1', 'User 1')
+    db.register_user(2, 'u2', 'User 2')
+    yield db
+    db.close()
@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+from broadcast import BroadcastEngine
+from main import AsyncDatabase, Database
+
+
+class FakeBot:
+    """ثبت ارسال‌ها و ویرایش‌های پیام پیشرفت"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await asyncio.sleep(self.delay)
+        self.sent.append(chat_id)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.edits.append(text)
+
+
+def open_database(tmp_path, users):
+    sync = Database(str(tmp_path / 'warzone.db'), write_behind=False, archive_path='')
+    for user_id in range(1, users + 1):
+        sync.register_user(user_id, f'u{user_id}', f'User {user_id}')
+    return sync
+
+
+def run(sync, scenario):
+    async def wrapper():
+        db = AsyncDatabase(sync, read_workers=1)
+        try:
+            return await scenario(db)
+        finally:
+            await db.close()
+    return asyncio.run(wrapper())
+
+
+def finish(engine):
+    return asyncio.gather(*engine._tasks.values())
+
+
+def test_broadcast_checkpoints_every_page(tmp_path):
+    sync = open_database(tmp_path, 7)
+    bot = FakeBot()
+    checkpoints = []
+
+    async def scenario(db):
+        engine = BroadcastEngine(bot, db, rate=1000, concurrency=3, page_size=3)
+        update = db.update_broadcast_job
+
+        async def recording(job_id, cursor, sent, failed, status='running'):
+            checkpoints.append((cursor, sent + failed, status))
+            await update(job_id, cursor, sent, failed, status)
+
+        db.update_broadcast_job = recording
+        await engine.start(1, 'hi')
+        await finish(engine)
+
+    run(sync, scenario)
+    # پیام پیشرفت ادمین هم از همین FakeBot ارسال شده است
+    assert sorted(bot.sent[1:]) == list(range(1, 8))
+    assert checkpoints == [(3, 3, 'running'), (6, 6, 'running'), (7, 7, 'done')]
+
+
+def test_resume_continues_after_cursor(tmp_path):
+    sync = open_database(tmp_path, 7)
+    job_id = sync.create_broadcast_job(1, 'hi', 7)
+    sync.update_broadcast_job(job_id, 4, 4, 0)
+    bot = FakeBot()
+
+    async def scenario(db):
+        engine = BroadcastEngine(bot, db, rate=1000, concurrency=2, page_size=2)
+        await engine.resume()
+        await finish(engine)
+        return await db.get_running_broadcasts()
+
+    assert run(sync, scenario) == []
+    assert sorted(bot.sent) == [5, 6, 7]
+    job = sync.get_connection().execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+    assert (job['cursor'], job['sent'], job['status']) == (7, 7, 'done')
+
+
+def test_progress_is_reported_on_a_timer(tmp_path):
+    sync = open_database(tmp_path, 40)
+    bot = FakeBot(delay=0.01)
+
+    async def scenario(db):
+        # یک صفحه کامل؛ ویرایش‌های میانی فقط از تایمر می‌آیند
+        engine = BroadcastEngine(bot, db, rate=1000, concurrency=2, page_size=500, progress_interval=0.03)
+        await engine.start(1, 'hi')
+        await finish(engine)
+        edits = len(bot.edits)
+        await asyncio.sleep(0.1)
+        return edits
+
+    edits = run(sync, scenario)
+    assert len(bot.edits) == edits
+    assert len(bot.edits) >= 3
+    assert 'تمام شد' in bot.edits[-1]
+    assert all('تمام شد' not in text for text in bot.edits[:-1])
@@ -0,0 +1,86 @@
+from main import Database, MISSILE_IDS
+
+GHOST = MISSILE_IDS['شبح']
+
+
+def test_buy_charges_and_adds_missile(database):
+    user = database.get_user(1)
+    missiles = database.get_user_missiles(1)['شبح']
+
+    result = database.buy_missile(1, GHOST, 100, min_level=1)
+
+    assert result['status'] == 'ok'
+    assert result['zone_coin'] == user.zone_coin - 100 == database.get_user(1).zone_coin
+    assert database.get_user_missiles(1)['شبح'] == missiles + 1
+
+
+def test_failed_purchases_change_nothing(database):
+    user = database.get_user(1)
+    missiles = database.get_user_missiles(1)
+
+    assert database.buy_missile(1, GHOST, 100, min_level=user.level + 1)['status'] == 'low_level'
+    assert database.buy_missile(1, GHOST, user.zone_coin + 1)['status'] == 'no_coins'
+    assert database.buy_missile(1, GHOST, 1, gem_cost=user.zone_gem + 1)['status'] == 'no_gems'
+    assert database.open_box(1, 0, user.zone_gem + 1, {'zone_coin': 500})['status'] == 'no_gems'
+    assert database.buy_missile(999, GHOST, 1)['status'] == 'no_user'
+
+    after = database.get_user(1)
+    assert (after.zone_coin, after.zone_gem, after.zone_point) == (user.zone_coin, user.zone_gem, user.zone_point)
+    assert database.get_user_missiles(1) == missiles
+
+
+def test_balance_cannot_go_negative(database):
+    # هر دو خرید از روی یک موجودی خوانده‌شده تصمیم گرفته‌اند؛ فقط یکی ثبت می‌شود
+    coins = database.get_user(1).zone_coin
+    statuses = [database.buy_missile(1, GHOST, coins)['status'] for _ in range(2)]
+
+    assert statuses == ['ok', 'no_coins']
+    assert database.get_user(1).zone_coin == 0
+
+
+def test_upgrade_is_applied_once_per_level(database):
+    user = database.get_user(1)
+
+    first = database.upgrade_miner(1, user.miner_level, 10)
+    second = database.upgrade_miner(1, user.miner_level, 10)
+
+    assert (first['status'], second['status']) == ('ok', 'stale')
+    assert database.get_user(1).miner_level == user.miner_level + 1
+    assert database.get_user(1).zone_coin == user.zone_coin - 10
+
+
+def test_upgrade_without_coins_keeps_level(database):
+    user = database.get_user(1)
+
+    result = database.upgrade_defense(1, 'missile', user.defense_missile_level, user.zone_coin + 1)
+
+    assert result['status'] == 'no_coins'
+    assert database.get_user(1).defense_missile_level == user.defense_missile_level
+    result = database.upgrade_defense(1, 'missile', user.defense_missile_level, 100)
+    assert result['status'] == 'ok'
+    assert result['total_defense_bonus'] == database.get_user(1).total_defense_bonus > user.total_defense_bonus
+
+
+def test_miner_claim_is_compare_and_set(database):
+    with database.transaction() as cursor:
+        cursor.execute('UPDATE users SET last_miner_claim = last_miner_claim - 3600 WHERE user_id = 1')
+    user = database.get_user(1)
+
+    first = database.claim_miner(1, 40, user.last_miner_claim)
+    second = database.claim_miner(1, 40, user.last_miner_claim)
+
+    assert (first['status'], second['status']) == ('ok', 'already_claimed')
+    assert database.get_user(1).zone_point == user.zone_point + 40 == first['zone_point']
+
+
+def test_write_behind_deltas_are_respected(tmp_path):
+    db = Database(str(tmp_path / 'warzone.db'), write_behind=True, archive_path='')
+    db.register_user(1, 'u1', 'User 1')
+    coins = db.get_user(1).zone_coin
+    db.update_user_coins(1, -coins)
+
+    assert db.buy_missile(1, GHOST, 1)['status'] == 'no_coins'
+    db.update_user_coins(1, 5)
+    assert db.buy_missile(1, GHOST, 5)['status'] == 'ok'
+    assert db.get_user(1).zone_coin == 0
+    db.close()
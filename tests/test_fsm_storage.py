@@ -0,0 +1,101 @@
+import asyncio
+import sqlite3
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'fsm.db')
+
+
+def run(storage, coroutine):
+    async def wrapper():
+        try:
+            return await coroutine
+        finally:
+            await storage.close()
+    return asyncio.run(wrapper())
+
+
+def test_state_and_data_round_trip(path):
+    storage = SQLiteStorage(path)
+
+    async def scenario():
+        await storage.set_state(KEY, 'UserStates:waiting')
+        await storage.set_data(KEY, {'text': 'سلام'})
+        return await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert run(storage, scenario()) == ('UserStates:waiting', {'text': 'سلام'})
+
+    # پروسه بعدی از دیتابیس می‌خواند
+    reopened = SQLiteStorage(path)
+    assert run(reopened, reopened.get_state(KEY)) == 'UserStates:waiting'
+
+
+def test_clearing_deletes_row(path):
+    storage = SQLiteStorage(path)
+
+    async def scenario():
+        await storage.set_state(KEY, 'UserStates:waiting')
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+
+    run(storage, scenario())
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM fsm_states').fetchone()[0] == 0
+    conn.close()
+
+
+def test_expired_state_reads_empty(path, monkeypatch):
+    storage = SQLiteStorage(path, ttl=60)
+    clock = [1000.0]
+    monkeypatch.setattr('fsm_storage.time.time', lambda: clock[0])
+
+    async def scenario():
+        await storage.set_state(KEY, 'UserStates:waiting')
+        await storage.set_data(KEY, {'step': 1})
+        clock[0] += 30
+        fresh = await storage.get_state(KEY)
+        clock[0] += 61
+        expired = await storage.get_state(KEY), await storage.get_data(KEY)
+        # نوشتن روی کلید منقضی از داده قدیمی شروع نمی‌کند
+        await storage.set_state(KEY, 'UserStates:other')
+        return fresh, expired, await storage.get_data(KEY)
+
+    fresh, expired, data = run(storage, scenario())
+    assert fresh == 'UserStates:waiting'
+    assert expired == (None, {})
+    assert data == {}
+
+
+def test_cache_invalidated_by_other_process(path):
+    storage = SQLiteStorage(path)
+    other = sqlite3.connect(path, isolation_level=None)
+
+    async def scenario():
+        await storage.set_state(KEY, 'UserStates:waiting')
+        assert await storage.get_state(KEY) == 'UserStates:waiting'
+        other.execute("UPDATE fsm_states SET state = 'UserStates:other'")
+        return await storage.get_state(KEY)
+
+    try:
+        assert run(storage, scenario()) == 'UserStates:other'
+    finally:
+        other.close()
+
+
+def test_cache_is_bounded(path):
+    storage = SQLiteStorage(path, cache_size=2)
+
+    async def scenario():
+        for user_id in range(5):
+            await storage.set_state(StorageKey(bot_id=1, chat_id=user_id, user_id=user_id), 'S:s')
+        return len(storage._cache), await storage.get_state(StorageKey(bot_id=1, chat_id=0, user_id=0))
+
+    assert run(storage, scenario()) == (2, 'S:s')
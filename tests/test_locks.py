@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from locks import UserLocks
+
+
+def test_same_key_is_serialized_and_evicted():
+    locks = UserLocks()
+    order = []
+
+    async def worker(name):
+        async with locks.hold(1):
+            order.append(f'{name}+')
+            await asyncio.sleep(0)
+            order.append(f'{name}-')
+
+    async def run():
+        await asyncio.gather(worker('a'), worker('b'), worker('c'))
+
+    asyncio.run(run())
+    assert order == ['a+', 'a-', 'b+', 'b-', 'c+', 'c-']
+    assert len(locks) == 0
+    assert locks.stats() == {'active': 0, 'peak': 1, 'acquired': 3, 'contended': 2}
+
+
+def test_different_keys_run_concurrently():
+    locks = UserLocks()
+    inside = set()
+    overlap = []
+
+    async def worker(key):
+        async with locks.hold(key):
+            inside.add(key)
+            await asyncio.sleep(0)
+            overlap.append(len(inside))
+            inside.discard(key)
+
+    async def run():
+        await asyncio.gather(*(worker(key) for key in range(3)))
+
+    asyncio.run(run())
+    assert max(overlap) == 3
+    assert len(locks) == 0 and locks.peak == 3 and locks.contended == 0
+
+
+def test_exception_and_cancellation_release_entry():
+    locks = UserLocks()
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            async with locks.hold(1):
+                raise RuntimeError
+
+        release = asyncio.Event()
+
+        async def owner():
+            async with locks.hold(1):
+                await release.wait()
+
+        async def waiter():
+            async with locks.hold(1):
+                pass
+
+        owner_task = asyncio.create_task(owner())
+        await asyncio.sleep(0)
+        waiter_task = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert len(locks) == 1
+        # لغو شدن منتظر ورودی را برای صاحب قفل نگه می‌دارد
+        waiter_task.cancel()
+        await asyncio.gather(waiter_task, return_exceptions=True)
+        assert len(locks) == 1
+        release.set()
+        await owner_task
+
+    asyncio.run(run())
+    assert len(locks) == 0
@@ -0,0 +1,106 @@
+import sqlite3
+
+from main import SCHEMA_MIGRATIONS, Database, MISSILE_IDS
+
+# شِمای Database.init_db پیش از مایگریشن‌ها
+BASELINE_SCHEMA = '''
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    zone_coin INTEGER DEFAULT 1000,
+    zone_gem INTEGER DEFAULT 0,
+    zone_point INTEGER DEFAULT 500,
+    level INTEGER DEFAULT 1,
+    xp INTEGER DEFAULT 0,
+    is_admin BOOLEAN DEFAULT 0,
+    miner_level INTEGER DEFAULT 1,
+    last_miner_claim INTEGER DEFAULT (strftime('%s', 'now')),
+    cyber_tower_level INTEGER DEFAULT 0,
+    defense_missile_level INTEGER DEFAULT 0,
+    defense_electronic_level INTEGER DEFAULT 0,
+    defense_antifighter_level INTEGER DEFAULT 0,
+    total_defense_bonus REAL DEFAULT 0.0,
+    fighter_level INTEGER DEFAULT 0,
+    last_revenge_time INTEGER DEFAULT 0,
+    created_at INTEGER DEFAULT (strftime('%s', 'now'))
+);
+CREATE TABLE user_missiles (
+    user_id INTEGER,
+    missile_name TEXT,
+    quantity INTEGER DEFAULT 0,
+    PRIMARY KEY (user_id, missile_name),
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+CREATE TABLE attacks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    attacker_id INTEGER,
+    target_id INTEGER,
+    attack_type TEXT,
+    missile_name TEXT,
+    damage INTEGER,
+    loot_coins INTEGER,
+    loot_gems INTEGER,
+    can_revenge BOOLEAN DEFAULT 1,
+    revenge_taken BOOLEAN DEFAULT 0,
+    timestamp INTEGER DEFAULT (strftime('%s', 'now')),
+    FOREIGN KEY (attacker_id) REFERENCES users(user_id),
+    FOREIGN KEY (target_id) REFERENCES users(user_id)
+);
+'''
+
+
+def create_baseline(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (user_id, username, full_name, zone_coin) VALUES (1, 'u1', 'User 1', 700)")
+    conn.execute("""
+    INSERT INTO users (user_id, username, full_name, created_at)
+    VALUES (2, 'u2', 'User 2', '2024-01-02 03:04:05')
+    """)
+    conn.executemany('INSERT INTO user_missiles VALUES (?, ?, ?)', [(1, 'شبح', 4), (1, 'رعد', 2), (2, 'تندر', 1)])
+    conn.execute("""
+    INSERT INTO attacks (attacker_id, target_id, attack_type, missile_name, damage, loot_coins, loot_gems)
+    VALUES (1, 2, 'normal', 'رعد', 40, 10, 0)
+    """)
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = str(tmp_path / 'warzone.db')
+    create_baseline(path)
+    db = Database(path, write_behind=False, archive_path='')
+    try:
+        conn = db.get_connection()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_MIGRATIONS[-1][0]
+
+        user = db.get_user(1)
+        assert user.zone_coin == 700
+        assert user.total_damage == 40
+        assert db.get_user(2).created_at == 1704164645
+
+        missiles = db.get_user_missiles(1)
+        assert missiles['شبح'] == 4 and missiles['رعد'] == 2
+        assert db.get_user_missiles(2)['تندر'] == 1
+
+        attack_columns = {row[1] for row in conn.execute('PRAGMA table_info(attacks)')}
+        assert 'missile_name' not in attack_columns
+        assert conn.execute('SELECT missile_id FROM attacks').fetchone()[0] == MISSILE_IDS['رعد']
+
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert {'attack_daily_summary', 'broadcast_jobs', 'shard_intents', 'outbox'} <= tables
+    finally:
+        db.close()
+
+
+def test_migrations_run_once(tmp_path):
+    path = str(tmp_path / 'warzone.db')
+    create_baseline(path)
+    Database(path, write_behind=False, archive_path='').close()
+    db = Database(path, write_behind=False, archive_path='')
+    try:
+        assert db.get_user(1).total_damage == 40
+        assert db.get_user_missiles(1)['شبح'] == 4
+    finally:
+        db.close()
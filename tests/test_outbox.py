@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError
+from aiogram.methods import SendMessage
+
+from broadcast import TokenBucket
+from main import AsyncDatabase, Database, ShardedDatabase
+from outbox import OutboxDispatcher
+
+
+class FakeBot:
+    """ثبت پیام‌های ارسال‌شده؛ failures[chat_id] فهرست خطاهای نوبت‌های بعدی آن چت است"""
+
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        errors = self.failures.get(chat_id)
+        if errors:
+            raise errors.pop(0)(SendMessage(chat_id=chat_id, text=text), 'fail')
+        self.sent.append((chat_id, text))
+
+
+def enqueue(db, chat_id, text):
+    with db.transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO outbox (chat_id, kind, payload) VALUES (?, 'note', ?)",
+            (chat_id, json.dumps({'text': text}))
+        )
+
+
+def outbox_rows(db):
+    return [tuple(row) for row in db.get_connection().execute(
+        'SELECT chat_id, attempts FROM outbox ORDER BY id'
+    )]
+
+
+def release_retries(db):
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE outbox SET next_attempt_at = 0')
+
+
+def drain(sync, bot, rounds=1, between=None, **options):
+    async def run():
+        db = AsyncDatabase(sync, read_workers=1)
+        dispatcher = OutboxDispatcher(
+            bot, db, {'note': lambda payload: (payload['text'], None)}, bucket=TokenBucket(1000), **options
+        )
+        try:
+            counts = []
+            for index in range(rounds):
+                if index and between:
+                    await db.write(between, sync.shards[0])
+                counts.append(await dispatcher.drain_once())
+            return counts, dispatcher.stats()
+        finally:
+            await db.close()
+    return asyncio.run(run())
+
+
+def open_database(tmp_path):
+    return Database(str(tmp_path / 'warzone.db'), write_behind=False, archive_path='')
+
+
+def test_messages_are_delivered_in_order(tmp_path):
+    sync = open_database(tmp_path)
+    for text in ('a1', 'b1', 'a2', 'a3', 'b2'):
+        enqueue(sync, 1 if text[0] == 'a' else 2, text)
+    bot = FakeBot()
+
+    counts, stats = drain(sync, bot)
+
+    assert counts == [5]
+    assert [text for chat, text in bot.sent if chat == 1] == ['a1', 'a2', 'a3']
+    assert [text for chat, text in bot.sent if chat == 2] == ['b1', 'b2']
+    assert stats == {'sent': 5, 'retried': 0, 'dropped': 0}
+    reopened = open_database(tmp_path)
+    assert outbox_rows(reopened) == []
+    reopened.close()
+
+
+def test_failed_message_holds_its_chat_until_retry(tmp_path):
+    sync = open_database(tmp_path)
+    for chat_id, text in ((1, 'a1'), (2, 'b1'), (1, 'a2')):
+        enqueue(sync, chat_id, text)
+    bot = FakeBot({1: [TelegramNetworkError]})
+
+    counts, stats = drain(sync, bot, rounds=3, between=release_retries)
+
+    # دور اول: a1 شکست می‌خورد و a2 منتظر می‌ماند؛ دور دوم هر دو به ترتیب
+    assert counts == [3, 2, 0]
+    assert bot.sent == [(2, 'b1'), (1, 'a1'), (1, 'a2')]
+    assert stats == {'sent': 3, 'retried': 1, 'dropped': 0}
+
+
+def test_backoff_blocks_later_messages(tmp_path):
+    sync = open_database(tmp_path)
+    enqueue(sync, 1, 'a1')
+    bot = FakeBot({1: [TelegramNetworkError]})
+    drain(sync, bot)
+
+    sync = open_database(tmp_path)
+    enqueue(sync, 1, 'a2')
+    enqueue(sync, 2, 'b1')
+    counts, _ = drain(sync, bot)
+
+    assert counts == [2]
+    assert bot.sent == [(2, 'b1')]
+    sync = open_database(tmp_path)
+    assert outbox_rows(sync) == [(1, 1), (1, 0)]
+    sync.close()
+
+
+def test_permanent_errors_and_max_attempts_drop(tmp_path):
+    sync = open_database(tmp_path)
+    enqueue(sync, 1, 'blocked')
+    enqueue(sync, 2, 'flaky')
+    enqueue(sync, 3, 'ok')
+    bot = FakeBot({1: [TelegramForbiddenError], 2: [TelegramNetworkError, TelegramNetworkError]})
+
+    counts, stats = drain(sync, bot, rounds=2, between=release_retries, max_attempts=2)
+
+    assert counts == [3, 1]
+    assert bot.sent == [(3, 'ok')]
+    assert stats == {'sent': 1, 'retried': 1, 'dropped': 2}
+    sync = open_database(tmp_path)
+    assert outbox_rows(sync) == []
+    sync.close()
+
+
+def test_chats_are_ordered_across_shards(tmp_path):
+    sync = ShardedDatabase(2, str(tmp_path / 'warzone.db'), archive_path='', write_behind=False)
+    # اعلان‌های یک چت می‌توانند از شارد مهاجم‌های مختلف بیایند
+    for shard, text in ((1, 'first'), (0, 'second'), (1, 'third')):
+        enqueue(sync.shards[shard], 5, text)
+        with sync.shards[shard].transaction() as cursor:
+            cursor.execute('UPDATE outbox SET created_at = ? WHERE payload LIKE ?', (
+                {'first': 100, 'second': 200, 'third': 300}[text], f'%{text}%'
+            ))
+    bot = FakeBot()
+
+    counts, _ = drain(sync, bot)
+
+    assert counts == [3]
+    assert bot.sent == [(5, 'first'), (5, 'second'), (5, 'third')]
@@ -0,0 +1,83 @@
+import pytest
+
+from routing import RoutingTable
+
+
+@pytest.fixture
+def routes():
+    table = RoutingTable()
+
+    @table.callback('buy', group='economy', missile_id=int)
+    async def buy(callback, missile_id):
+        pass
+
+    @table.callback('rvw', group='attack', attack_id=int, missile_id=int)
+    async def revenge_with(callback, attack_id, missile_id):
+        pass
+
+    @table.callback('note', text=str)
+    async def note(callback, text):
+        pass
+
+    @table.callback('back')
+    async def back(callback):
+        pass
+
+    table.legacy('revenge_', 'rvw')
+    return table
+
+
+def test_pack_joins_fields():
+    assert RoutingTable.pack('rvw', 12, 3) == 'rvw:12:3'
+    assert RoutingTable.pack('back') == 'back'
+
+
+def test_pack_enforces_telegram_limit():
+    RoutingTable.pack('note', 'x' * 59)
+    with pytest.raises(ValueError):
+        RoutingTable.pack('note', 'x' * 60)
+    # محدودیت بر حسب بایت است
+    with pytest.raises(ValueError):
+        RoutingTable.pack('note', 'ش' * 30)
+
+
+def test_parse_round_trip(routes):
+    route, values = routes.parse(routes.pack('rvw', 12, 3))
+    assert route.action == 'rvw' and values == {'attack_id': 12, 'missile_id': 3}
+    assert routes.parse(routes.pack('back'))[1] == {}
+    # فیلد آخر می‌تواند جداکننده داشته باشد
+    assert routes.parse('note:a:b')[1] == {'text': 'a:b'}
+
+
+def test_parse_legacy_prefix(routes):
+    route, values = routes.parse('revenge_12_3')
+    assert route.action == 'rvw' and values == {'attack_id': 12, 'missile_id': 3}
+
+
+def test_invalid_and_unknown_are_counted_separately(routes):
+    for data in ('buy:x', 'buy', 'back:1', 'rvw:1', 'revenge_x_1'):
+        assert routes.parse(data) is None
+    for data in ('nope', 'nope:1', 'claim_'):
+        assert routes.parse(data) is None
+    assert routes.parse(None) is None and routes.parse('') is None
+    stats = routes.stats()
+    assert (stats['invalid'], stats['unknown']) == (5, 3)
+
+
+def test_group(routes):
+    assert routes.group('buy:1') == 'economy'
+    assert routes.group('rvw:1:2') == 'attack'
+    assert routes.group('back') is None
+    assert routes.group('nope:1') is None
+    assert routes.group(None) is None
+
+
+def test_registration_errors(routes):
+    with pytest.raises(ValueError):
+        routes.callback('a:b')
+    with pytest.raises(ValueError):
+        routes.callback('buy')(lambda callback: None)
+    routes.text('🏪 بازار')(lambda message: None)
+    with pytest.raises(ValueError):
+        routes.text('🏪 بازار')(lambda message: None)
+    assert routes.has_text('🏪 بازار') and not routes.has_text('سلام')
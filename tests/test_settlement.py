@@ -0,0 +1,69 @@
+import json
+
+from main import MISSILE_IDS
+
+GHOST = MISSILE_IDS['شبح']
+
+
+def balances(db, *user_ids):
+    return [(db.get_user(user_id).zone_coin, db.get_user(user_id).zone_gem) for user_id in user_ids]
+
+
+def test_settle_moves_loot_and_spends_missile(database):
+    (attacker_coins, _), (target_coins, _) = balances(database, 1, 2)
+    missiles = database.get_user_missiles(1)['شبح']
+
+    result = database.settle_attack(1, 2, GHOST, 25, 10)
+
+    assert result['status'] == 'ok'
+    assert result['loot_coins'] == min(int(target_coins * 0.10), 1000)
+    assert database.get_user(1).zone_coin == attacker_coins + result['loot_coins'] == result['attacker_coins']
+    assert database.get_user(2).zone_coin == target_coins - result['loot_coins'] == result['target_coins']
+    assert database.get_user_missiles(1)['شبح'] == missiles - 1
+    assert database.get_last_attack(1, 2)['id'] == result['attack_id']
+
+
+def test_settle_failures_change_nothing(database):
+    before = balances(database, 1, 2)
+    special = MISSILE_IDS['شهاب']
+
+    assert database.settle_attack(1, 2, special, 125, 10, gem_cost=1)['status'] == 'no_missile'
+    database.add_missile(1, special, 1)
+    assert database.settle_attack(1, 2, special, 125, 10, gem_cost=1)['status'] == 'no_gems'
+    assert database.get_user_missiles(1)['شهاب'] == 1
+    assert database.settle_attack(1, 999, GHOST, 25, 10)['status'] == 'no_target'
+
+    assert balances(database, 1, 2) == before
+    assert database.get_user_missiles(1)['شبح'] == 5
+
+
+def test_revenge_is_taken_once(database):
+    attack = database.settle_attack(1, 2, GHOST, 25, 10)
+
+    revenge = database.settle_attack(2, 1, GHOST, 25, 10, revenge_of=attack['attack_id'])
+    assert revenge['status'] == 'ok'
+    assert database.get_revengeable_attack(attack['attack_id']) is None
+
+    again = database.settle_attack(2, 1, GHOST, 25, 10, revenge_of=attack['attack_id'])
+    assert again['status'] == 'revenge_taken'
+    # موشک انتقام دوم برگردانده می‌شود
+    assert database.get_user_missiles(2)['شبح'] == 4
+
+
+def test_settle_enqueues_notice(database):
+    notify = {'kind': 'attack', 'payload': {'attacker_id': 1, 'damage': 25}}
+    result = database.settle_attack(1, 2, GHOST, 25, 10, notify=notify)
+
+    rows, blocked = database.get_outbox_batch()
+    assert blocked == set()
+    assert [(row['chat_id'], row['kind']) for row in rows] == [(2, 'attack')]
+    payload = json.loads(rows[0]['payload'])
+    assert payload['attacker_id'] == 1
+    assert payload['loot_coins'] == result['loot_coins']
+    assert payload['target_coins'] == result['target_coins']
+
+
+def test_failed_settle_enqueues_nothing(database):
+    notify = {'kind': 'attack', 'payload': {'attacker_id': 1}}
+    assert database.settle_attack(1, 999, GHOST, 25, 10, notify=notify)['status'] == 'no_target'
+    assert database.get_outbox_batch() == ([], set())
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import threading
+
+import pytest
+
+from main import MISSILE_IDS, AsyncDatabase, Database, ShardedDatabase
+
+GHOST = MISSILE_IDS['شبح']
+PAYLOAD = {
+    'attacker_id': 1, 'target_id': 2, 'missile_id': GHOST, 'damage': 25, 'xp_gained': 10,
+    'gem_cost': 0, 'loot_rate': 0.10, 'loot_cap': 1000, 'gem_loot_rate': 0.05, 'gem_loot_cap': 5,
+    'revenge_of': None, 'notify': None
+}
+
+
+def open_sharded(tmp_path, count=3):
+    return ShardedDatabase(count, str(tmp_path / 'warzone.db'), archive_path='', write_behind=False)
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    db = open_sharded(tmp_path)
+    for user_id in range(1, 7):
+        db.register_user(user_id, f'u{user_id}', f'User {user_id}')
+    yield db
+    db.close()
+
+
+def totals(db):
+    stats = db.get_admin_stats()
+    return stats['total_coins'], stats['total_gems']
+
+
+def test_same_shard_settle_uses_global_ids(sharded):
+    # ۱ و ۴ هر دو در شارد ۱ هستند
+    result = sharded.settle_attack(1, 4, GHOST, 25, 10)
+    assert result['status'] == 'ok'
+    assert result['attack_id'] % sharded.count == 1
+    assert sharded.get_last_attack(1, 4)['id'] == result['attack_id']
+
+
+def test_cross_shard_settle_and_revenge(sharded):
+    before = totals(sharded)
+    result = sharded.settle_attack(1, 2, GHOST, 25, 10)
+    assert result['status'] == 'ok'
+    assert sharded.get_user(1).zone_coin == result['attacker_coins']
+    assert sharded.get_user(2).zone_coin == result['target_coins']
+    assert totals(sharded) == before
+    assert sharded.get_recent_attacks_on_user(2)[0]['id'] == result['attack_id']
+
+    revenge = sharded.settle_attack(2, 1, GHOST, 25, 10, revenge_of=result['attack_id'])
+    assert revenge['status'] == 'ok'
+    assert sharded.get_revengeable_attack(result['attack_id']) is None
+    again = sharded.settle_attack(2, 1, GHOST, 25, 10, revenge_of=result['attack_id'])
+    assert again['status'] == 'revenge_taken'
+    assert sharded.get_user_missiles(2)['شبح'] == 4
+    assert totals(sharded) == before
+
+
+def test_cross_shard_failure_refunds_attacker(sharded):
+    result = sharded.settle_attack(1, 998, GHOST, 25, 10)
+    assert result['status'] == 'no_target'
+    assert sharded.get_user_missiles(1)['شبح'] == 5
+    assert sharded.shards[1].get_pending_intents() == []
+
+
+def test_cross_shard_notice_is_written_on_attacker_shard(sharded):
+    notify = {'kind': 'attack', 'payload': {'attacker_id': 1}}
+    sharded.settle_attack(1, 2, GHOST, 25, 10, notify=notify)
+    rows, _ = sharded.shards[1].get_outbox_batch()
+    assert [(row['chat_id'], row['kind']) for row in rows] == [(2, 'attack')]
+
+
+@pytest.mark.parametrize('applied', [False, True])
+def test_recover_intents_finishes_half_done_settlement(sharded, applied):
+    before = totals(sharded)
+    coins = sharded.get_user(1).zone_coin
+    opened = sharded.shards[1].open_attack_intent(2, PAYLOAD)
+    if applied:
+        # crash بین مرحله ۲ و ۳؛ اجرای دوباره مرحله ۲ نباید دوباره غارت کند
+        sharded.shards[2].apply_attack_intent(1, opened['intent_id'], PAYLOAD)
+
+    assert sharded.recover_intents() == 1
+    assert sharded.recover_intents() == 0
+    assert sharded.get_user(1).zone_coin > coins
+    assert totals(sharded) == before
+    assert sharded.get_user_missiles(1)['شبح'] == 4
+
+
+def test_pending_intents_are_recovered_on_open(tmp_path, sharded):
+    sharded.shards[1].open_attack_intent(2, PAYLOAD)
+    coins = sharded.get_user(1).zone_coin
+    sharded.close()
+    reopened = open_sharded(tmp_path)
+    try:
+        assert reopened.get_user(1).zone_coin > coins
+        assert all(not shard.get_pending_intents() for shard in reopened.shards)
+    finally:
+        reopened.close()
+
+
+def test_async_steps_run_on_each_shard_writer(sharded):
+    calls = []
+    for index, shard in enumerate(sharded.shards):
+        for name in ('settle_attack', 'open_attack_intent', 'apply_attack_intent', 'close_attack_intent',
+                     'get_pending_intents', 'prune_attacks', 'prune_intents', 'bulk_grant', 'flush'):
+            method = getattr(shard, name)
+
+            def record(*args, _method=method, _index=index, **kwargs):
+                calls.append((_index, threading.current_thread().name))
+                return _method(*args, **kwargs)
+            setattr(shard, name, record)
+
+    async def run():
+        db = AsyncDatabase(sharded)
+        try:
+            attack = await db.settle_attack(1, 2, GHOST, 25, 10)
+            assert attack['status'] == 'ok'
+            revenge = await db.settle_attack(2, 1, GHOST, 25, 10, revenge_of=attack['attack_id'])
+            assert revenge['status'] == 'ok'
+            assert (await db.settle_attack(1, 4, GHOST, 25, 10))['status'] == 'ok'
+            assert (await db.bulk_grant({'zone_gem': 1}))['rows'] == 6
+            assert await db.prune_attacks(0) == 0
+            await db.flush()
+            return list(calls)
+        finally:
+            # close پس از توقف نویسنده‌ها از thread اصلی flush می‌کند
+            await db.close()
+
+    calls = asyncio.run(run())
+    assert {index for index, _ in calls} == {0, 1, 2}
+    assert all(thread == f'db-writer-{index}' for index, thread in calls)
+
+
+def test_import_unsharded_keeps_legacy_file(tmp_path):
+    legacy = Database(str(tmp_path / 'warzone.db'), write_behind=False, archive_path='')
+    for user_id in range(1, 5):
+        legacy.register_user(user_id, f'u{user_id}', f'User {user_id}')
+    attack = legacy.settle_attack(1, 2, GHOST, 25, 10, notify={'kind': 'attack', 'payload': {'attacker_id': 1}})
+    legacy.settle_attack(3, 2, GHOST, 25, 10, notify={'kind': 'attack', 'payload': {'attacker_id': 3}})
+    legacy.close()
+    with open(tmp_path / 'warzone.db', 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    sharded = open_sharded(tmp_path, 2)
+    try:
+        with open(tmp_path / 'warzone.db', 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == digest
+        assert not list(tmp_path.glob('*.import*'))
+        assert sharded.count_users() == 4
+        # شناسه‌های قدیمی به حمله دیگری نمی‌رسند
+        assert sharded.get_revengeable_attack(attack['attack_id']) is None
+        assert len(sharded.get_recent_attacks_on_user(2)) == 2
+        rows, _ = sharded.shards[0].get_outbox_batch()
+        assert [row['payload'].count('"attacker_id": 1') for row in rows] == [1, 0]
+    finally:
+        sharded.close()
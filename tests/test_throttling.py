@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+from middlewares import ThrottlingMiddleware, TokenBuckets
+
+
+def test_bucket_allows_burst_then_refills():
+    buckets = TokenBuckets()
+    limit = (1.0, 3)
+    assert [buckets.take('a', limit, 0.0) for _ in range(3)] == [None, None, None]
+    assert buckets.take('a', limit, 0.0) is not None
+    assert buckets.take('a', limit, 0.5) is not None
+    assert buckets.take('a', limit, 1.0) is None
+    # کلیدها مستقل‌اند
+    assert buckets.take('b', limit, 1.0) is None
+
+
+def test_refilled_buckets_are_evicted():
+    buckets = TokenBuckets()
+    limit = (1.0, 2)
+    buckets.take('a', limit, 0.0)
+    buckets.take('b', limit, 0.5)
+    assert len(buckets) == 2
+    # a در ۱.۰ و b در ۱.۵ دوباره پر می‌شوند
+    buckets.take('c', limit, 1.2)
+    assert len(buckets) == 2 and buckets.evicted == 1
+    buckets.take('c', limit, 10.0)
+    assert len(buckets) == 1 and buckets.evicted == 2
+
+
+def test_max_size_evicts_least_recently_used():
+    buckets = TokenBuckets(max_size=2)
+    limit = (0.001, 5)
+    for key in 'abc':
+        buckets.take(key, limit, 0.0)
+    assert len(buckets) == 2
+    # a قدیمی‌ترین بود و با سطل پر دوباره ساخته می‌شود
+    assert all(buckets.take('a', limit, 0.0) is None for _ in range(5))
+
+
+class Callback:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def run_updates(middleware, user_id, count, callback=None):
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+        return True
+
+    async def run():
+        event = SimpleNamespace(callback_query=callback)
+        data = {'event_from_user': SimpleNamespace(id=user_id)}
+        return [await middleware(handler, event, data) for _ in range(count)]
+
+    return asyncio.run(run()), handled
+
+
+def test_user_limit_drops_excess_updates():
+    middleware = ThrottlingMiddleware((0.001, 3), {}, classify=lambda update: None)
+    results, handled = run_updates(middleware, 1, 5)
+    assert results == [True, True, True, None, None]
+    assert len(handled) == 3
+    assert middleware.stats()['throttled'] == 2
+    assert middleware.stats()['by_class']['user'] == 2
+
+
+def test_class_limit_and_single_notice():
+    middleware = ThrottlingMiddleware(
+        (100, 100), {'economy': (0.001, 2)}, classify=lambda update: 'economy', notice='slow'
+    )
+    callback = Callback()
+    results, _ = run_updates(middleware, 1, 5, callback)
+    assert results == [True, True, None, None, None]
+    assert middleware.throttled['economy'] == 3
+    # فقط اولین رد شدن در هر دوره خالی بودن سطل پاسخ داده می‌شود
+    assert callback.answers == ['slow']
+
+
+def test_exempt_users_skip_buckets():
+    middleware = ThrottlingMiddleware((0.001, 1), {}, classify=lambda update: None, exempt=[7])
+    results, _ = run_updates(middleware, 7, 4)
+    assert results == [True] * 4
+    assert len(middleware.buckets) == 0
@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+from main import Database
+
+
+@pytest.fixture
+def buffered(tmp_path):
+    db = Database(str(tmp_path / 'warzone.db'), write_behind=True, archive_path='')
+    db.register_user(1, 'u1', 'User 1')
+    db.flush()
+    yield db
+    db.close()
+
+
+def add_deferred_constraint(db):
+    """جدولی که کلید خارجی deferred آن فقط در COMMIT بررسی می‌شود"""
+    conn = db.get_connection()
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+    conn.execute('CREATE TABLE child (parent_id INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)')
+
+
+def test_commit(database):
+    with database.transaction() as cursor:
+        cursor.execute('UPDATE users SET zone_coin = 5 WHERE user_id = 1')
+    assert not database.get_connection().in_transaction
+    assert database.get_user(1).zone_coin == 5
+
+
+def test_exception_rolls_back(database):
+    coins = database.get_user(1).zone_coin
+    with pytest.raises(RuntimeError):
+        with database.transaction() as cursor:
+            cursor.execute('UPDATE users SET zone_coin = 5 WHERE user_id = 1')
+            raise RuntimeError
+    assert not database.get_connection().in_transaction
+    assert database.get_user(1).zone_coin == coins
+
+
+def test_nested_transaction_joins_outer(database):
+    coins = database.get_user(1).zone_coin
+    with pytest.raises(RuntimeError):
+        with database.transaction() as cursor:
+            database.update_user_coins(1, 100)
+            cursor.execute('UPDATE users SET zone_gem = 7 WHERE user_id = 1')
+            raise RuntimeError
+    user = database.get_user(1)
+    assert (user.zone_coin, user.zone_gem) == (coins, 0)
+
+
+def test_commit_failure_rolls_back(database):
+    add_deferred_constraint(database)
+    with pytest.raises(sqlite3.IntegrityError):
+        with database.transaction() as cursor:
+            cursor.execute('INSERT INTO child VALUES (1)')
+    conn = database.get_connection()
+    assert not conn.in_transaction
+    assert conn.execute('SELECT COUNT(*) FROM child').fetchone()[0] == 0
+    # اتصال پس از خطا دوباره قابل استفاده است
+    database.update_user_coins(1, 1)
+
+
+def test_commit_failure_restores_buffered_deltas(buffered):
+    coins = buffered.get_user(1).zone_coin
+    buffered.update_user_coins(1, 50)
+    add_deferred_constraint(buffered)
+    with pytest.raises(sqlite3.IntegrityError):
+        with buffered.transaction() as cursor:
+            cursor.execute('INSERT INTO child VALUES (1)')
+    assert buffered.pending.ops == 1
+    assert buffered.get_user(1).zone_coin == coins + 50
+    buffered.flush()
+    assert buffered.pending.ops == 0
+    row = buffered.get_connection().execute('SELECT zone_coin FROM users WHERE user_id = 1').fetchone()
+    assert row[0] == coins + 50